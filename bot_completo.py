@@ -5,18 +5,44 @@ PrenotaFacile – Minimal
 Dipendenze: vedi requirements.txt
 Avvio: scripts/start_polling.ps1 (Windows)
 """
-import os, calendar, sqlite3, asyncio, logging
+import os, calendar, sqlite3, asyncio, logging, json
 from io import BytesIO, StringIO
 import csv
 from datetime import datetime, date, time, timedelta
+from time import monotonic
 from typing import List
 from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton, InputFile
 from telegram.constants import ParseMode
+from telegram.error import RetryAfter, TelegramError
 from telegram.ext import Application, CommandHandler, CallbackQueryHandler, MessageHandler, filters, ContextTypes, ConversationHandler
 from ux_module import send_confirm
 from stats_module import get_daily_stats_text, get_weekly_stats_text
+from core_module import (
+    DB_PATH, SLOT_MINUTES, env_flag, TEST_MODE, REMINDER_DELAY, WAITLIST_STEP_SECONDS,
+    get_admin_ids, is_admin, SERVIZI,
+    db_conn, ensure_unified_schema, ensure_client_for_user,
+    init_db, migrate_db, category_emoji, ensure_sample_data,
+    datetime_from_date_time_str, booking_span, to_epoch_minutes,
+    is_slot_free_for_operator, free_slots_for_operator, day_status_symbol, operator_name,
+    operator_day_ranges, operator_ids, ANY_OPERATOR, free_slots_any_operator, assign_least_loaded, record_assignment,
+    first_available_slots, FIRST_AVAILABLE_DAYS, month_availability, PACKAGE_MAX_SERVICES, DAY_MINUTES, hhmm_to_min, min_to_hhmm, first_package_slots, book_package, save_booking, bulk_update_bookings, match_waitlist, save_slot_offer, take_slot_offer, ACTIVE_BOOKING_SQL, add_schedule_exception, delete_schedule_exception, list_schedule_exceptions,
+    find_service_by_code, availability_version, ARCHIVE_AFTER_DAYS, archive_old_bookings, bookings_source, normalize_price, format_price_eur, enable_wal, backup_database,
+)
+from runtime_module import (
+    PerChatUpdateProcessor, TASKS, drain_background_tasks, InstrumentedRequest,
+    install_job_lag_metrics, register_command_names,
+)
+from cluster_module import (
+    CLUSTER_MODE, CLUSTER_CHAT_AFFINITY, WORKER_ID, ELECTOR, LEASE_RENEW_INTERVAL,
+    ensure_cluster_tables, enqueue_waitlist_event, claim_waitlist_events,
+)
+from persistence_module import PERSISTENCE_ENABLED, build_persistence, evict_idle_sessions_job
+from dispatch_module import CallbackRouter, deduplicated, fields
+from metrics_module import METRICS_ENABLED, REMINDER_LAG, REPORT_DURATION, REPORT_SENT, connection_factory, start_metrics_server, summary_text as metrics_summary_text
+from slowquery_module import SLOW_QUERIES
+from logging_module import SAMPLED, setup_logging
+from calendar_module import NAVIGATION, PREFETCH, cached_render, edit_if_changed
 
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 ITALIAN_MONTHS = [
@@ -43,522 +69,56 @@ def load_token() -> str:
     logger.error("BOT token non trovato: imposta BOT_TOKEN o crea token.txt nella root del progetto.")
     raise SystemExit(1)
 
-TOKEN = load_token()
+# Bot API alternativa (es. scripts/fake_bot_api.py per test locali multi-worker)
+BOT_API_BASE_URL = os.environ.get("BOT_API_BASE_URL", "").strip()
 
-# Usa un percorso assoluto relativo a questo file per evitare di creare DB in cartelle diverse
-DB_PATH = os.path.join(os.path.dirname(__file__), "prenotafacile.db")
-SLOT_MINUTES = 30
+async def on_application_start(application):
+    """Hook post_init: i comandi registrati diventano etichette delle metriche."""
+    register_command_names(application)
 
-# Modalità Test/Produzione per Reminder Intelligente
-def env_flag(name: str, default: bool = False) -> bool:
-    raw = os.environ.get(name)
-    if raw is None:
-        return default
-    raw = raw.strip().lower()
-    return raw in {"1", "true", "yes", "on"}
-
-
-TEST_MODE = env_flag("TEST_MODE", default=True)
-REMINDER_DELAY = 5 if TEST_MODE else 24 * 60 * 60  # 5 secondi in test, 24 ore in produzione
-
-# Attesa tra notifiche consecutive della lista d'attesa (secondi)
-WAITLIST_STEP_SECONDS = int(os.environ.get("WAITLIST_STEP_SECONDS", "120"))
-
-# Admin
-def get_admin_ids() -> set[int]:
-    raw = os.environ.get("ADMIN_IDS", "").strip()
-    ids: set[int] = set()
-    if raw:
-        for part in raw.replace(";", ",").split(","):
-            part = part.strip()
-            if not part:
-                continue
-            try:
-                ids.add(int(part))
-            except Exception:
-                pass
-    return ids
-
-def is_admin(user_id: int) -> bool:
-    return user_id in get_admin_ids()
-
-ORARI_SETTIMANA = {
-    0: [("09:00","13:00"),("15:00","19:00")],
-    1: [("09:00","13:00"),("15:00","19:00")],
-    2: [("09:00","13:00"),("15:00","19:00")],
-    3: [("09:00","13:00"),("15:00","19:00")],
-    4: [("09:00","13:00"),("15:00","19:00")],
-    5: [("09:00","13:00")],
-    6: []
-}
-
-# Operatori: aggiornati per riflettere i nomi proposti dall'utente
-OPERATRICI = [
-    {"id":"op_sara","name":"Sara"},
-    {"id":"op_giulia","name":"Giulia"},
-    {"id":"op_martina","name":"Martina"},
-]
-
-SERVIZI = {
-    "Donna": {
-        "Trattamenti Viso": [
-            {"code":"d_viso_pulizia","nome":"Pulizia del viso","durata":60,"prezzo":40},
-            {"code":"d_viso_antiage","nome":"Trattamento anti-age","durata":75,"prezzo":60},
-            {"code":"d_viso_trattamento","nome":"Trattamento viso","durata":45,"prezzo":35},
-        ],
-        "Unghie": [
-            {"code":"d_unghie_semipermanente","nome":"Semipermanente mani","durata":60,"prezzo":30},
-            {"code":"d_unghie_refill_gel","nome":"Refill gel","durata":75,"prezzo":40},
-            {"code":"d_unghie_manicure","nome":"Manicure classica","durata":40,"prezzo":20},
-            {"code":"d_unghie_pedicure","nome":"Pedicure","durata":45,"prezzo":25},
-        ],
-        "Estetica": [
-            {"code":"d_estetica_epilazione","nome":"Epilazione completa","durata":60,"prezzo":35},
-            {"code":"d_estetica_sopracciglia","nome":"Definizione sopracciglia","durata":15,"prezzo":8},
-            {"code":"d_estetica_ceretta_completa","nome":"Ceretta completa","durata":60,"prezzo":40},
-            {"code":"d_estetica_extension_ciglia","nome":"Extension ciglia","durata":90,"prezzo":60},
-        ],
-        "Massaggi": [
-            {"code":"d_massaggio_decontr","nome":"Massaggio decontratturante","durata":50,"prezzo":50},
-            {"code":"d_massaggio_rilass","nome":"Massaggio rilassante","durata":50,"prezzo":45},
-        ],
-    },
-    "Uomo": {
-        "Trattamenti Viso": [
-            {"code":"u_viso_pulizia","nome":"Pulizia del viso","durata":60,"prezzo":40},
-            {"code":"u_viso_purificante","nome":"Trattamento viso purificante","durata":45,"prezzo":35},
-        ],
-        "Estetica": [
-            {"code":"u_estetica_sopracciglia","nome":"Definizione sopracciglia","durata":15,"prezzo":8},
-            {"code":"u_estetica_epilazione_schiena","nome":"Epilazione schiena","durata":40,"prezzo":30},
-        ],
-    },
-}
-
-# DB
-
-def db_conn():
-    return sqlite3.connect(DB_PATH, check_same_thread=False)
-
-
-def ensure_unified_schema():
-    """Allinea lo schema del DB per l'uso con entrambe le varianti."""
-    con = db_conn(); cur = con.cursor()
-
-    # Tabella clients principale (migrazione da schema legacy se necessario)
-    cur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='clients'")
-    has_clients_table = cur.fetchone() is not None
-
-    if not has_clients_table:
-        cur.execute(
-            """
-            CREATE TABLE clients (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                tg_id INTEGER UNIQUE,
-                username TEXT,
-                name TEXT,
-                phone TEXT,
-                notes TEXT,
-                last_seen TEXT
-            )
-            """
-        )
-        has_clients_table = True
-    else:
-        cur.execute("PRAGMA table_info(clients)")
-        client_cols = {row[1] for row in cur.fetchall()}
-        if "id" not in client_cols:
-            cur.execute(
-                """
-                CREATE TABLE IF NOT EXISTS clients_tmp (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    tg_id INTEGER UNIQUE,
-                    username TEXT,
-                    name TEXT,
-                    phone TEXT,
-                    notes TEXT,
-                    last_seen TEXT
-                )
-                """
-            )
-            cur.execute(
-                """
-                INSERT OR IGNORE INTO clients_tmp (tg_id, username, name, phone, notes, last_seen)
-                SELECT COALESCE(tg_id, user_id), username, name, phone, notes, last_seen FROM clients
-                """
-            )
-            cur.execute("DROP TABLE clients")
-            cur.execute("ALTER TABLE clients_tmp RENAME TO clients")
-
-    # Copia eventuali record legacy dalla tabella users nella nuova struttura
-    cur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='users'")
-    if cur.fetchone():
-        cur.execute(
-            """
-            INSERT OR IGNORE INTO clients (tg_id, username, name, phone, notes)
-            SELECT user_id, username, name, phone, notes FROM users
-            """
-        )
-
-    # Colonne mancanti su bookings
-    cur.execute("PRAGMA table_info(bookings)")
-    booking_cols = {row[1] for row in cur.fetchall()}
-
-    def ensure_booking_column(col_name: str, ddl: str, post_update_sql: str | None = None):
-        if col_name not in booking_cols:
-            cur.execute(f"ALTER TABLE bookings ADD COLUMN {ddl}")
-            if post_update_sql:
-                cur.execute(post_update_sql)
-            booking_cols.add(col_name)
-
-    ensure_booking_column("client_id", "client_id INTEGER", None)
-    ensure_booking_column("center_id", "center_id INTEGER DEFAULT 1", "UPDATE bookings SET center_id=1 WHERE center_id IS NULL")
-    ensure_booking_column("status", "status TEXT DEFAULT 'CONFIRMED'", "UPDATE bookings SET status='CONFIRMED' WHERE status IS NULL")
-    ensure_booking_column("reminder_sent", "reminder_sent INTEGER DEFAULT 0", "UPDATE bookings SET reminder_sent=0 WHERE reminder_sent IS NULL")
-
-    # Colonne mancanti su waitlist
-    cur.execute("PRAGMA table_info(waitlist)")
-    waitlist_cols = {row[1] for row in cur.fetchall()}
-    if "client_id" not in waitlist_cols:
-        cur.execute("ALTER TABLE waitlist ADD COLUMN client_id INTEGER")
-        waitlist_cols.add("client_id")
-
-    # Assicura che esistano record clients per ogni user_id visto in bookings/waitlist
-    cur.execute(
-        """
-        INSERT OR IGNORE INTO clients (tg_id, last_seen)
-        SELECT DISTINCT user_id, datetime('now') FROM bookings WHERE user_id IS NOT NULL
-        """
-    )
-    cur.execute(
-        """
-        INSERT OR IGNORE INTO clients (tg_id, last_seen)
-        SELECT DISTINCT user_id, datetime('now') FROM waitlist WHERE user_id IS NOT NULL
-        """
-    )
-
-    # Popola/Reallinea client_id sfruttando tg_id
-    cur.execute(
-        """
-        UPDATE bookings
-        SET client_id = (
-            SELECT id FROM clients WHERE tg_id = bookings.user_id
-        )
-        WHERE user_id IS NOT NULL
-        """
-    )
-    cur.execute(
-        """
-        UPDATE waitlist
-        SET client_id = (
-            SELECT id FROM clients WHERE tg_id = waitlist.user_id
-        )
-        WHERE user_id IS NOT NULL
-        """
-    )
-
-    con.commit(); con.close()
-
-
-def ensure_client_for_user(user_id: int, username: str | None = None, name: str | None = None, phone: str | None = None, notes: str | None = None) -> int | None:
-    """Crea/aggiorna il mapping verso clients e restituisce l'id client."""
-    now = datetime.utcnow().isoformat()
-    con = db_conn(); cur = con.cursor()
-    cur.execute(
-        """
-        INSERT OR IGNORE INTO clients (tg_id, username, name, phone, notes, last_seen)
-        VALUES (?,?,?,?,?,?)
-        """,
-        (user_id, username, name, phone, notes, now),
-    )
-    cur.execute(
-        """
-        UPDATE clients
-        SET username=COALESCE(?, username),
-            name=COALESCE(?, name),
-            phone=COALESCE(?, phone),
-            notes=COALESCE(?, notes),
-            last_seen=?
-        WHERE tg_id=?
-        """,
-        (username, name, phone, notes, now, user_id),
-    )
-    cur.execute("SELECT id FROM clients WHERE tg_id=?", (user_id,))
-    row = cur.fetchone()
-    con.commit(); con.close()
-    return row[0] if row else None
-
-
-def get_client_id_for_user(user_id: int) -> int | None:
-    con = db_conn(); cur = con.cursor(); cur.execute("SELECT id FROM clients WHERE tg_id=?", (user_id,)); row = cur.fetchone(); con.close(); return row[0] if row else None
-
-
-def resolve_default_center_id() -> int:
-    con = db_conn(); cur = con.cursor(); cur.execute("SELECT id FROM centers ORDER BY id LIMIT 1"); row = cur.fetchone()
-    if row:
-        center_id = row[0]
-    else:
-        cur.execute("INSERT INTO centers(name) VALUES(?)", ("Centro Principale",))
-        center_id = cur.lastrowid
-        con.commit()
-    con.close()
-    return center_id
-
-def init_db():
-    con = db_conn(); cur = con.cursor()
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS users (
-            user_id INTEGER PRIMARY KEY,
-            username TEXT,
-            name TEXT,
-            phone TEXT,
-            notes TEXT
-        )
-    """)
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS bookings (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            client_id INTEGER,
-            center_id INTEGER,
-            service_code TEXT,
-            service_name TEXT,
-            date TEXT,
-            time TEXT,
-            duration INTEGER,
-            operator_id TEXT,
-            price REAL,
-            created_at TEXT,
-            status TEXT DEFAULT 'CONFIRMED',
-            reminder_sent INTEGER DEFAULT 0
-        )
-    """)
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS waitlist (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            client_id INTEGER,
-            date TEXT,
-            service_code TEXT,
-            created_at TEXT
-        )
-    """)
-    con.commit(); con.close()
-
-def migrate_db():
-    """Aggiunge tabelle mancanti per supportare servizi/operatori/categorie da DB"""
-    con = db_conn(); cur = con.cursor()
-    # Tabella centers
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS centers (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            name TEXT NOT NULL,
-            address TEXT,
-            phone TEXT
-        )
-    """)
-    # Tabella operators
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS operators (
-            id TEXT PRIMARY KEY,
-            center_id INTEGER,
-            name TEXT NOT NULL,
-            work_start TEXT DEFAULT '09:00',
-            work_end TEXT DEFAULT '19:00',
-            FOREIGN KEY(center_id) REFERENCES centers(id)
-        )
-    """)
-    # Tabella services con gender e category
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS services (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            center_id INTEGER,
-            code TEXT UNIQUE NOT NULL,
-            title TEXT NOT NULL,
-            duration_minutes INTEGER DEFAULT 30,
-            price REAL DEFAULT 0,
-            gender TEXT,
-            category TEXT,
-            FOREIGN KEY(center_id) REFERENCES centers(id)
-        )
-    """)
-    # Rinomina users -> clients per consistenza
-    cur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='clients'")
-    if not cur.fetchone():
-        cur.execute("ALTER TABLE users RENAME TO clients")
-    # Aggiungi colonne mancanti in clients
-    try:
-        cur.execute("ALTER TABLE clients ADD COLUMN tg_id INTEGER")
-    except Exception:
-        pass  # Colonna già esiste
-    try:
-        cur.execute("ALTER TABLE clients ADD COLUMN last_seen TEXT")
-    except Exception:
-        pass
-    con.commit(); con.close()
-
-def category_emoji(cat: str) -> str:
-    """Mappa categoria a emoji"""
-    mapping = {
-        "Trattamenti Viso": "💆",
-        "Unghie": "💅",
-        "Estetica": "✨",
-        "Massaggi": "💆‍♀️"
-    }
-    emoji = mapping.get(cat, "📋")
-    return f"{emoji} {cat}"
-
-def ensure_sample_data():
-    """Popola DB con centro, operatori e servizi completi (Donna/Uomo con categorie)"""
-    con = db_conn(); cur = con.cursor()
-    # Centro
-    cur.execute("SELECT COUNT(*) FROM centers")
-    if cur.fetchone()[0] == 0:
-        cur.execute("INSERT INTO centers(name, address, phone) VALUES(?,?,?)",
-                    ("Centro Estetico Bella Vita", "Via Roma 123", "0123456789"))
-        center_id = cur.lastrowid
-    else:
-        cur.execute("SELECT id FROM centers LIMIT 1")
-        center_id = cur.fetchone()[0]
-    
-    # Operatori
-    cur.execute("SELECT COUNT(*) FROM operators")
-    if cur.fetchone()[0] == 0:
-        operators_data = [
-            ("op_sara", center_id, "Sara", "09:00", "19:00"),
-            ("op_giulia", center_id, "Giulia", "09:00", "19:00"),
-            ("op_martina", center_id, "Martina", "09:00", "18:00"),
-        ]
-        cur.executemany("INSERT INTO operators(id, center_id, name, work_start, work_end) VALUES(?,?,?,?,?)", operators_data)
-    
-    # Servizi completi (39 totali: 24 Donna + 15 Uomo)
-    cur.execute("SELECT COUNT(*) FROM services")
-    if cur.fetchone()[0] == 0:
-        services_data = [
-            # DONNA - Trattamenti Viso (8)
-            (center_id, "d_viso_pulizia", "Pulizia del viso profonda", 60, 40, "Donna", "Trattamenti Viso"),
-            (center_id, "d_viso_antiage", "Trattamento anti-age", 75, 60, "Donna", "Trattamenti Viso"),
-            (center_id, "d_viso_idratante", "Trattamento viso idratante", 50, 45, "Donna", "Trattamenti Viso"),
-            (center_id, "d_viso_purificante", "Trattamento viso purificante", 55, 38, "Donna", "Trattamenti Viso"),
-            (center_id, "d_viso_schiarente", "Trattamento viso schiarente", 65, 50, "Donna", "Trattamenti Viso"),
-            (center_id, "d_viso_lifting", "Trattamento lifting viso", 80, 70, "Donna", "Trattamenti Viso"),
-            (center_id, "d_viso_peeling", "Peeling chimico viso", 45, 55, "Donna", "Trattamenti Viso"),
-            (center_id, "d_viso_acne", "Trattamento acne", 60, 50, "Donna", "Trattamenti Viso"),
-            
-            # DONNA - Unghie (7)
-            (center_id, "d_unghie_semipermanente", "Semipermanente mani", 60, 30, "Donna", "Unghie"),
-            (center_id, "d_unghie_refill_gel", "Refill gel", 75, 40, "Donna", "Unghie"),
-            (center_id, "d_unghie_manicure", "Manicure classica", 40, 20, "Donna", "Unghie"),
-            (center_id, "d_unghie_pedicure", "Pedicure", 45, 25, "Donna", "Unghie"),
-            (center_id, "d_unghie_ricostruzione", "Ricostruzione unghie", 90, 50, "Donna", "Unghie"),
-            (center_id, "d_unghie_nail_art", "Nail art decorazioni", 30, 15, "Donna", "Unghie"),
-            (center_id, "d_unghie_french", "French manicure", 50, 28, "Donna", "Unghie"),
-            
-            # DONNA - Estetica (5)
-            (center_id, "d_estetica_epilazione", "Epilazione completa", 60, 35, "Donna", "Estetica"),
-            (center_id, "d_estetica_sopracciglia", "Definizione sopracciglia", 15, 8, "Donna", "Estetica"),
-            (center_id, "d_estetica_ceretta_completa", "Ceretta completa", 60, 40, "Donna", "Estetica"),
-            (center_id, "d_estetica_extension_ciglia", "Extension ciglia", 90, 60, "Donna", "Estetica"),
-            (center_id, "d_estetica_laminazione", "Laminazione ciglia", 45, 35, "Donna", "Estetica"),
-            
-            # DONNA - Massaggi (4)
-            (center_id, "d_massaggio_decontr", "Massaggio decontratturante", 50, 50, "Donna", "Massaggi"),
-            (center_id, "d_massaggio_rilass", "Massaggio rilassante", 50, 45, "Donna", "Massaggi"),
-            (center_id, "d_massaggio_drenante", "Massaggio drenante", 60, 55, "Donna", "Massaggi"),
-            (center_id, "d_massaggio_stone", "Massaggio hot stone", 70, 65, "Donna", "Massaggi"),
-            
-            # UOMO - Trattamenti Viso (6)
-            (center_id, "u_viso_pulizia", "Pulizia del viso profonda", 60, 40, "Uomo", "Trattamenti Viso"),
-            (center_id, "u_viso_purificante", "Trattamento viso purificante", 45, 35, "Uomo", "Trattamenti Viso"),
-            (center_id, "u_viso_anti_fatica", "Trattamento anti-fatica", 50, 42, "Uomo", "Trattamenti Viso"),
-            (center_id, "u_viso_barba", "Trattamento barba", 30, 25, "Uomo", "Trattamenti Viso"),
-            (center_id, "u_viso_idratante", "Trattamento idratante", 40, 38, "Uomo", "Trattamenti Viso"),
-            (center_id, "u_viso_peeling", "Peeling viso uomo", 45, 50, "Uomo", "Trattamenti Viso"),
-            
-            # UOMO - Unghie (3)
-            (center_id, "u_unghie_manicure", "Manicure uomo", 35, 18, "Uomo", "Unghie"),
-            (center_id, "u_unghie_pedicure", "Pedicure uomo", 40, 22, "Uomo", "Unghie"),
-            (center_id, "u_unghie_cura", "Cura unghie", 25, 15, "Uomo", "Unghie"),
-            
-            # UOMO - Estetica (3)
-            (center_id, "u_estetica_sopracciglia", "Definizione sopracciglia", 15, 8, "Uomo", "Estetica"),
-            (center_id, "u_estetica_epilazione_schiena", "Epilazione schiena", 40, 30, "Uomo", "Estetica"),
-            (center_id, "u_estetica_ceretta_corpo", "Ceretta corpo", 50, 35, "Uomo", "Estetica"),
-            
-            # UOMO - Massaggi (3)
-            (center_id, "u_massaggio_sportivo", "Massaggio sportivo", 50, 55, "Uomo", "Massaggi"),
-            (center_id, "u_massaggio_decontr", "Massaggio decontratturante", 50, 50, "Uomo", "Massaggi"),
-            (center_id, "u_massaggio_schiena", "Massaggio schiena", 40, 40, "Uomo", "Massaggi"),
-        ]
-        
-        # 🆕 NUOVI SERVIZI BEAUTY - DONNA (aggiuntivi)
-        new_services_donna = [
-            # Estetica
-            (center_id, "epilazione_completa_corpo", "Epilazione completa corpo", 60, 35, "Donna", "Estetica"),
-            (center_id, "sopracciglia_baffetti", "Sopracciglia / Baffetti", 20, 10, "Donna", "Estetica"),
-            (center_id, "ceretta_parziale", "Ceretta parziale (gambe o braccia)", 30, 25, "Donna", "Estetica"),
-            (center_id, "corpo_anticellulite", "Trattamento corpo anticellulite", 50, 55, "Donna", "Estetica"),
-            (center_id, "laminazione_ciglia_sopracciglia", "Laminazione ciglia / sopracciglia", 40, 40, "Donna", "Estetica"),
-            (center_id, "solarium", "Solarium", 20, 15, "Donna", "Estetica"),
-            (center_id, "trucco_giorno_sera", "Trucco giorno / sera", 45, 50, "Donna", "Estetica"),
-            
-            # Unghie
-            (center_id, "manicure_pedicure_base", "Manicure / Pedicure base", 40, 25, "Donna", "Unghie"),
-            (center_id, "smalto_semipermanente_mani", "Smalto semipermanente mani", 30, 28, "Donna", "Unghie"),
-            (center_id, "ricostruzione_unghie_gel_completa", "Ricostruzione unghie in gel", 60, 45, "Donna", "Unghie"),
-            
-            # Trattamenti Viso
-            (center_id, "pulizia_viso_base_donna", "Pulizia viso base", 40, 35, "Donna", "Trattamenti Viso"),
-            (center_id, "trattamento_viso_antiage_premium", "Trattamento viso anti-age premium", 50, 60, "Donna", "Trattamenti Viso"),
-            
-            # Massaggi
-            (center_id, "massaggio_rilassante_donna", "Massaggio rilassante completo", 50, 50, "Donna", "Massaggi"),
-            (center_id, "massaggio_drenante_gambe", "Massaggio drenante gambe", 45, 45, "Donna", "Massaggi"),
-        ]
-        
-        # 🆕 NUOVI SERVIZI BEAUTY - UOMO (aggiuntivi)
-        new_services_uomo = [
-            # Trattamenti Viso
-            (center_id, "taglio_barba_completo", "Taglio capelli + Barba", 30, 25, "Uomo", "Trattamenti Viso"),
-            (center_id, "viso_purificante_uomo", "Trattamento viso purificante uomo", 40, 38, "Uomo", "Trattamenti Viso"),
-            (center_id, "anticaduta_capelli", "Trattamento anticaduta capelli", 40, 45, "Uomo", "Trattamenti Viso"),
-            (center_id, "viso_energizzante", "Trattamento viso energizzante", 45, 42, "Uomo", "Trattamenti Viso"),
-            
-            # Massaggi
-            (center_id, "massaggio_decontratturante_uomo", "Massaggio decontratturante completo", 50, 55, "Uomo", "Massaggi"),
-            (center_id, "massaggio_rilassante_uomo_full", "Massaggio rilassante uomo", 50, 50, "Uomo", "Massaggi"),
-            (center_id, "trattamento_corpo_tonificante", "Trattamento corpo tonificante", 45, 50, "Uomo", "Massaggi"),
-            
-            # Estetica
-            (center_id, "ceretta_torace_schiena", "Ceretta torace / schiena", 35, 30, "Uomo", "Estetica"),
-            (center_id, "solarium_uomo", "Solarium uomo", 20, 15, "Uomo", "Estetica"),
-            
-            # Unghie
-            (center_id, "cura_mani_piedi_uomo", "Cura mani / piedi uomo", 40, 20, "Uomo", "Unghie"),
-        ]
-        
-        # Inserisci servizi esistenti
-        cur.executemany(
-            "INSERT INTO services(center_id, code, title, duration_minutes, price, gender, category) VALUES(?,?,?,?,?,?,?)",
-            services_data
-        )
-        
-        # Inserisci nuovi servizi Donna
-        cur.executemany(
-            "INSERT INTO services(center_id, code, title, duration_minutes, price, gender, category) VALUES(?,?,?,?,?,?,?)",
-            new_services_donna
-        )
-        
-        # Inserisci nuovi servizi Uomo
-        cur.executemany(
-            "INSERT INTO services(center_id, code, title, duration_minutes, price, gender, category) VALUES(?,?,?,?,?,?,?)",
-            new_services_uomo
-        )
-        con.commit()
-        logger.info("[MINIMAL] Dati di demo inseriti (Donna/Uomo con servizi completi).")
-    con.close()
-
-# Utils calendario
+async def on_application_stop(application):
+    """Hook post_stop: drena i task in background e rilascia il lease del cluster."""
+    await drain_background_tasks(application)
+    if CLUSTER_MODE:
+        try:
+            ELECTOR.release()
+        except Exception as e:
+            logger.warning("Rilascio lease fallito: %s", e)
+
+def build_app_builder(token: str):
+    """ApplicationBuilder comune alle due varianti."""
+    builder = Application.builder().token(token)
+    if BOT_API_BASE_URL:
+        builder = builder.base_url(BOT_API_BASE_URL.rstrip("/") + "/bot").base_file_url(BOT_API_BASE_URL.rstrip("/") + "/file/bot")
+    persistence = build_persistence()
+    if persistence is not None:
+        # Conversazioni e user_data sopravvivono ai riavvii (SQLite, scrittura a lotti)
+        builder = builder.persistence(persistence)
+    if METRICS_ENABLED:
+        # Stessi pool del default PTB, con durata ed errori per metodo Bot API
+        builder = builder.request(InstrumentedRequest(connection_pool_size=256)).get_updates_request(InstrumentedRequest())
+    # Update concorrenti tra utenti diversi, ordinati per singola chat (stati ASK_* della conversazione)
+    return builder.concurrent_updates(PerChatUpdateProcessor()).post_init(on_application_start).post_stop(on_application_stop)
+
+def bind_runtime(app):
+    """Collega all'Application i servizi di runtime comuni alle due varianti."""
+    TASKS.bind(app)
+    processor = app.update_processor
+    if hasattr(processor, "add_arrival_callback"):
+        # Raffiche di tocchi mese prec./succ.: si calcola solo l'ultimo (calendar_module)
+        processor.add_arrival_callback(NAVIGATION.arrived)
+        processor.add_done_callback(NAVIGATION.done)
+    # Precalcolo dei mesi adiacenti solo con il bot poco impegnato
+    PREFETCH.bind(processor, TASKS)
+    if METRICS_ENABLED and app.job_queue is not None:
+        install_job_lag_metrics(app.job_queue)
+    if app.persistence is not None and app.job_queue is not None:
+        interval = max(60, app.persistence.idle_seconds / 4)
+        app.job_queue.run_repeating(evict_idle_sessions_job, interval=interval, first=interval, name="persistence_evict")
+    if ARCHIVE_AFTER_DAYS > 0 and ARCHIVE_INTERVAL_HOURS > 0 and app.job_queue is not None:
+        # In cluster lo esegue solo il leader; da soli lo esegue il worker unico
+        job = leader_only(archive_job) if CLUSTER_MODE else archive_job
+        app.job_queue.run_repeating(job, interval=ARCHIVE_INTERVAL_HOURS * 3600, first=120, name="bookings_archive")
 
 # ------------------------
 # LISTA D'ATTESA - helper
@@ -608,375 +168,480 @@ async def join_waitlist(user_id: int, date_str: str, svc_code: str) -> int:
     con.close()
     return int(pos) if pos else 1
 
-# ------------------------
-# UTENTE - SALVATAGGIO E AGGIORNAMENTO
-# ------------------------
-def save_or_update_user(user_id: int, username: str | None = None, name: str | None = None, phone: str | None = None, notes: str | None = None) -> int | None:
-    """Salva/aggiorna i dati utente su clients e mantiene la tabella legacy users."""
-    client_id = ensure_client_for_user(user_id, username=username, name=name, phone=phone, notes=notes)
-
-    # Mantieni sincronizzata la tabella legacy users se presente
-    try:
-        con = db_conn(); cur = con.cursor()
-        cur.execute(
-            "INSERT OR IGNORE INTO users (user_id, username, name, phone, notes) VALUES (?,?,?,?,?)",
-            (user_id, username, name, phone, notes),
-        )
-        cur.execute(
-            "UPDATE users SET username=?, name=?, phone=?, notes=? WHERE user_id=?",
-            (username, name, phone, notes, user_id),
-        )
-        con.commit(); con.close()
-    except Exception:
-        # Se la tabella non esiste più ignoriamo l'errore
-        pass
-
-    return client_id
-
-def parse_time_hhmm(s: str) -> time:
-    h, m = map(int, s.split(":")); return time(hour=h, minute=m)
-
-def datetime_from_date_time_str(date_str: str, time_str: str) -> datetime:
-    d = datetime.strptime(date_str, "%Y-%m-%d").date(); t = parse_time_hhmm(time_str); return datetime.combine(d, t)
-
-def list_all_slots_for_day(d: date, durata: int) -> List[str]:
-    wd = d.weekday(); ranges = ORARI_SETTIMANA.get(wd, []); slots = []
-    for start_s, end_s in ranges:
-        start_dt = datetime.combine(d, parse_time_hhmm(start_s)); end_dt = datetime.combine(d, parse_time_hhmm(end_s))
-        cur = start_dt
-        while cur + timedelta(minutes=durata) <= end_dt:
-            slots.append(cur.time().strftime("%H:%M")); cur = cur + timedelta(minutes=SLOT_MINUTES)
-    return slots
-
-def is_slot_free_for_operator(date_str: str, time_str: str, durata: int, operator_id: str) -> bool:
-    """Verifica se uno slot è libero per un operatore.
-
-    Calcola new_start/new_end e controlla sovrapposizioni con le prenotazioni esistenti
-    nello stesso giorno e per lo stesso operatore. Ritorna sempre True/False in modo affidabile.
-    """
-    exs = []
-    con = None
-    try:
-        con = db_conn()
-        cur = con.cursor()
-        cur.execute(
-            "SELECT time, duration, date FROM bookings WHERE date=? AND operator_id=?",
-            (date_str, operator_id),
-        )
-        exs = cur.fetchall()
-    except Exception as e:
-        logger.debug("Errore DB in is_slot_free_for_operator: %s", e)
-        # Conservativo: considera non libero in caso di errore DB
-        return False
-    finally:
-        try:
-            if con:
-                con.close()
-        except Exception:
-            pass
-
-    new_start = datetime_from_date_time_str(date_str, time_str)
-    new_end = new_start + timedelta(minutes=int(durata))
-    for t, d, dat in exs:
-        ex_start = datetime_from_date_time_str(dat, t)
-        ex_end = ex_start + timedelta(minutes=int(d))
-        # Sovrapposizione se gli intervalli [new_start,new_end) e [ex_start,ex_end) si intersecano
-        if not (new_end <= ex_start or new_start >= ex_end):
-            return False
-    return True
-
-def free_slots_for_operator(d: date, durata: int, operator_id: str) -> List[str]:
-    ds = d.strftime("%Y-%m-%d"); all_slots = list_all_slots_for_day(d, durata); return [s for s in all_slots if is_slot_free_for_operator(ds, s, durata, operator_id)]
-
-def day_status_symbol(d: date, durata: int) -> str:
-    ranges = ORARI_SETTIMANA.get(d.weekday(), [])
-    if not ranges: return ""
-    # Usa DB per operatori
-    con = db_conn(); cur = con.cursor()
-    cur.execute("SELECT id FROM operators")
-    operators = cur.fetchall()
-    con.close()
-    for op in operators:
-        if free_slots_for_operator(d, durata, op[0]): return "🟢"
-    return "🔴"
-
 # States
 (ASK_GENDER, ASK_CATEGORY, ASK_SERVICE, ASK_OPERATOR, ASK_MONTH, ASK_DAY, ASK_TIME, ASK_NAME, ASK_PHONE, ASK_NOTES, CONFIRM) = range(11)
 
 # Handlers
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
-    logger.info(f"⭐ START command received from user {user.id if user else 'unknown'}")
-    logger.info(f"DEBUG: update.message exists: {getattr(update, 'message', None) is not None}")
+    logger.info("/start da user %s", user.id if user else "unknown", extra={"event": "start", "user_id": user.id if user else None})
     
     if user: 
         context.user_data["username"] = getattr(user, "username", None)
-        logger.info(f"DEBUG: Username set: {context.user_data.get('username')}")
+    clear_package(context)
     
-    logger.info("DEBUG: Creating keyboard...")
     kb = [[InlineKeyboardButton("👩 Donna", callback_data="gender_Donna"), InlineKeyboardButton("👨 Uomo", callback_data="gender_Uomo")],
           [InlineKeyboardButton("📆 Le mie prenotazioni", callback_data="my_bookings")],
           [InlineKeyboardButton("ℹ️ Help", callback_data="help")]]
     text = "Benvenuto in *PrenotaFacile* — scegli il profilo:"
     
-    logger.info("DEBUG: Attempting to send message...")
     try:
         # Preferisci reply se è un normale messaggio
         if getattr(update, "message", None):
-            logger.info("DEBUG: Sending via reply_text...")
             await update.message.reply_text(text, reply_markup=InlineKeyboardMarkup(kb), parse_mode=ParseMode.MARKDOWN)
-            logger.info("DEBUG: Message sent successfully!")
         else:
             # Fallback robusto: invia al chat_id effettivo (es. se /start arriva in contesti particolari)
-            logger.info("DEBUG: Using fallback send_message...")
+            logger.debug("/start senza message: invio con send_message")
             chat_id = update.effective_chat.id if getattr(update, "effective_chat", None) else (user.id if user else None)
             if chat_id is not None:
                 await context.application.bot.send_message(chat_id=chat_id, text=text, reply_markup=InlineKeyboardMarkup(kb), parse_mode=ParseMode.MARKDOWN)
-                logger.info("DEBUG: Fallback message sent successfully!")
             else:
                 logger.warning("/start: impossibile determinare il chat_id")
     except Exception as e:
         logger.exception("Failed to send /start menu: %s", e)
     
-    logger.info(f"DEBUG: Returning ASK_GENDER state")
     return ASK_GENDER
 
+# Callback del flusso Minimal: tabella prefisso -> handler (vedi dispatch_module)
+MENU_ROUTES = CallbackRouter("minimal")
+
 async def menu_callback_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    q = update.callback_query; await q.answer(); data = q.data
-    logger.info(f"🔵 Router received callback: {data}")
-    if data == "ignore": return
-    if data == "help":
-        await q.edit_message_text("Aiuto: usa /start per ricominciare.\nLegenda: 🟢 giorno con disponibilità · 🔴 giorno pieno · ❌ orario occupato.\nUsa ⬅️ per tornare."); return
-    if data == "my_bookings": await show_my_bookings(update, context, via_callback=True); return
-    if data.startswith("gender_"):
-        gender = data.split("_",1)[1]; context.user_data["gender"] = gender
-        # Usa DB invece di SERVIZI hardcoded
-        con = db_conn(); cur = con.cursor()
-        cur.execute("SELECT DISTINCT category FROM services WHERE gender=? ORDER BY category", (gender,))
-        cats = [row[0] for row in cur.fetchall()]
-        con.close()
-        # Aggiungi emoji alle categorie
-        kb = [[InlineKeyboardButton(category_emoji(cat), callback_data=f"cat_{gender}|{cat}")] for cat in cats]
-        kb.append([InlineKeyboardButton("🏠 Menu", callback_data="home")])
-        gender_emoji = "👩" if gender == "Donna" else "👨"
-        await q.edit_message_text(f"Profilo: {gender_emoji} *{gender}*\nScegli una categoria:", reply_markup=InlineKeyboardMarkup(kb), parse_mode=ParseMode.MARKDOWN); return ASK_CATEGORY
-    if data == "home":
-        kb = [[InlineKeyboardButton("👩 Donna", callback_data="gender_Donna"), InlineKeyboardButton("👨 Uomo", callback_data="gender_Uomo")],
-              [InlineKeyboardButton("📆 Le mie prenotazioni", callback_data="my_bookings")],
-              [InlineKeyboardButton("ℹ️ Help", callback_data="help")]]
-        await q.edit_message_text("Menu principale:", reply_markup=InlineKeyboardMarkup(kb)); return ASK_GENDER
-    if data.startswith("cat_"):
-        # Nuovo formato: cat_Gender|Category
-        if "|" in data:
-            parts = data.split("cat_")[1].split("|", 1)
-            gender = parts[0]
-            cat = parts[1]
-        else:
-            # Fallback per vecchio formato
-            cat = data.split("_",1)[1]
-            gender = context.user_data.get("gender","Donna")
-        
-        context.user_data["category"] = cat
-        context.user_data["gender"] = gender
-        
-        # Usa DB invece di SERVIZI hardcoded
-        con = db_conn(); cur = con.cursor()
-        cur.execute("SELECT code, title, duration_minutes FROM services WHERE gender=? AND category=? ORDER BY title", (gender, cat))
-        items = cur.fetchall()
-        con.close()
-        
-        kb = [[InlineKeyboardButton(f"{row[1]} ({row[2]}m)", callback_data=f"svc_{row[0]}")] for row in items]
-        kb.append([InlineKeyboardButton("⬅️ Indietro", callback_data=f"gender_{gender}")])
-        await q.edit_message_text(f"Categoria: *{category_emoji(cat)}*\nScegli un trattamento:", reply_markup=InlineKeyboardMarkup(kb), parse_mode=ParseMode.MARKDOWN); return ASK_SERVICE
-    if data.startswith("svc_"):
-        code = data.split("_",1)[1]; svc = find_service_by_code(code)
-        if not svc: await q.edit_message_text("Servizio non trovato."); return ASK_SERVICE
-        context.user_data["service"] = svc
-        # Usa DB per operatori
-        con = db_conn(); cur = con.cursor()
-        cur.execute("SELECT id, name FROM operators ORDER BY name")
-        operators = cur.fetchall()
-        con.close()
-        kb = [[InlineKeyboardButton(op[1], callback_data=f"opid_{op[0]}")] for op in operators]
-        gender = context.user_data.get("gender", "")
-        category = context.user_data.get("category", "")
-        if gender and category:
-            kb.append([InlineKeyboardButton("⬅️ Indietro", callback_data=f"cat_{gender}|{category}")])
-        else:
-            kb.append([InlineKeyboardButton("⬅️ Indietro", callback_data="home")])
-        await q.edit_message_text(f"Hai scelto *{svc['nome']}* ({svc['durata']} min)\nSeleziona l'operatrice/operatore:", reply_markup=InlineKeyboardMarkup(kb), parse_mode=ParseMode.MARKDOWN); return ASK_OPERATOR
-    if data.startswith("op_") or data.startswith("opid_"):
-        parts = data.split("_", 1)
-        op_id = parts[1] if len(parts) > 1 else ""
-        logger.info("Operator selected: %s", op_id)
-        context.user_data["operator_id"] = op_id
-        today = date.today()
+    # Un callback per ogni tap: evento campionato (LOG_SAMPLE_EVERY)
+    logger.info("Callback %s", update.callback_query.data, extra=SAMPLED)
+    return await MENU_ROUTES.dispatch(update, context)
+
+@MENU_ROUTES.route("ignore", exact=True)
+async def route_ignore(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    return None
+
+@MENU_ROUTES.route("help", exact=True)
+async def route_help(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.callback_query.edit_message_text("Aiuto: usa /start per ricominciare.\nLegenda: 🟢 giorno con disponibilità · 🔴 giorno pieno · ❌ orario occupato.\nUsa ⬅️ per tornare.")
+
+@MENU_ROUTES.route("my_bookings", exact=True)
+async def route_my_bookings(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await show_my_bookings(update, context, via_callback=True)
+
+@MENU_ROUTES.route("gender_", name="gender")
+async def route_gender(update: Update, context: ContextTypes.DEFAULT_TYPE, gender: str):
+    q = update.callback_query
+    context.user_data["gender"] = gender
+    # Usa DB invece di SERVIZI hardcoded
+    con = db_conn(); cur = con.cursor()
+    cur.execute("SELECT DISTINCT category FROM services WHERE gender=? ORDER BY category", (gender,))
+    cats = [row[0] for row in cur.fetchall()]
+    con.close()
+    # Aggiungi emoji alle categorie
+    kb = [[InlineKeyboardButton(category_emoji(cat), callback_data=f"cat_{gender}|{cat}")] for cat in cats]
+    kb.append([InlineKeyboardButton("🏠 Menu", callback_data="home")])
+    gender_emoji = "👩" if gender == "Donna" else "👨"
+    await q.edit_message_text(f"Profilo: {gender_emoji} *{gender}*\nScegli una categoria:", reply_markup=InlineKeyboardMarkup(kb), parse_mode=ParseMode.MARKDOWN); return ASK_CATEGORY
+
+@MENU_ROUTES.route("home", exact=True)
+async def route_home(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    kb = [[InlineKeyboardButton("👩 Donna", callback_data="gender_Donna"), InlineKeyboardButton("👨 Uomo", callback_data="gender_Uomo")],
+          [InlineKeyboardButton("📆 Le mie prenotazioni", callback_data="my_bookings")],
+          [InlineKeyboardButton("ℹ️ Help", callback_data="help")]]
+    await update.callback_query.edit_message_text("Menu principale:", reply_markup=InlineKeyboardMarkup(kb)); return ASK_GENDER
+
+@MENU_ROUTES.route("cat_", name="category")
+async def route_category(update: Update, context: ContextTypes.DEFAULT_TYPE, payload: str):
+    q = update.callback_query
+    # Nuovo formato: cat_Gender|Category
+    if "|" in payload:
+        gender, cat = payload.split("|", 1)
+    else:
+        # Fallback per vecchio formato
+        cat = payload
+        gender = context.user_data.get("gender","Donna")
+
+    context.user_data["category"] = cat
+    context.user_data["gender"] = gender
+
+    # Usa DB invece di SERVIZI hardcoded
+    con = db_conn(); cur = con.cursor()
+    cur.execute("SELECT code, title, duration_minutes FROM services WHERE gender=? AND category=? ORDER BY title", (gender, cat))
+    items = cur.fetchall()
+    con.close()
+
+    kb = [[InlineKeyboardButton(f"{row[1]} ({row[2]}m)", callback_data=f"svc_{row[0]}")] for row in items]
+    kb.append([InlineKeyboardButton("⬅️ Indietro", callback_data=f"gender_{gender}")])
+    await q.edit_message_text(f"Categoria: *{category_emoji(cat)}*\nScegli un trattamento:", reply_markup=InlineKeyboardMarkup(kb), parse_mode=ParseMode.MARKDOWN); return ASK_SERVICE
+
+@MENU_ROUTES.route("svc_", name="service")
+async def route_service(update: Update, context: ContextTypes.DEFAULT_TYPE, code: str):
+    q = update.callback_query
+    svc = find_service_by_code(code)
+    if not svc: await q.edit_message_text("Servizio non trovato."); return ASK_SERVICE
+    context.user_data["service"] = svc
+    package = context.user_data.get("package")
+    if package:
+        # Pacchetto in corso: il servizio scelto si aggiunge alla sequenza
+        if svc["code"] not in {s["code"] for s in package} and len(package) < PACKAGE_MAX_SERVICES:
+            package.append(svc)
+        return await show_package(q, context)
+    # Usa DB per operatori
+    con = db_conn(); cur = con.cursor()
+    cur.execute("SELECT id, name FROM operators ORDER BY name")
+    operators = cur.fetchall()
+    con.close()
+    kb = [[InlineKeyboardButton("⚡ Prima disponibilità", callback_data="first_available")]]
+    kb += [[InlineKeyboardButton(op[1], callback_data=f"opid_{op[0]}")] for op in operators]
+    kb.append([InlineKeyboardButton("🤝 Indifferente", callback_data=f"opid_{ANY_OPERATOR}")])
+    kb.append([InlineKeyboardButton("➕ Aggiungi un altro trattamento", callback_data="pkg_add")])
+    gender = context.user_data.get("gender", "")
+    category = context.user_data.get("category", "")
+    if gender and category:
+        kb.append([InlineKeyboardButton("⬅️ Indietro", callback_data=f"cat_{gender}|{category}")])
+    else:
+        kb.append([InlineKeyboardButton("⬅️ Indietro", callback_data="home")])
+    await q.edit_message_text(f"Hai scelto *{svc['nome']}* ({svc['durata']} min)\nSeleziona l'operatrice/operatore:", reply_markup=InlineKeyboardMarkup(kb), parse_mode=ParseMode.MARKDOWN); return ASK_OPERATOR
+
+@MENU_ROUTES.route("first_available", exact=True)
+async def route_first_available(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Gli slot liberi più vicini tra tutte le operatrici, in un solo messaggio."""
+    q = update.callback_query
+    svc = context.user_data.get("service")
+    if not svc:
+        await q.edit_message_text("Sessione scaduta. Premi /start")
+        return ConversationHandler.END
+    slots = await asyncio.to_thread(first_available_slots, svc["durata"])
+    back = [InlineKeyboardButton("⬅️ Scegli l'operatrice", callback_data=f"svc_{svc['code']}")]
+    if not slots:
+        await q.edit_message_text(
+            f"Nessuno slot libero per *{svc['nome']}* nei prossimi {FIRST_AVAILABLE_DAYS} giorni.",
+            reply_markup=InlineKeyboardMarkup([back]), parse_mode=ParseMode.MARKDOWN,
+        )
+        return ASK_OPERATOR
+    kb = [
+        [InlineKeyboardButton(
+            f"{ITALIAN_WEEKDAYS_SHORT[d.weekday()]} {d.strftime('%d/%m')} {t} · {operator_name(op_id)}",
+            callback_data=f"fa_{d.isoformat()}_{t}_{op_id}",
+        )]
+        for d, t, op_id in slots
+    ]
+    kb.append(back)
+    await q.edit_message_text(
+        f"⚡ Prime disponibilità per *{svc['nome']}* ({svc['durata']} min):",
+        reply_markup=InlineKeyboardMarkup(kb), parse_mode=ParseMode.MARKDOWN,
+    )
+    return ASK_TIME
+
+@MENU_ROUTES.route("fa_", parse=fields(str, str, str), name="first_available_pick")
+async def route_first_available_pick(update: Update, context: ContextTypes.DEFAULT_TYPE, date_str: str, time_str: str, op_id: str):
+    # Stessi dati del percorso operatrice -> giorno -> orario; la conferma ricontrolla lo slot
+    drop_package_choice(context)
+    context.user_data["operator_id"] = op_id
+    context.user_data["date"] = date_str
+    return await route_time(update, context, time_str)
+
+# Pacchetti: più trattamenti uno dopo l'altro nella stessa visita
+async def show_package(q, context):
+    package = context.user_data.get("package") or []
+    total = sum(int(s["durata"]) for s in package)
+    lines = "\n".join(f"{i}. {s['nome']} ({s['durata']} min)" for i, s in enumerate(package, 1))
+    kb = []
+    if len(package) < PACKAGE_MAX_SERVICES:
+        kb.append([InlineKeyboardButton("➕ Aggiungi un trattamento", callback_data="pkg_add")])
+    if len(package) > 1:
+        kb.append([InlineKeyboardButton("🔎 Cerca orari consecutivi", callback_data="pkg_search")])
+    kb.append([InlineKeyboardButton("🗑️ Annulla pacchetto", callback_data="pkg_clear")])
+    await q.edit_message_text(
+        f"📦 *Pacchetto* ({total} min in tutto):\n{lines}\n\nI trattamenti verranno prenotati uno dopo l'altro, senza attese.",
+        reply_markup=InlineKeyboardMarkup(kb), parse_mode=ParseMode.MARKDOWN,
+    )
+    return ASK_SERVICE
+
+@MENU_ROUTES.route("pkg_add", exact=True)
+async def route_package_add(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    package = context.user_data.setdefault("package", [])
+    svc = context.user_data.get("service")
+    if not package and svc:
+        package.append(svc)
+    if len(package) >= PACKAGE_MAX_SERVICES:
+        return await show_package(update.callback_query, context)
+    return await route_gender(update, context, context.user_data.get("gender", "Donna"))
+
+def clear_package(context) -> None:
+    for key in ("package", "package_options", "package_choice"):
+        context.user_data.pop(key, None)
+
+def drop_package_choice(context) -> None:
+    """Percorso a slot singolo: la sequenza del pacchetto scelta prima non vale più (il pacchetto resta)."""
+    for key in ("package_options", "package_choice"):
+        context.user_data.pop(key, None)
+
+def current_package_choice(context):
+    """``package_choice`` solo se data e ora della sessione sono ancora quelle della sequenza.
+
+    Un tocco su una tastiera precedente (calendario, orari) cambia data o ora: la scelta
+    del pacchetto viene scartata e si prosegue con lo slot singolo appena scelto.
+    """
+    choice = context.user_data.get("package_choice")
+    if not choice:
+        return None
+    date_str, items = choice
+    if context.user_data.get("date") != date_str or not items or context.user_data.get("time") != items[0][1]:
+        drop_package_choice(context)
+        return None
+    return choice
+
+@MENU_ROUTES.route("pkg_clear", exact=True)
+async def route_package_clear(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    clear_package(context)
+    return await route_home(update, context)
+
+@MENU_ROUTES.route("pkg_search", exact=True)
+async def route_package_search(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    q = update.callback_query
+    package = context.user_data.get("package")
+    if not package:
+        await q.edit_message_text("Sessione scaduta. Premi /start")
+        return ConversationHandler.END
+    options = await asyncio.to_thread(first_package_slots, package)
+    back = [InlineKeyboardButton("⬅️ Pacchetto", callback_data="pkg_show")]
+    if not options:
+        await q.edit_message_text(
+            f"Nessuna sequenza libera per il pacchetto nei prossimi {FIRST_AVAILABLE_DAYS} giorni.",
+            reply_markup=InlineKeyboardMarkup([back]),
+        )
+        return ASK_SERVICE
+    # Nel callback solo l'indice: la sequenza completa supera i 64 byte di callback_data
+    context.user_data["package_options"] = [[d.isoformat(), items] for d, items in options]
+    names = {op_id: operator_name(op_id) for op_id in {op for _, items in options for _, _, op in items}}
+    kb = []
+    for i, (d, items) in enumerate(options):
+        end = min_to_hhmm(hhmm_to_min(items[-1][1]) + int(package[-1]["durata"]))
+        ops = " + ".join(dict.fromkeys(names[op] for _, _, op in items))
+        kb.append([InlineKeyboardButton(
+            f"{ITALIAN_WEEKDAYS_SHORT[d.weekday()]} {d.strftime('%d/%m')} {items[0][1]}–{end} · {ops}",
+            callback_data=f"pkgopt_{i}",
+        )])
+    kb.append(back)
+    await q.edit_message_text("📦 Prime sequenze disponibili per il pacchetto:", reply_markup=InlineKeyboardMarkup(kb))
+    return ASK_TIME
+
+@MENU_ROUTES.route("pkg_show", exact=True)
+async def route_package_show(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    return await show_package(update.callback_query, context)
+
+@MENU_ROUTES.route("pkgopt_", parse=fields(int), name="package_option")
+async def route_package_option(update: Update, context: ContextTypes.DEFAULT_TYPE, index: int):
+    options = context.user_data.get("package_options") or []
+    if not 0 <= index < len(options):
+        await update.callback_query.edit_message_text("Sessione scaduta. Premi /start")
+        return ConversationHandler.END
+    date_str, items = options[index]
+    context.user_data["package_choice"] = [date_str, items]
+    # Primo trattamento nei campi usuali: riepilogo e controlli di sessione restano validi
+    context.user_data["operator_id"] = items[0][2]
+    context.user_data["date"] = date_str
+    return await route_time(update, context, items[0][1])
+
+# "op_" è il formato storico, i bottoni attuali usano "opid_"
+@MENU_ROUTES.route("opid_", "op_", name="operator")
+async def route_operator(update: Update, context: ContextTypes.DEFAULT_TYPE, op_id: str):
+    q = update.callback_query
+    logger.info("Operator selected: %s", op_id)
+    drop_package_choice(context)
+    context.user_data["operator_id"] = op_id
+    today = date.today()
+    try:
+        await show_calendar_month(q, context, today.year, today.month)
+    except Exception as e:
+        logger.exception("Errore in show_calendar_month: %s", e)
         try:
-            await show_calendar_month(q, context, today.year, today.month)
-        except Exception as e:
-            logger.exception("Errore in show_calendar_month: %s", e)
-            try:
-                await q.edit_message_text("Errore nel mostrare il calendario. Premi /start e riprova.")
-            except Exception:
-                pass
-        return ASK_MONTH
-    if data.startswith("cal_"):
-        parts = data.split("_")
-        if len(parts) >= 3:
-            year = int(parts[1])
-            month = int(parts[2])
-            # Il calcolo avanti/indietro è già fatto nei pulsanti, basta mostrare il calendario
-            await show_calendar_month(q, context, year, month)
-            return ASK_MONTH
-    if data.startswith("pickmonths_"):
-        parts = data.split("_")
-        if len(parts) >= 3:
-            year = int(parts[1]); month = int(parts[2]); await show_month_picker(q, context, year, month)
-        else:
-            year = int(parts[1]) if len(parts)>1 else date.today().year; await show_month_picker(q, context, year, 1)
+            await q.edit_message_text("Errore nel mostrare il calendario. Premi /start e riprova.")
+        except Exception:
+            pass
+    return ASK_MONTH
+
+@MENU_ROUTES.route("cal_", parse=fields(int, int), name="calendar")
+async def route_calendar(update: Update, context: ContextTypes.DEFAULT_TYPE, year: int, month: int):
+    # Il calcolo avanti/indietro è già fatto nei pulsanti, basta mostrare il calendario
+    if await NAVIGATION.settle(update.callback_query):
+        await show_calendar_month(update.callback_query, context, year, month)
+    return ASK_MONTH
+
+@MENU_ROUTES.route("pickmonths_", name="month_picker")
+async def route_month_picker(update: Update, context: ContextTypes.DEFAULT_TYPE, payload: str):
+    if not await NAVIGATION.settle(update.callback_query):
         return ASK_MONTH
-    if data.startswith("day_"):
-        date_str = data.split("_", 1)[1]
-        context.user_data["date"] = date_str
-        svc = context.user_data.get("service")
-        op_id = context.user_data.get("operator_id")
-        if not svc or not op_id:
-            await q.edit_message_text("Sessione scaduta. Premi /start")
-            return ConversationHandler.END
-        d = datetime.strptime(date_str, "%Y-%m-%d").date()
-        free = free_slots_for_operator(d, svc["durata"], op_id)
-        if free:
-            kb = [[InlineKeyboardButton(t, callback_data=f"time_{t}")] for t in free]
-            kb.append([InlineKeyboardButton("⬅️ Indietro", callback_data=f"cal_{d.year}_{d.month}")])
-            # Mantieni i nomi dei giorni in italiano
-            weekday_it = ITALIAN_WEEKDAYS_FULL[d.weekday()]
-            await q.edit_message_text(
-                f"Data: *{weekday_it} {d.strftime('%d/%m/%Y')}*\nScegli un orario disponibile:",
-                reply_markup=InlineKeyboardMarkup(kb),
-                parse_mode=ParseMode.MARKDOWN,
-            )
-            return ASK_TIME
-        else:
-            # Giorno pieno -> proponi la lista d'attesa
-            kb = [
-                [InlineKeyboardButton("🕰️ Entra in lista d'attesa", callback_data="waitlist_join")],
-                [InlineKeyboardButton("⬅️ Indietro", callback_data=f"cal_{d.year}_{d.month}")],
-            ]
-            await q.edit_message_text(
-                "🔴 Questo giorno è pieno per l'operatrice scelta.\nVuoi entrare in lista d'attesa?",
-                reply_markup=InlineKeyboardMarkup(kb),
-            )
-            return ASK_DAY
-    if data == "waitlist_join":
-        user = q.from_user
-        date_str = context.user_data.get("date")
-        svc = context.user_data.get("service")
-        if not date_str or not svc:
-            await q.edit_message_text("Sessione scaduta. Premi /start")
-            return ConversationHandler.END
-        pos = await join_waitlist(user.id, date_str, svc["code"])  # helper
-        davanti = max(0, (pos - 1))
-        msg = (
-            "✅ Inserito in lista d'attesa.\n"
-            f"📍 Posizione stimata: {pos} (persone davanti: {davanti}).\n"
-            "Ti notificheremo quando si libera uno slot."
+    parts = payload.split("_")
+    if len(parts) >= 2:
+        year = int(parts[0]); month = int(parts[1]); await show_month_picker(update.callback_query, context, year, month)
+    else:
+        year = int(parts[0]) if parts[0] else date.today().year; await show_month_picker(update.callback_query, context, year, 1)
+    return ASK_MONTH
+
+@MENU_ROUTES.route("day_", name="day")
+async def route_day(update: Update, context: ContextTypes.DEFAULT_TYPE, date_str: str):
+    q = update.callback_query
+    drop_package_choice(context)
+    context.user_data["date"] = date_str
+    svc = context.user_data.get("service")
+    op_id = context.user_data.get("operator_id")
+    if not svc or not op_id:
+        await q.edit_message_text("Sessione scaduta. Premi /start")
+        return ConversationHandler.END
+    d = datetime.strptime(date_str, "%Y-%m-%d").date()
+    free = free_slots_any_operator(d, svc["durata"]) if op_id == ANY_OPERATOR else free_slots_for_operator(d, svc["durata"], op_id)
+    if free:
+        kb = [[InlineKeyboardButton(t, callback_data=f"time_{t}")] for t in free]
+        kb.append([InlineKeyboardButton("⬅️ Indietro", callback_data=f"cal_{d.year}_{d.month}")])
+        # Mantieni i nomi dei giorni in italiano
+        weekday_it = ITALIAN_WEEKDAYS_FULL[d.weekday()]
+        await q.edit_message_text(
+            f"Data: *{weekday_it} {d.strftime('%d/%m/%Y')}*\nScegli un orario disponibile:",
+            reply_markup=InlineKeyboardMarkup(kb),
+            parse_mode=ParseMode.MARKDOWN,
         )
-        await q.edit_message_text(msg)
+        return ASK_TIME
+    else:
+        # Giorno pieno -> proponi la lista d'attesa
+        kb = [
+            [InlineKeyboardButton("🕰️ Entra in lista d'attesa", callback_data="waitlist_join")],
+            [InlineKeyboardButton("⬅️ Indietro", callback_data=f"cal_{d.year}_{d.month}")],
+        ]
+        await q.edit_message_text(
+            "🔴 Questo giorno è pieno per l'operatrice scelta.\nVuoi entrare in lista d'attesa?",
+            reply_markup=InlineKeyboardMarkup(kb),
+        )
+        return ASK_DAY
+
+@MENU_ROUTES.route("waitlist_join", exact=True)
+async def route_waitlist_join(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    q = update.callback_query
+    user = q.from_user
+    date_str = context.user_data.get("date")
+    svc = context.user_data.get("service")
+    if not date_str or not svc:
+        await q.edit_message_text("Sessione scaduta. Premi /start")
         return ConversationHandler.END
-    if data.startswith("time_"):
-        time_str = data.split("_",1)[1]; context.user_data["time"] = time_str
-        await q.edit_message_text("Perfetto. Inserisci *Nome e Cognome*:", parse_mode=ParseMode.MARKDOWN); return ASK_NAME
-    if data.startswith("acsl_") or data.startswith("accept_slot_"):
-        # Nuovo formato compatto: acsl_YYYYMMDD|HH:MM|op_compact|svc_compact
-        waitlist_entry_id = None
-        if data.startswith("acsl_"):
-            # Recupera dati completi da bot_data
-            if hasattr(context, 'bot_data') and data in context.bot_data:
-                slot_data = context.bot_data[data]
-                date_str = slot_data['date']
-                time_str = slot_data['time']
-                op_id = slot_data['op_id']
-                svc_code = slot_data['svc_code']
-                waitlist_entry_id = slot_data.get('waitlist_id')
-                # Rimuovi i dati usati per evitare riutilizzi successivi
-                try:
-                    context.bot_data.pop(data, None)
-                except Exception:
-                    pass
-            else:
-                await q.edit_message_text("⚠️ Slot scaduto o non disponibile."); return
-        else:
-            # Vecchio formato: accept_slot_date|time|op_id|svc_code
-            payload = data[len("accept_slot_"):]
-            # Nuovo formato con separatore sicuro '|': date|time|op_id|svc_code
-            if "|" in payload:
-                try:
-                    date_str, time_str, op_id, svc_code = payload.split("|", 3)
-                except Exception:
-                    await q.edit_message_text("Dati slot non validi."); return
-            else:
-                # Back-compat: vecchio formato con '_' che collide con i campi
-                try:
-                    if len(payload) < 17 or payload[10] != '_' or payload[16] != '_':
-                        raise ValueError("payload legacy malformato")
-                    date_str = payload[:10]
-                    time_str = payload[11:16]
-                    rest = payload[17:]
-                    # rest = f"{op_id}_{svc_code}" ma entrambi possono contenere '_'
-                    # Ricava svc_code facendo match con i codici esistenti (scegli il più lungo)
-                    svc_code = None
-                    op_id = None
-                    svc_codes = []
-                    for _, cats in SERVIZI.items():
-                        for cat_items in cats.values():
-                            for s in cat_items:
-                                svc_codes.append(s["code"])
-                    best = None
-                    for code in svc_codes:
-                        if rest.endswith(code) and (best is None or len(code) > len(best)):
-                            best = code
-                    if best is None:
-                        raise ValueError("svc_code non riconosciuto nel payload legacy")
-                    svc_code = best
-                    # Rimuovi separatore '_' tra op_id e svc_code se presente
-                    op_part_len = len(rest) - len(svc_code)
-                    op_id = rest[:max(0, op_part_len - 1)] if op_part_len > 0 and rest[op_part_len-1] == '_' else rest[:op_part_len]
-                    if not op_id:
-                        raise ValueError("op_id vuoto nel payload legacy")
-                except Exception:
-                    await q.edit_message_text("Dati slot non validi."); return
-        svc = find_service_by_code(svc_code)
-        if not svc: await q.edit_message_text("Servizio non valido."); return
-        if is_slot_free_for_operator(date_str, time_str, svc["durata"], op_id):
-            await finalize_booking_from_accept(q.from_user.id, context, svc, date_str, time_str, op_id, waitlist_entry_id=waitlist_entry_id)
-            await q.edit_message_text("✅ Slot assegnato a te! Controlla le tue prenotazioni.")
-        else:
-            await q.edit_message_text("❌ Lo slot è già stato preso da un altro.")
-        return
-    if data.startswith("cancel_"):
-        logger.info(f"🔴 Cancel callback detected: {data}")
-        booking_id = int(data.split("_",1)[1]); await cancel_booking(update, context, booking_id); return
-    if data.startswith("remove_waitlist_"):
-        waitlist_id = int(data.split("_",2)[2])
-        logger.info(f"🗑️ Removing waitlist entry: {waitlist_id}")
-        con = db_conn(); cur = con.cursor()
-        cur.execute("DELETE FROM waitlist WHERE id=? AND user_id=?", (waitlist_id, q.from_user.id))
-        deleted = cur.rowcount
-        con.commit(); con.close()
-        if deleted > 0:
-            await q.edit_message_text("✅ Rimosso dalla lista d'attesa.")
-        else:
-            await q.edit_message_text("❌ Entry non trovata.")
-        return
+    pos = await join_waitlist(user.id, date_str, svc["code"])  # helper
+    davanti = max(0, (pos - 1))
+    msg = (
+        "✅ Inserito in lista d'attesa.\n"
+        f"📍 Posizione stimata: {pos} (persone davanti: {davanti}).\n"
+        "Ti notificheremo quando si libera uno slot."
+    )
+    await q.edit_message_text(msg)
+    return ConversationHandler.END
+
+@MENU_ROUTES.route("time_", name="time")
+async def route_time(update: Update, context: ContextTypes.DEFAULT_TYPE, time_str: str):
+    context.user_data["time"] = time_str
+    await update.callback_query.edit_message_text("Perfetto. Inserisci *Nome e Cognome*:", parse_mode=ParseMode.MARKDOWN); return ASK_NAME
+
+def parse_legacy_accept_slot(payload: str) -> tuple[str, str, str, str]:
+    """Payload di accept_slot_: (date, time, op_id, svc_code). Solleva ValueError se non valido."""
+    # Nuovo formato con separatore sicuro '|': date|time|op_id|svc_code
+    if "|" in payload:
+        date_str, time_str, op_id, svc_code = payload.split("|", 3)
+        return date_str, time_str, op_id, svc_code
+    # Back-compat: vecchio formato con '_' che collide con i campi
+    if len(payload) < 17 or payload[10] != '_' or payload[16] != '_':
+        raise ValueError("payload legacy malformato")
+    date_str = payload[:10]
+    time_str = payload[11:16]
+    rest = payload[17:]
+    # rest = f"{op_id}_{svc_code}" ma entrambi possono contenere '_'
+    # Ricava svc_code facendo match con i codici esistenti (scegli il più lungo)
+    svc_codes = []
+    for _, cats in SERVIZI.items():
+        for cat_items in cats.values():
+            for s in cat_items:
+                svc_codes.append(s["code"])
+    best = None
+    for code in svc_codes:
+        if rest.endswith(code) and (best is None or len(code) > len(best)):
+            best = code
+    if best is None:
+        raise ValueError("svc_code non riconosciuto nel payload legacy")
+    svc_code = best
+    # Rimuovi separatore '_' tra op_id e svc_code se presente
+    op_part_len = len(rest) - len(svc_code)
+    op_id = rest[:max(0, op_part_len - 1)] if op_part_len > 0 and rest[op_part_len-1] == '_' else rest[:op_part_len]
+    if not op_id:
+        raise ValueError("op_id vuoto nel payload legacy")
+    return date_str, time_str, op_id, svc_code
+
+async def accept_freed_slot(update: Update, context: ContextTypes.DEFAULT_TYPE, date_str: str, time_str: str, op_id: str, svc_code: str, waitlist_entry_id=None):
+    q = update.callback_query
+    svc = find_service_by_code(svc_code)
+    if not svc: await q.edit_message_text("Servizio non valido."); return
+    if is_slot_free_for_operator(date_str, time_str, svc["durata"], op_id) and \
+            await finalize_booking_from_accept(q.from_user.id, context, svc, date_str, time_str, op_id, waitlist_entry_id=waitlist_entry_id) is not None:
+        await q.edit_message_text("✅ Slot assegnato a te! Controlla le tue prenotazioni.")
+    else:
+        await q.edit_message_text("❌ Lo slot è già stato preso da un altro.")
+
+@MENU_ROUTES.route("acsl_", name="accept_slot", dedup=True)
+async def route_accept_slot(update: Update, context: ContextTypes.DEFAULT_TYPE, payload: str):
+    # Formato compatto: acsl_<waitlist_id>, dati completi in slot_offers (condivisa tra i worker).
+    # L'offerta viene consumata qui, così non si può riusare; bot_data solo per bottoni
+    # inviati prima che le offerte passassero al DB
+    slot_data = await asyncio.to_thread(take_slot_offer, int(payload)) if payload.isdigit() else None
+    slot_data = slot_data or context.bot_data.pop(f"acsl_{payload}", None)
+    if not slot_data:
+        await update.callback_query.edit_message_text("⚠️ Slot scaduto o non disponibile."); return
+    await accept_freed_slot(update, context, slot_data['date'], slot_data['time'], slot_data['op_id'], slot_data['svc_code'], waitlist_entry_id=slot_data.get('waitlist_id'))
+
+@MENU_ROUTES.route("accept_slot_", name="accept_slot_legacy", dedup=True)
+async def route_accept_slot_legacy(update: Update, context: ContextTypes.DEFAULT_TYPE, payload: str):
+    # Vecchio formato: accept_slot_date|time|op_id|svc_code
+    try:
+        date_str, time_str, op_id, svc_code = parse_legacy_accept_slot(payload)
+    except ValueError:
+        await update.callback_query.edit_message_text("Dati slot non validi."); return
+    await accept_freed_slot(update, context, date_str, time_str, op_id, svc_code)
+
+@MENU_ROUTES.route("cancel_", parse=fields(int), name="cancel_booking", dedup=True)
+async def route_cancel_booking(update: Update, context: ContextTypes.DEFAULT_TYPE, booking_id: int):
+    logger.info("Disdetta richiesta: booking=%s", booking_id)
+    await cancel_booking(update, context, booking_id)
+
+@MENU_ROUTES.route("remove_waitlist_", parse=fields(int), name="remove_waitlist", dedup=True)
+async def route_remove_waitlist(update: Update, context: ContextTypes.DEFAULT_TYPE, waitlist_id: int):
+    q = update.callback_query
+    logger.info("Rimozione dalla waitlist: id=%s", waitlist_id)
+    con = db_conn(); cur = con.cursor()
+    cur.execute("DELETE FROM waitlist WHERE id=? AND user_id=?", (waitlist_id, q.from_user.id))
+    deleted = cur.rowcount
+    con.commit(); con.close()
+    if deleted > 0:
+        await q.edit_message_text("✅ Rimosso dalla lista d'attesa.")
+    else:
+        await q.edit_message_text("❌ Entry non trovata.")
+
+@MENU_ROUTES.fallback
+async def route_menu_fallback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
-        await q.edit_message_text("Sessione aggiornata. Usa /start per ripartire.")
+        await update.callback_query.edit_message_text("Sessione aggiornata. Usa /start per ripartire.")
     except Exception:
         pass
 
 # UI calendario
 async def show_calendar_month(q, context, year, month):
+    svc = context.user_data.get("service"); op_id = context.user_data.get("operator_id")
+    # Calcolo fuori dall'event loop: intanto possono arrivare tocchi più recenti
+    text, markup = await asyncio.to_thread(calendar_month_view, year, month, op_id, svc)
+    if NAVIGATION.superseded(q):
+        return
+    await edit_if_changed(q, text, reply_markup=markup, parse_mode=ParseMode.MARKDOWN)
+    # Il prossimo tocco è probabilmente il mese dopo: precalcolo in background
+    PREFETCH.after_render(calendar_month_view, year, month, op_id, svc)
+
+def calendar_month_view(year: int, month: int, op_id, svc, prefetch: bool = False) -> tuple[str, InlineKeyboardMarkup]:
+    """Testo e tastiera del mese dalla cache (calendar_module), ricalcolati se la disponibilità è cambiata."""
+    durata = svc["durata"] if svc else 30
+    version = availability_version()
+    key = None if version is None else ("minimal", op_id, svc.get("code") if svc else None, durata, year, month, date.today(), version)
+    return cached_render(key, lambda: render_calendar_month(year, month, op_id, svc), prefetch)
+
+def render_calendar_month(year: int, month: int, op_id, svc) -> tuple[str, InlineKeyboardMarkup]:
     calendar.setfirstweekday(calendar.MONDAY)
-    svc = context.user_data.get("service"); durata = svc["durata"] if svc else 30
+    durata = svc["durata"] if svc else 30
     m = calendar.monthcalendar(year, month); kb = []
     header = [InlineKeyboardButton(d, callback_data="ignore") for d in ITALIAN_WEEKDAYS_SHORT]; kb.append(header)
     today = date.today()
@@ -987,9 +652,11 @@ async def show_calendar_month(q, context, year, month):
                 row.append(InlineKeyboardButton(" ", callback_data="ignore"))
             else:
                 ddate = date(year, month, day)
-                wd = ddate.weekday()
-                ranges = ORARI_SETTIMANA.get(wd, [])
-                is_closed = not ranges
+                # Chiuso se l'operatrice scelta (o il centro) non lavora quel giorno
+                if op_id == ANY_OPERATOR:
+                    is_closed = not any(operator_day_ranges(o, ddate) for o in operator_ids())
+                else:
+                    is_closed = not operator_day_ranges(op_id, ddate)
                 is_today = (ddate == today)
                 is_past = ddate < today
                 symbol = day_status_symbol(ddate, durata) if not is_closed and not is_past else ""
@@ -1020,16 +687,41 @@ async def show_calendar_month(q, context, year, month):
         pass
     legend_text = "Legenda: 🟢 disponibilità · 🔴 giorno pieno · ❌ orario occupato"
     month_name_it = ITALIAN_MONTHS[month-1]
-    await q.edit_message_text(f"*{month_name_it} {year}*\n\n{legend_text}", reply_markup=InlineKeyboardMarkup(kb), parse_mode=ParseMode.MARKDOWN)
+    return f"*{month_name_it} {year}*\n\n{legend_text}", InlineKeyboardMarkup(kb)
 
 async def show_month_picker(q, context, year: int, start_month: int | None = None):
     today = date.today()
     if start_month is None: year, start_month = today.year, today.month
+    svc = context.user_data.get("service"); op_id = context.user_data.get("operator_id")
+    text, markup = await asyncio.to_thread(month_picker_view, year, start_month, op_id, svc)
+    if NAVIGATION.superseded(q):
+        return
+    await edit_if_changed(q, text, reply_markup=markup, parse_mode=ParseMode.MARKDOWN)
+
+def month_picker_view(year: int, start_month: int, op_id, svc) -> tuple[str, InlineKeyboardMarkup]:
+    """Come calendar_month_view per la griglia dei 12 mesi (con i giorni liberi per mese)."""
+    version = availability_version()
+    key = None if version is None or not svc or not op_id else (
+        "picker", op_id, svc.get("code"), svc["durata"], year, start_month, date.today(), version)
+    return cached_render(key, lambda: render_month_picker(year, start_month, op_id, svc))
+
+def render_month_picker(year: int, start_month: int, op_id, svc) -> tuple[str, InlineKeyboardMarkup]:
     def add_months(y: int, m: int, delta: int) -> tuple[int, int]:
         nm = m + delta; y += (nm - 1) // 12; m2 = ((nm - 1) % 12) + 1; return y, m2
+    # Giorni liberi per mese per l'operatrice/servizio scelti: una query per tutti i 12 mesi
+    availability = {}
+    if svc and op_id:
+        ops = operator_ids() if op_id == ANY_OPERATOR else [op_id]
+        availability = month_availability(ops, svc["durata"], year, start_month)
     kb = []; row = []
     for offset in range(12):
         y, m = add_months(year, start_month, offset); label = f"{ITALIAN_MONTHS[m-1]} {y}"
+        if (y, m) in availability:
+            free_days, working_days = availability[(y, m)]
+            if working_days:
+                label = f"{ITALIAN_MONTHS[m-1][:3]} {y} {'🟢' if free_days else '🔴'}{free_days or ''}"
+            else:
+                label = f"{ITALIAN_MONTHS[m-1][:3]} {y} —"
         row.append(InlineKeyboardButton(label, callback_data=f"cal_{y}_{m}"))
         if len(row) == 3: kb.append(row); row = []
     if row: kb.append(row)
@@ -1040,7 +732,8 @@ async def show_month_picker(q, context, year: int, start_month: int | None = Non
         InlineKeyboardButton("12 mesi succ. ➡️", callback_data=f"pickmonths_{next_y}_{next_m}")
     ])
     header = f"Seleziona mese - da {ITALIAN_MONTHS[start_month-1]} {year}"
-    await q.edit_message_text(f"*{header}*", reply_markup=InlineKeyboardMarkup(kb), parse_mode=ParseMode.MARKDOWN)
+    legend = "\n🟢N giorni con disponibilità · 🔴 mese pieno · — chiuso o passato" if availability else ""
+    return f"*{header}*{legend}", InlineKeyboardMarkup(kb)
 
 # Flusso dati
 async def ask_name(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1073,8 +766,24 @@ async def ask_notes(update: Update, context: ContextTypes.DEFAULT_TYPE):
         prezzo_txt = f"€{prezzo_val:.2f}"
     else:
         prezzo_txt = "—"
+    choice = current_package_choice(context)
+    if choice:
+        package = {s["code"]: s for s in context.user_data.get("package") or []}
+        rows = "\n".join(
+            f"  - {t} *{package[code]['nome']}* ({package[code]['durata']} min) con {operator_name(op)}"
+            for code, t, op in choice[1] if code in package
+        )
+        total = sum(normalize_price(s.get("prezzo")) for s in package.values())
+        text = (f"Riepilogo pacchetto:\n{rows}\n"
+                f"• Totale: *{format_price_eur(total)}*\n"
+                f"• Data: *{datetime.strptime(date_str, '%Y-%m-%d').strftime('%d/%m/%Y')}*\n"
+                f"• Nome: *{context.user_data.get('name')}*\n"
+                f"• Tel: *{context.user_data.get('phone') or '—'}*\n"
+                f"• Note: *{notes or '—'}*\n\nConfermi tutti i trattamenti?")
+        kb = [[InlineKeyboardButton("✅ Conferma", callback_data="confirm_yes"), InlineKeyboardButton("❌ Annulla", callback_data="confirm_no")]]
+        await update.message.reply_text(text, reply_markup=InlineKeyboardMarkup(kb), parse_mode=ParseMode.MARKDOWN); return CONFIRM
     text = (f"Riepilogo:\n• Servizio: *{svc['nome']}* ({svc['durata']} min) - {prezzo_txt}\n"
-            f"• Operatrice: *{operator_name(op_id)}*\n"
+            f"• Operatrice: *{'la prima libera (assegnata alla conferma)' if op_id == ANY_OPERATOR else operator_name(op_id)}*\n"
             f"• Data: *{datetime.strptime(date_str, '%Y-%m-%d').strftime('%d/%m/%Y')}*\n"
             f"• Ora: *{time_str}*\n"
             f"• Nome: *{context.user_data.get('name')}*\n"
@@ -1084,6 +793,7 @@ async def ask_notes(update: Update, context: ContextTypes.DEFAULT_TYPE):
     kb = [[InlineKeyboardButton("✅ Conferma", callback_data="confirm_yes"), InlineKeyboardButton("❌ Annulla", callback_data="confirm_no")]]
     await update.message.reply_text(text, reply_markup=InlineKeyboardMarkup(kb), parse_mode=ParseMode.MARKDOWN); return CONFIRM
 
+@deduplicated("minimal", "confirm")
 async def confirm_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query
     logger.debug("[MINIMAL] confirm_router triggered data=%s user_keys=%s", getattr(q, "data", None), sorted(context.user_data.keys()))
@@ -1102,22 +812,22 @@ async def confirm_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
             try: await q.edit_message_text("Sessione scaduta. /start")
             except Exception: pass
             return ConversationHandler.END
-        if not is_slot_free_for_operator(date_str, time_str, svc["durata"], op_id):
-            d = datetime.strptime(date_str, "%Y-%m-%d").date(); free = free_slots_for_operator(d, svc["durata"], op_id)
-            if free:
-                kb = [[InlineKeyboardButton(t, callback_data=f"time_{t}")] for t in free]; kb.append([InlineKeyboardButton("⬅️ Indietro", callback_data=f"cal_{d.year}_{d.month}")])
-                weekday_it = ITALIAN_WEEKDAYS_FULL[d.weekday()]
-                await q.edit_message_text(
-                    f"❌ Ops! Lo slot selezionato è appena stato preso.\n"
-                    f"Data: *{weekday_it} {d.strftime('%d/%m/%Y')}*\n"
-                    f"Scegli un altro orario disponibile:",
-                    reply_markup=InlineKeyboardMarkup(kb), parse_mode=ParseMode.MARKDOWN,
-                )
-                return ASK_TIME
-            else:
-                await q.edit_message_text("❌ Ops! Non ci sono più orari disponibili in questo giorno per l'operatrice scelta.")
-                return ConversationHandler.END
-        await finalize_booking(q, context, svc, date_str, time_str, op_id, from_waitlist=False)
+        if current_package_choice(context):
+            return await confirm_package(q, context)
+        assignment = None
+        if op_id == ANY_OPERATOR:
+            # Sceglie ora, sui dati più recenti, l'operatrice libera meno carica
+            chosen, candidates = assign_least_loaded(date_str, time_str, svc["durata"])
+            if chosen is not None:
+                assignment = (chosen, candidates); op_id = chosen
+        if op_id == ANY_OPERATOR or not is_slot_free_for_operator(date_str, time_str, svc["durata"], op_id):
+            return await slot_taken_reply(q, svc, date_str, op_id)
+        booking_id = await finalize_booking(q, context, svc, date_str, time_str, op_id, from_waitlist=False)
+        if booking_id is None:
+            # Preso da un'altra chat tra il controllo e il salvataggio (ricontrollato in transazione)
+            return await slot_taken_reply(q, svc, date_str, context.user_data.get("operator_id"))
+        if assignment is not None:
+            await asyncio.to_thread(record_assignment, booking_id, q.from_user.id, svc["code"], date_str, time_str, *assignment)
         
         # Usa il modulo UX per messaggio di conferma migliorato
         booking_info = {
@@ -1132,12 +842,56 @@ async def confirm_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await send_confirm(update_for_ux, context, booking_info, via_callback=True)
         return ConversationHandler.END
 
+async def slot_taken_reply(q, svc, date_str: str, op_id: str):
+    """Lo slot scelto non è più libero: propone gli altri orari del giorno (stato ASK_TIME) o chiude."""
+    d = datetime.strptime(date_str, "%Y-%m-%d").date()
+    free = free_slots_any_operator(d, svc["durata"]) if op_id == ANY_OPERATOR else free_slots_for_operator(d, svc["durata"], op_id)
+    if free:
+        kb = [[InlineKeyboardButton(t, callback_data=f"time_{t}")] for t in free]; kb.append([InlineKeyboardButton("⬅️ Indietro", callback_data=f"cal_{d.year}_{d.month}")])
+        weekday_it = ITALIAN_WEEKDAYS_FULL[d.weekday()]
+        await q.edit_message_text(
+            f"❌ Ops! Lo slot selezionato è appena stato preso.\n"
+            f"Data: *{weekday_it} {d.strftime('%d/%m/%Y')}*\n"
+            f"Scegli un altro orario disponibile:",
+            reply_markup=InlineKeyboardMarkup(kb), parse_mode=ParseMode.MARKDOWN,
+        )
+        return ASK_TIME
+    await q.edit_message_text("❌ Ops! Non ci sono più orari disponibili in questo giorno per l'operatrice scelta.")
+    return ConversationHandler.END
+
+async def confirm_package(q, context: ContextTypes.DEFAULT_TYPE):
+    """Conferma del pacchetto: tutte le prenotazioni in una transazione, o nessuna."""
+    date_str, items = context.user_data["package_choice"]
+    package = {s["code"]: s for s in context.user_data.get("package") or []}
+    user = q.from_user
+    username = getattr(user, "username", None) or context.user_data.get("username")
+    client = {k: context.user_data.get(k) for k in ("name", "phone", "notes")}
+    entries = [(package[code], date_str, t, op) for code, t, op in items if code in package]
+    ids = await asyncio.to_thread(book_package, user.id, entries, dict(client, username=username))
+    if ids is None:
+        context.user_data.pop("package_choice", None)
+        kb = [[InlineKeyboardButton("🔎 Cerca di nuovo", callback_data="pkg_search")]]
+        await q.edit_message_text("❌ Ops! Uno degli orari del pacchetto è appena stato preso. Nessun trattamento è stato prenotato.",
+                                  reply_markup=InlineKeyboardMarkup(kb))
+        return ASK_TIME
+    logger.info("Package saved: ids=%s user=%s date=%s", ids, user.id, date_str,
+                extra={"event": "package_saved", "booking_ids": ids})
+    for svc, d_str, t, _ in entries:
+        schedule_booking_reminder(context, user.id, svc["nome"], d_str, t)
+    lines = "\n".join(f"• {t} {svc['nome']} con {operator_name(op)}" for svc, _, t, op in entries)
+    await q.edit_message_text(
+        f"✅ Pacchetto confermato per *{datetime.strptime(date_str, '%Y-%m-%d').strftime('%d/%m/%Y')}*:\n{lines}",
+        parse_mode=ParseMode.MARKDOWN,
+    )
+    clear_package(context)
+    return ConversationHandler.END
+
 async def show_my_bookings(update_or_cb, context: ContextTypes.DEFAULT_TYPE, via_callback=False):
     user = update_or_cb.callback_query.from_user if via_callback else update_or_cb.message.from_user
     con = db_conn(); cur = con.cursor();
     
     # Prenotazioni confermate
-    cur.execute("SELECT id, service_name, date, time, duration, operator_id, price FROM bookings WHERE user_id=? ORDER BY date, time", (user.id,))
+    cur.execute("SELECT id, service_name, date, time, duration, operator_id, price FROM bookings WHERE user_id=? AND " + ACTIVE_BOOKING_SQL + " ORDER BY date, time", (user.id,))
     bookings = cur.fetchall()
     
     # Lista d'attesa
@@ -1195,8 +949,13 @@ async def admin_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     # Statistiche rapide
     con = db_conn(); cur = con.cursor()
-    cur.execute("SELECT COUNT(*) FROM bookings")
+    # Le disdette (/disdici_periodo) restano in tabella ma non contano
+    cur.execute("SELECT COUNT(*) FROM bookings WHERE " + ACTIVE_BOOKING_SQL)
     tot_book = cur.fetchone()[0]
+    tot_archived = 0
+    if bookings_source(con, None) == "bookings_all":
+        cur.execute("SELECT COUNT(*) FROM bookings_archive WHERE " + ACTIVE_BOOKING_SQL)
+        tot_archived = cur.fetchone()[0]
     cur.execute("SELECT COUNT(*) FROM waitlist")
     tot_wait = cur.fetchone()[0]
     con.close()
@@ -1205,7 +964,8 @@ async def admin_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         [InlineKeyboardButton("📅 Prenotazioni di oggi", callback_data="admin_today")],
     ]
     await update.message.reply_text(
-        f"Pannello Admin\n• Prenotazioni: {tot_book}\n• In lista d'attesa: {tot_wait}",
+        f"Pannello Admin\n• Prenotazioni: {tot_book}" + (f" (+{tot_archived} in archivio)" if tot_archived else "")
+        + f"\n• In lista d'attesa: {tot_wait}",
         reply_markup=InlineKeyboardMarkup(kb),
     )
 
@@ -1225,47 +985,157 @@ async def admin_cb_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     await q.edit_message_text("Comando admin non riconosciuto.")
 
+def parse_bulk_args(args: list[str], valid_ops: set[str]) -> tuple[str, str, list[str] | None]:
+    """Argomenti dei comandi in blocco: dal [al] op_id[,op_id...]|tutte -> (dal, al, operatrici o None)."""
+    args = [a.strip() for a in args if a.strip()]
+    if not args or not _is_iso_date(args[0]):
+        raise ValueError("data iniziale mancante o non valida (YYYY-MM-DD)")
+    date_from = args.pop(0); date_to = date_from
+    if args and _is_iso_date(args[0]):
+        date_to = args.pop(0)
+    if date_to < date_from:
+        raise ValueError("la data finale precede quella iniziale")
+    if len(args) != 1:
+        raise ValueError("indica le operatrici (op_a,op_b) oppure 'tutte'")
+    if args[0].lower() == "tutte":
+        return date_from, date_to, None
+    ops = [o for o in args[0].split(",") if o]
+    unknown = [o for o in ops if o not in valid_ops]
+    if unknown:
+        raise ValueError("operatrice non valida: " + ", ".join(unknown))
+    return date_from, date_to, ops
+
+async def _bulk_bookings_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE, cancel: bool):
+    if not is_admin(update.effective_user.id):
+        await update.message.reply_text("Accesso negato. ✋")
+        return
+    valid_ops = set(operator_ids())
+    try:
+        date_from, date_to, ops = parse_bulk_args(context.args or [], valid_ops)
+    except ValueError as e:
+        usage = "/disdici_periodo" if cancel else "/purge_day"
+        await update.message.reply_text(
+            f"Errore: {e}\nUso: {usage} YYYY-MM-DD [YYYY-MM-DD] op_id[,op_id...]|tutte\n"
+            f"Esempio: {usage} 2025-10-25 2025-10-27 op_sara,op_giulia\nOperatrici: {', '.join(sorted(valid_ops))}"
+        )
+        return
+    touched, freed = await asyncio.to_thread(bulk_update_bookings, date_from, date_to, ops, cancel)
+    # Un solo abbinamento con la lista d'attesa per tutti gli intervalli liberati
+    matches = await asyncio.to_thread(match_waitlist, freed)
+    for d, t, op, code, name, entries in matches:
+        await notify_waitlist(context, d, t, op, code, name, entries=entries)
+    who = "tutte le operatrici" if ops is None else ", ".join(operator_name(o) for o in ops)
+    when = date_from if date_from == date_to else f"{date_from} → {date_to}"
+    logger.info("Operazione in blocco: %s %s prenotazioni (%s liberate) %s %s", "disdette" if cancel else "eliminate",
+                touched, len(freed), when, who, extra={"event": "bulk_bookings", "count": touched, "waitlist_matches": len(matches)})
+    await update.message.reply_text(
+        f"{'Disdette' if cancel else 'Eliminate'} {touched} prenotazioni per {who} ({when}).\n"
+        f"Lista d'attesa: {len(matches)} notifiche avviate."
+    )
+
 async def purge_day_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Comando admin: /purge_day YYYY-MM-DD op_id
+    """Comando admin: /purge_day YYYY-MM-DD [YYYY-MM-DD] op_id[,op_id...]|tutte
 
     Esempio: /purge_day 2025-10-25 op_sara
-    Elimina tutte le prenotazioni di quella giornata per la specifica operatrice.
+    Elimina le prenotazioni del periodo per le operatrici indicate e avvisa la lista d'attesa.
     """
-    uid = update.effective_user.id
-    if not is_admin(uid):
+    await _bulk_bookings_cmd(update, context, cancel=False)
+
+async def cancel_period_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Comando admin: /disdici_periodo YYYY-MM-DD [YYYY-MM-DD] op_id[,op_id...]|tutte
+
+    Come /purge_day ma le prenotazioni restano registrate come disdette (status CANCELLED).
+    """
+    await _bulk_bookings_cmd(update, context, cancel=True)
+
+def _is_iso_date(value: str) -> bool:
+    try:
+        date.fromisoformat(value); return True
+    except ValueError:
+        return False
+
+def parse_exception_args(args: list[str], valid_ops: set[str], with_hours: bool):
+    """Argomenti di /chiusura e /orario_speciale: dal [al] [orari] [op_id] [nota...]."""
+    args = list(args)
+    if not args or not _is_iso_date(args[0]):
+        raise ValueError("data iniziale mancante o non valida (YYYY-MM-DD)")
+    date_from = args.pop(0); date_to = date_from
+    if args and _is_iso_date(args[0]):
+        date_to = args.pop(0)
+    hours = None
+    if with_hours:
+        if not args:
+            raise ValueError("orari mancanti (es. 10:00-20:00 oppure 09:00-13:00,14:00-20:00)")
+        hours = args.pop(0)
+    op_id = None
+    if args and args[0] in valid_ops:
+        op_id = args.pop(0)
+    return date_from, date_to, op_id, hours, " ".join(args) or None
+
+def describe_exception(row) -> str:
+    exc_id, op_id, date_from, date_to, hours_json, note = row
+    when = date_from if date_from == date_to else f"{date_from} → {date_to}"
+    who = operator_name(op_id) if op_id else "centro"
+    what = "chiuso" if not hours_json else "orario " + ", ".join(f"{a}-{b}" for a, b in json.loads(hours_json))
+    return f"#{exc_id} {when} · {who} · {what}" + (f" ({note})" if note else "")
+
+def count_bookings_between(date_from: str, date_to: str, op_id: str | None) -> int:
+    con = db_conn(); cur = con.cursor()
+    table = bookings_source(con, date_from)
+    if op_id:
+        cur.execute(f"SELECT COUNT(*) FROM {table} WHERE date BETWEEN ? AND ? AND operator_id=? AND {ACTIVE_BOOKING_SQL}", (date_from, date_to, op_id))
+    else:
+        cur.execute(f"SELECT COUNT(*) FROM {table} WHERE date BETWEEN ? AND ? AND {ACTIVE_BOOKING_SQL}", (date_from, date_to))
+    n = cur.fetchone()[0]; con.close(); return n
+
+async def _add_exception_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE, with_hours: bool):
+    if not is_admin(update.effective_user.id) and update.effective_user.id != FULL_ADMIN_CHAT_ID:
         await update.message.reply_text("Accesso negato. ✋")
         return
-    args = context.args if hasattr(context, "args") else []
-    if len(args) != 2:
-        await update.message.reply_text("Uso: /purge_day YYYY-MM-DD op_id\nEsempio: /purge_day 2025-10-25 op_sara")
-        return
-    date_str, op_id = args[0].strip(), args[1].strip()
-    # Valida data
+    con = db_conn(); cur = con.cursor(); cur.execute("SELECT id FROM operators"); valid_ops = {r[0] for r in cur.fetchall()}; con.close()
     try:
-        _ = datetime.strptime(date_str, "%Y-%m-%d")
-    except Exception:
-        await update.message.reply_text("Data non valida. Usa formato YYYY-MM-DD")
+        date_from, date_to, op_id, hours, note = parse_exception_args(context.args or [], valid_ops, with_hours)
+        exc_id = add_schedule_exception(date_from, date_to, op_id, hours, note)
+    except ValueError as e:
+        usage = ("/orario_speciale YYYY-MM-DD [YYYY-MM-DD] 10:00-20:00 [op_id] [nota]" if with_hours
+                 else "/chiusura YYYY-MM-DD [YYYY-MM-DD] [op_id] [nota]")
+        await update.message.reply_text(f"Errore: {e}\nUso: {usage}\nOperatrici: {', '.join(sorted(valid_ops))}")
         return
-    # Valida operatrice (da DB)
-    con = db_conn(); cur = con.cursor()
-    cur.execute("SELECT id FROM operators")
-    valid_ops = {row[0] for row in cur.fetchall()}
-    con.close()
-    if op_id not in valid_ops:
-        await update.message.reply_text("Operatrice non valida. Usa uno di: " + ", ".join(sorted(valid_ops)))
+    text = f"✅ Registrata eccezione #{exc_id}."
+    if not with_hours:
+        existing = count_bookings_between(date_from, date_to, op_id)
+        if existing:
+            text += f"\n⚠️ Ci sono già {existing} prenotazioni nel periodo: non vengono cancellate (vedi /disdici_periodo e /purge_day)."
+    await update.message.reply_text(text)
+
+async def closure_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Comando admin: /chiusura YYYY-MM-DD [YYYY-MM-DD] [op_id] [nota] - festività, chiusure, ferie."""
+    await _add_exception_cmd(update, context, with_hours=False)
+
+async def special_hours_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Comando admin: /orario_speciale YYYY-MM-DD [YYYY-MM-DD] HH:MM-HH:MM[,...] [op_id] [nota]."""
+    await _add_exception_cmd(update, context, with_hours=True)
+
+async def exceptions_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Comando admin: /eccezioni [elimina <id>] - elenca o rimuove chiusure e orari speciali."""
+    if not is_admin(update.effective_user.id) and update.effective_user.id != FULL_ADMIN_CHAT_ID:
+        await update.message.reply_text("Accesso negato. ✋")
         return
-    # Cancella
-    con = db_conn(); cur = con.cursor()
-    cur.execute("SELECT COUNT(*) FROM bookings WHERE date=? AND operator_id=?", (date_str, op_id))
-    pre = cur.fetchone()[0]
-    cur.execute("DELETE FROM bookings WHERE date=? AND operator_id=?", (date_str, op_id))
-    con.commit(); con.close()
-    await update.message.reply_text(f"Eliminate {pre} prenotazioni per {operator_name(op_id)} in data {date_str}.")
+    args = context.args or []
+    if len(args) == 2 and args[0].lower() == "elimina" and args[1].lstrip("#").isdigit():
+        ok = delete_schedule_exception(int(args[1].lstrip("#")))
+        await update.message.reply_text("✅ Eccezione eliminata." if ok else "❌ Eccezione non trovata.")
+        return
+    rows = list_schedule_exceptions()
+    if not rows:
+        await update.message.reply_text("Nessuna chiusura o orario speciale in programma.")
+        return
+    await update.message.reply_text(("Chiusure e orari speciali:\n" + "\n".join(describe_exception(r) for r in rows))[:4000])
 
 async def admin_today_impl(q, context: ContextTypes.DEFAULT_TYPE):
     dstr = date.today().strftime('%Y-%m-%d')
     con = db_conn(); cur = con.cursor()
-    cur.execute("SELECT id, user_id, service_name, date, time, duration, operator_id, price FROM bookings WHERE date=? ORDER BY time", (dstr,))
+    cur.execute("SELECT id, user_id, service_name, date, time, duration, operator_id, price FROM bookings WHERE date=? AND " + ACTIVE_BOOKING_SQL + " ORDER BY time", (dstr,))
     rows = cur.fetchall(); con.close()
     if not rows:
         await q.edit_message_text("Oggi non ci sono prenotazioni.")
@@ -1278,11 +1148,12 @@ async def admin_today_impl(q, context: ContextTypes.DEFAULT_TYPE):
 
 async def admin_export_impl(q, context: ContextTypes.DEFAULT_TYPE):
     con = db_conn(); cur = con.cursor()
-    cur.execute("SELECT id, user_id, service_code, service_name, date, time, duration, operator_id, price, created_at FROM bookings ORDER BY date, time")
+    # Esportazione completa: anche le prenotazioni archiviate
+    cur.execute(f"SELECT id, user_id, service_code, service_name, date, time, duration, operator_id, price, status, created_at FROM {bookings_source(con, None)} ORDER BY date, time")
     rows = cur.fetchall(); con.close()
     buf = BytesIO()
     writer = csv.writer(buf)
-    writer.writerow(["id","user_id","service_code","service_name","date","time","duration","operator_id","price","created_at"])
+    writer.writerow(["id","user_id","service_code","service_name","date","time","duration","operator_id","price","status","created_at"])
     for r in rows:
         writer.writerow(list(r))
     buf.seek(0)
@@ -1349,16 +1220,6 @@ async def process_waitlist_cmd(update: Update, context: ContextTypes.DEFAULT_TYP
         f"• Notifiche inviate: {notified}"
     )
 
-# Operatrici
-
-def operator_name(op_id: str) -> str:
-    # Usa DB invece di OPERATRICI hardcoded
-    con = db_conn(); cur = con.cursor()
-    cur.execute("SELECT name FROM operators WHERE id=?", (op_id,))
-    row = cur.fetchone()
-    con.close()
-    return row[0] if row else "—"
-
 # Prenotazione / Disdetta / Waitlist
 async def finalize_booking(cb_or_update, context: ContextTypes.DEFAULT_TYPE, svc, date_str, time_str, op_id, from_waitlist=False):
     """Finalizza la prenotazione e pianifica i promemoria.
@@ -1394,136 +1255,31 @@ async def finalize_booking(cb_or_update, context: ContextTypes.DEFAULT_TYPE, svc
                 username = context.user_data.get("username")
             else:
                 # Non riusciamo a determinare l'utente correttamente
-                logger.error("Impossibile determinare l'utente per la prenotazione; abort.")
-                return
-        else:
-            user_id = user_obj.id
-            username = getattr(user_obj, "username", None) or context.user_data.get("username")
-    # Salva/aggiorna dati utente in modo centralizzato
-    client_id = save_or_update_user(
-        user_id=user_id,
-        username=username,
-        name=context.user_data.get("name"),
-        phone=context.user_data.get("phone"),
-        notes=context.user_data.get("notes"),
-    )
-    if client_id is None:
-        client_id = ensure_client_for_user(user_id, username=username, name=context.user_data.get("name"), phone=context.user_data.get("phone"), notes=context.user_data.get("notes"))
-
-    center_id = resolve_default_center_id()
-    con = db_conn(); cur = con.cursor()
-    price_val = normalize_price(svc.get("prezzo"))
-    cur.execute(
-        """
-        INSERT INTO bookings (
-            user_id, client_id, center_id,
-            service_code, service_name,
-            date, time, duration,
-            operator_id, price, created_at,
-            status, reminder_sent
-        ) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?)
-        """,
-        (
-            user_id,
-            client_id,
-            center_id,
-            svc["code"],
-            svc["nome"],
-            date_str,
-            time_str,
-            svc["durata"],
-            op_id,
-            price_val,
-            datetime.utcnow().isoformat(),
-            "CONFIRMED",
-            0,
-        ),
-    )
-    booking_id = cur.lastrowid; con.commit(); con.close(); logger.info(f"Booking saved: id={booking_id} user={user_id} svc={svc['code']} date={date_str} time={time_str} op={op_id}")
-    
-    # Calcola quando inviare il reminder
-    if TEST_MODE:
-        # In TEST: invia 5 secondi DOPO la prenotazione (per testare subito)
-        delay = REMINDER_DELAY  # 5 secondi
-        logger.info(f"TEST_MODE: Scheduled reminder in {delay}s AFTER booking for user={user_id}")
-    else:
-        # In PRODUZIONE: invia 24 ore PRIMA dell'appuntamento
-        appt_dt = datetime_from_date_time_str(date_str, time_str)
-        remind_at = appt_dt - timedelta(seconds=REMINDER_DELAY)
-        delay = (remind_at - datetime.now()).total_seconds()
-        if delay < 1: 
-            delay = 1  # Se l'appuntamento è troppo vicino, invia subito
-        logger.info(f"PRODUZIONE: Scheduled reminder in {delay}s ({delay/3600:.1f}h) BEFORE appointment for user={user_id}")
-    
-    try: 
-        context.application.job_queue.run_once(send_reminder_job, when=delay, data={"user_id": user_id, "service_name": svc["nome"], "date_str": date_str, "time_str": time_str})
-    except Exception as e: 
-        logger.warning("Failed to schedule reminder: %s", e)
-        asyncio.create_task(reminder_background(delay, user_id, svc["nome"], date_str, time_str, context))
-    
-    if from_waitlist:
-        con = db_conn(); cur = con.cursor(); cur.execute("DELETE FROM waitlist WHERE user_id=? AND date=? AND service_code= ?", (user_id, date_str, svc["code"]))
-        con.commit(); con.close()
-
-async def finalize_booking_from_accept(user_id: int, context: ContextTypes.DEFAULT_TYPE, svc, date_str: str, time_str: str, op_id: str, waitlist_entry_id: int | None = None):
-    try:
-        chat = await context.application.bot.get_chat(user_id); username = getattr(chat, "username", None)
-    except Exception:
-        username = None
-    # Allinea i dati utente
-    client_id: int | None = None
-    try:
-        client_id = save_or_update_user(user_id=user_id, username=username)
-    except Exception as e:
-        logger.debug("save_or_update_user (accept) fallito: %s", e)
-        client_id = ensure_client_for_user(user_id, username=username)
-    else:
-        if client_id is None:
-            client_id = ensure_client_for_user(user_id, username=username)
-    center_id = resolve_default_center_id()
-    con = db_conn(); cur = con.cursor();
-    price_val = normalize_price(svc.get("prezzo"))
-    cur.execute(
-        """
-        INSERT INTO bookings (
-            user_id, client_id, center_id,
-            service_code, service_name,
-            date, time, duration,
-            operator_id, price, created_at,
-            status, reminder_sent
-        ) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?)
-        """,
-        (
-            user_id,
-            client_id,
-            center_id,
-            svc["code"],
-            svc["nome"],
-            date_str,
-            time_str,
-            svc["durata"],
-            op_id,
-            price_val,
-            datetime.utcnow().isoformat(),
-            "CONFIRMED",
-            0,
-        ),
+                logger.error("Impossibile determinare l'utente per la prenotazione; abort.")
+                return
+        else:
+            user_id = user_obj.id
+            username = getattr(user_obj, "username", None) or context.user_data.get("username")
+    # Client, prenotazione e pulizia della waitlist: una connessione, una transazione
+    client = {k: context.user_data.get(k) for k in ("name", "phone", "notes")}
+    saved = await asyncio.to_thread(
+        save_booking, user_id, svc, date_str, time_str, op_id, dict(client, username=username), clear_waitlist=from_waitlist,
     )
-    booking_id = cur.lastrowid; con.commit(); con.close()
-    
-    # Se la prenotazione arriva dalla lista d'attesa rimuovi solo quella entry
-    if waitlist_entry_id is not None:
-        con = db_conn(); cur = con.cursor()
-        cur.execute("DELETE FROM waitlist WHERE id=?", (waitlist_entry_id,))
-        removed = cur.rowcount
-        con.commit(); con.close()
-        logger.info("Waitlist entry %s removed after accept (rows=%s)", waitlist_entry_id, removed)
-    
+    if saved is None:
+        logger.info("Slot già preso al salvataggio: user=%s date=%s time=%s op=%s", user_id, date_str, time_str, op_id,
+                    extra={"event": "booking_conflict"})
+        return None
+    booking_id, _ = saved
+    logger.info("Booking saved: id=%s user=%s svc=%s date=%s time=%s op=%s", booking_id, user_id, svc['code'], date_str, time_str, op_id, extra={"event": "booking_saved", "booking_id": booking_id})
+    schedule_booking_reminder(context, user_id, svc["nome"], date_str, time_str)
+    return booking_id
+
+def schedule_booking_reminder(context: ContextTypes.DEFAULT_TYPE, user_id: int, service_name: str, date_str: str, time_str: str) -> None:
     # Calcola quando inviare il reminder
     if TEST_MODE:
         # In TEST: invia 5 secondi DOPO la prenotazione (per testare subito)
         delay = REMINDER_DELAY  # 5 secondi
-        logger.info(f"TEST_MODE: Scheduled reminder in {delay}s AFTER booking for user={user_id} (accept)")
+        logger.info("TEST_MODE: Scheduled reminder in %ss AFTER booking for user=%s", delay, user_id)
     else:
         # In PRODUZIONE: invia 24 ore PRIMA dell'appuntamento
         appt_dt = datetime_from_date_time_str(date_str, time_str)
@@ -1531,39 +1287,75 @@ async def finalize_booking_from_accept(user_id: int, context: ContextTypes.DEFAU
         delay = (remind_at - datetime.now()).total_seconds()
         if delay < 1: 
             delay = 1  # Se l'appuntamento è troppo vicino, invia subito
-        logger.info(f"PRODUZIONE: Scheduled reminder in {delay}s ({delay/3600:.1f}h) BEFORE appointment for user={user_id} (accept)")
-    
-    try: 
-        context.application.job_queue.run_once(send_reminder_job, when=delay, data={"user_id": user_id, "service_name": svc["nome"], "date_str": date_str, "time_str": time_str})
-    except Exception as e: 
-        logger.warning("Failed to schedule reminder (accept): %s", e)
-        asyncio.create_task(reminder_background(delay, user_id, svc["nome"], date_str, time_str, context))
+        logger.info("PRODUZIONE: Scheduled reminder in %.0fs (%.1fh) BEFORE appointment for user=%s", delay, delay / 3600, user_id)
     
+    if CLUSTER_MODE:
+        # In cluster il reminder lo invia il leader (reminder_scan_job) leggendo il DB
+        pass
+    else:
+        try:
+            context.application.job_queue.run_once(send_reminder_job, when=delay, data={"user_id": user_id, "service_name": service_name, "date_str": date_str, "time_str": time_str})
+        except Exception as e:
+            logger.warning("Failed to schedule reminder: %s", e)
+            TASKS.spawn(reminder_background(delay, user_id, service_name, date_str, time_str, context), kind="reminder", name=f"reminder:{user_id}:{date_str} {time_str}")
+
+async def finalize_booking_from_accept(user_id: int, context: ContextTypes.DEFAULT_TYPE, svc, date_str: str, time_str: str, op_id: str, waitlist_entry_id: int | None = None):
+    try:
+        chat = await context.application.bot.get_chat(user_id); username = getattr(chat, "username", None)
+    except Exception:
+        username = None
+    # Client, prenotazione e rimozione della sola voce di waitlist accettata in una transazione
+    saved = await asyncio.to_thread(
+        save_booking, user_id, svc, date_str, time_str, op_id, {"username": username}, waitlist_entry_id=waitlist_entry_id,
+    )
+    if saved is None:
+        logger.info("Slot già preso al salvataggio (accept): user=%s date=%s time=%s op=%s", user_id, date_str, time_str, op_id,
+                    extra={"event": "booking_conflict"})
+        return None
+    booking_id, removed = saved
+    if waitlist_entry_id is not None:
+        logger.info("Waitlist entry %s removed after accept (rows=%s)", waitlist_entry_id, removed)
+    schedule_booking_reminder(context, user_id, svc["nome"], date_str, time_str)
+
     # Avvisa gli altri utenti in lista d'attesa che lo slot è stato preso
     try:
         await notify_waitlist_slot_taken(context, date_str, time_str, svc["code"], svc["nome"], exclude_user_id=user_id)
     except Exception as e:
         logger.debug("notify_waitlist_slot_taken fallita: %s", e)
+    return booking_id
 
 async def cancel_booking(update: Update, context: ContextTypes.DEFAULT_TYPE, booking_id: int):
     q = update.callback_query; con = db_conn(); cur = con.cursor(); cur.execute("SELECT user_id, service_code, service_name, date, time, operator_id FROM bookings WHERE id= ?", (booking_id,)); row = cur.fetchone()
     if not row: await q.edit_message_text("Prenotazione non trovata."); con.close(); return
     user_id_db, svc_code, svc_name, date_str, time_str, op_id = row
-    logger.info(f"Canceling booking {booking_id}: service={svc_code} date={date_str} time={time_str} op={op_id}")
+    logger.info("Canceling booking %s: service=%s date=%s time=%s op=%s", booking_id, svc_code, date_str, time_str, op_id, extra={"event": "booking_cancelled", "booking_id": booking_id})
     cur.execute("DELETE FROM bookings WHERE id=?", (booking_id,)); con.commit(); con.close()
     await q.edit_message_text("✅ Prenotazione disdetta.")
     await notify_waitlist(context, date_str, time_str, op_id, svc_code, svc_name)
 
-async def notify_waitlist(context: ContextTypes.DEFAULT_TYPE, date_str: str, time_str: str, op_id: str, svc_code: str, svc_name: str):
-    """Avvia la notifica sequenziale agli utenti della lista d'attesa."""
-    con = db_conn(); cur = con.cursor()
-    cur.execute(
-        "SELECT id, user_id FROM waitlist WHERE date=? AND service_code=? ORDER BY id ASC",
-        (date_str, svc_code),
-    )
-    entries = [{"id": row[0], "user_id": row[1]} for row in cur.fetchall()]
-    con.close()
-    logger.info(f"Waitlist check: date={date_str} service={svc_code} -> {len(entries)} entries found")
+async def notify_waitlist(context: ContextTypes.DEFAULT_TYPE, date_str: str, time_str: str, op_id: str, svc_code: str, svc_name: str,
+                          entries: list[dict] | None = None):
+    """Avvia la notifica sequenziale agli utenti della lista d'attesa.
+
+    ``entries`` (voci già lette, es. da match_waitlist) evita di rileggere la waitlist.
+    """
+    if CLUSTER_MODE:
+        # La cascata la esegue solo il leader: accoda l'evento, lo preleva waitlist_dispatch_job
+        enqueue_waitlist_event(date_str, time_str, op_id, svc_code, svc_name)
+        return
+    await start_waitlist_cascade(context, date_str, time_str, op_id, svc_code, svc_name, entries)
+
+async def start_waitlist_cascade(context: ContextTypes.DEFAULT_TYPE, date_str: str, time_str: str, op_id: str, svc_code: str, svc_name: str,
+                                 entries: list[dict] | None = None):
+    if entries is None:
+        con = db_conn(); cur = con.cursor()
+        cur.execute(
+            "SELECT id, user_id FROM waitlist WHERE date=? AND service_code=? ORDER BY id ASC",
+            (date_str, svc_code),
+        )
+        entries = [{"id": row[0], "user_id": row[1]} for row in cur.fetchall()]
+        con.close()
+    logger.info("Waitlist check: date=%s service=%s -> %s entries found", date_str, svc_code, len(entries))
     if not entries:
         return
     # Primo step immediato
@@ -1591,23 +1383,22 @@ async def waitlist_step_job(context: ContextTypes.DEFAULT_TYPE):
     date_str = data.get("date_str"); time_str = data.get("time_str")
     op_id = data.get("op_id"); svc_code = data.get("svc_code"); svc_name = data.get("svc_name")
     
-    logger.info(f"🔔 waitlist_step_job called: idx={idx}/{len(entries)} date={date_str} time={time_str} svc={svc_code}")
+    logger.debug("waitlist_step_job: idx=%s/%s date=%s time=%s svc=%s", idx, len(entries), date_str, time_str, svc_code)
     
     if not entries or idx >= len(entries) or not all([date_str, time_str, op_id, svc_code]):
-        logger.warning(f"❌ Waitlist step aborted: entries={len(entries)} idx={idx} date={date_str} time={time_str} op={op_id} svc={svc_code}")
+        logger.warning("Waitlist step aborted: entries=%s idx=%s date=%s time=%s op=%s svc=%s", len(entries), idx, date_str, time_str, op_id, svc_code)
         return
     svc = find_service_by_code(svc_code)
     if not svc:
-        logger.warning(f"❌ Service not found: {svc_code}")
+        logger.warning("Service not found: %s", svc_code)
         return
     # Interrompi se lo slot non è più libero
     if not is_slot_free_for_operator(date_str, time_str, svc["durata"], op_id):
-        logger.info(f"⏹️ Slot no longer available: {date_str} {time_str}")
+        logger.info("Waitlist: slot %s %s non più libero, cascata interrotta", date_str, time_str)
         return
     entry = entries[idx]
     waitlist_id = entry.get("id")
     uid = entry.get("user_id")
-    logger.info(f"📤 Sending waitlist notification to user {uid} (waitlist_id={waitlist_id})")
     
     # Escape caratteri speciali Markdown nel nome servizio
     svc_name_escaped = svc_name.replace('_', '\\_').replace('*', '\\*').replace('[', '\\[').replace(']', '\\]')
@@ -1618,19 +1409,15 @@ async def waitlist_step_job(context: ContextTypes.DEFAULT_TYPE):
         f"⏳ Hai {WAITLIST_STEP_SECONDS} secondi prima che venga proposto al prossimo."
     )
     callback_str = f"acsl_{waitlist_id}"
-    context.bot_data[callback_str] = {
-        'date': date_str,
-        'time': time_str,
-        'op_id': op_id,
-        'svc_code': svc_code,
-        'waitlist_id': waitlist_id,
-    }
+    # Nel DB: in cluster la cascata gira sul leader, il tocco può arrivare a un altro worker
+    await asyncio.to_thread(save_slot_offer, waitlist_id, date_str, time_str, op_id, svc_code)
     kb = [[InlineKeyboardButton("📌 Prenota questo slot", callback_data=callback_str)]]
     try:
         await context.application.bot.send_message(uid, text, reply_markup=InlineKeyboardMarkup(kb), parse_mode=ParseMode.MARKDOWN)
-        logger.info(f"✅ Waitlist notification sent successfully to user {uid}")
+        logger.info("Waitlist: notifica inviata a user=%s (waitlist_id=%s, step %s/%s)", uid, waitlist_id, idx + 1, len(entries),
+                    extra={"event": "waitlist_notified", "waitlist_id": waitlist_id})
     except Exception as e:
-        logger.error(f"❌ Failed to send waitlist notification to user {uid}: {e}")
+        logger.error("Failed to send waitlist notification to user %s: %s", uid, e)
     # Pianifica il prossimo utente se resta libero
     next_idx = idx + 1
     if next_idx < len(entries):
@@ -1702,6 +1489,159 @@ async def send_post_confirm_reminder_job(context: ContextTypes.DEFAULT_TYPE):
     try: await context.application.bot.send_message(user_id, text, parse_mode=ParseMode.MARKDOWN)
     except Exception as e: logger.exception("Failed to send post-confirm reminder to user=%s: %s", user_id, e)
 
+# ------------------------
+# CLUSTER - job periodici eseguiti solo dal leader
+# ------------------------
+CLUSTER_REMINDER_SCAN_SECONDS = int(os.environ.get("CLUSTER_REMINDER_SCAN_SECONDS", "30"))
+CLUSTER_WAITLIST_POLL_SECONDS = int(os.environ.get("CLUSTER_WAITLIST_POLL_SECONDS", "5"))
+BACKUP_INTERVAL_HOURS = float(os.environ.get("BACKUP_INTERVAL_HOURS", "24"))
+BACKUP_KEEP = int(os.environ.get("BACKUP_KEEP", "7"))
+ARCHIVE_INTERVAL_HOURS = float(os.environ.get("ARCHIVE_INTERVAL_HOURS", "24"))
+BACKUP_DIR = os.environ.get("BACKUP_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "backups"))
+
+def leader_only(callback):
+    """Esegue il job solo se questo worker detiene il lease del cluster."""
+    async def wrapper(context: ContextTypes.DEFAULT_TYPE):
+        if not ELECTOR.is_leader:
+            return
+        await callback(context)
+    wrapper.__name__ = callback.__name__
+    return wrapper
+
+async def lease_heartbeat_job(context: ContextTypes.DEFAULT_TYPE):
+    await asyncio.to_thread(ELECTOR.try_acquire)
+
+def select_due_reminders(now: datetime) -> list[tuple]:
+    """Prenotazioni attive (non disdette) con reminder da inviare: (id, user_id, service_name, date, time, remind_at).
+
+    Finestra su start_ts (indice): appuntamenti non ancora iniziati e, fuori da TEST_MODE,
+    che iniziano entro REMINDER_DELAY secondi.
+    """
+    window, params = "start_ts > ?", [to_epoch_minutes(now)]
+    if not TEST_MODE:
+        window += " AND start_ts <= ?"
+        params.append(to_epoch_minutes(now + timedelta(seconds=REMINDER_DELAY)))
+    con = db_conn(); cur = con.cursor()
+    cur.execute(
+        "SELECT id, user_id, service_name, date, time, created_at FROM bookings WHERE " + window +
+        " AND " + ACTIVE_BOOKING_SQL + " AND COALESCE(reminder_sent,0)=0 AND user_id IS NOT NULL",
+        params,
+    )
+    rows = cur.fetchall(); con.close()
+    due = []
+    for bid, uid, sname, dstr, tstr, created_at in rows:
+        try:
+            appt_dt = datetime_from_date_time_str(dstr, tstr)
+        except Exception:
+            continue
+        if TEST_MODE:
+            # In TEST il reminder parte REMINDER_DELAY secondi dopo la prenotazione (created_at è UTC)
+            try:
+                created_local = datetime.fromisoformat(str(created_at)) + (datetime.now() - datetime.utcnow())
+            except Exception:
+                created_local = now
+            remind_at = created_local + timedelta(seconds=REMINDER_DELAY)
+            if remind_at > now:
+                continue
+        else:
+            remind_at = appt_dt - timedelta(seconds=REMINDER_DELAY)
+        due.append((bid, uid, sname, dstr, tstr, remind_at))
+    return due
+
+def claim_reminder(booking_id: int) -> bool:
+    """Marca il reminder come inviato; False se un altro worker lo ha già preso."""
+    con = db_conn(); cur = con.cursor()
+    cur.execute("UPDATE bookings SET reminder_sent=1 WHERE id=? AND COALESCE(reminder_sent,0)=0", (booking_id,))
+    claimed = cur.rowcount > 0
+    con.commit(); con.close()
+    return claimed
+
+async def reminder_scan_job(context: ContextTypes.DEFAULT_TYPE):
+    due = await asyncio.to_thread(select_due_reminders, datetime.now())
+    for bid, uid, sname, dstr, tstr, remind_at in due:
+        if not await asyncio.to_thread(claim_reminder, bid):
+            continue
+        text = (f"🔔 Promemoria: tra poco hai *{sname}*\n" f"📅 {datetime.strptime(dstr, '%Y-%m-%d').strftime('%d/%m/%Y')} 🕒 {tstr}")
+        try:
+            await context.application.bot.send_message(uid, text, parse_mode=ParseMode.MARKDOWN)
+            REMINDER_LAG.observe(max(0.0, (datetime.now() - remind_at).total_seconds()), "cluster_scan")
+        except Exception as e:
+            logger.warning("Reminder (cluster) fallito per booking=%s user=%s: %s", bid, uid, e)
+
+async def waitlist_dispatch_job(context: ContextTypes.DEFAULT_TYPE):
+    events = await asyncio.to_thread(claim_waitlist_events)
+    for date_str, time_str, op_id, svc_code, svc_name in events:
+        await start_waitlist_cascade(context, date_str, time_str, op_id, svc_code, svc_name)
+
+async def archive_job(context: ContextTypes.DEFAULT_TYPE):
+    """Sposta le prenotazioni passate da oltre ARCHIVE_AFTER_DAYS giorni in bookings_archive."""
+    started = monotonic()
+    try:
+        moved = await asyncio.to_thread(archive_old_bookings)
+    except Exception as e:
+        logger.exception("Archiviazione prenotazioni fallita: %s", e)
+        return
+    if moved:
+        logger.info("Archiviate %d prenotazioni in %.0f ms", moved, (monotonic() - started) * 1000,
+                    extra={"event": "bookings_archived", "count": moved})
+
+async def backup_job(context: ContextTypes.DEFAULT_TYPE):
+    try:
+        path = await asyncio.to_thread(backup_database, BACKUP_DIR, BACKUP_KEEP)
+        logger.info("Backup DB completato: %s", path)
+    except Exception as e:
+        logger.exception("Backup DB fallito: %s", e)
+
+def install_cluster_jobs(app):
+    """Registra heartbeat del lease e job periodici (eseguiti solo dal leader)."""
+    jq = app.job_queue
+    jq.run_repeating(lease_heartbeat_job, interval=LEASE_RENEW_INTERVAL, first=0, name="cluster_lease")
+    jq.run_repeating(leader_only(reminder_scan_job), interval=CLUSTER_REMINDER_SCAN_SECONDS, first=5, name="cluster_reminders")
+    jq.run_repeating(leader_only(waitlist_dispatch_job), interval=CLUSTER_WAITLIST_POLL_SECONDS, first=5, name="cluster_waitlist")
+    if BACKUP_INTERVAL_HOURS > 0:
+        jq.run_repeating(leader_only(backup_job), interval=BACKUP_INTERVAL_HOURS * 3600, first=60, name="cluster_backup")
+
+async def cluster_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Comando admin: /cluster - stato del lease e del worker corrente."""
+    if not is_admin(update.effective_user.id):
+        await update.message.reply_text("Accesso negato. ✋")
+        return
+    if not CLUSTER_MODE:
+        await update.message.reply_text("Modalità cluster non attiva (CLUSTER_MODE=0).")
+        return
+    holder = await asyncio.to_thread(ELECTOR.current_holder)
+    leader_txt = f"{holder[0]} (scade tra {max(0, holder[1] - datetime.now().timestamp()):.0f}s)" if holder else "nessuno"
+    await update.message.reply_text(
+        f"Worker: {WORKER_ID}\n• Leader: {leader_txt}\n• Questo worker è leader: {'sì' if ELECTOR.is_leader else 'no'}"
+    )
+
+async def metrics_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Comando admin: /metrics - riepilogo di latenze, query, Bot API, job e cache."""
+    if not is_admin(update.effective_user.id) and update.effective_user.id != FULL_ADMIN_CHAT_ID:
+        await update.message.reply_text("Accesso negato. ✋")
+        return
+    if not METRICS_ENABLED:
+        await update.message.reply_text("Metriche disattivate (METRICS_ENABLED=0).")
+        return
+    await update.message.reply_text(metrics_summary_text()[:4000])
+
+async def slow_queries_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Comando admin: /slow_queries [reset] - query SQL oltre SLOW_QUERY_MS con piano di esecuzione."""
+    if not is_admin(update.effective_user.id) and update.effective_user.id != FULL_ADMIN_CHAT_ID:
+        await update.message.reply_text("Accesso negato. ✋")
+        return
+    if SLOW_QUERIES is None:
+        await update.message.reply_text("Log delle query lente disattivato (imposta SLOW_QUERY_MS).")
+        return
+    if context.args and context.args[0].lower() == "reset":
+        SLOW_QUERIES.reset()
+        await update.message.reply_text("Statistiche delle query lente azzerate.")
+        return
+    await update.message.reply_text(
+        f"Query più lente (oltre {SLOW_QUERIES.threshold_s * 1000:g} ms, dettagli in {SLOW_QUERIES.path}):\n"
+        + SLOW_QUERIES.summary(top=8)[:3800]
+    )
+
 async def test_reminder_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id; when = 10
     try:
@@ -1718,50 +1658,6 @@ async def test_after_confirm_cmd(update: Update, context: ContextTypes.DEFAULT_T
     except Exception as e:
         logger.exception("Failed to schedule post-confirm test reminder: %s", e); await update.message.reply_text("Errore nel programmare il promemoria post-conferma di test.")
 
-# Helpers
-
-def find_service_by_code(code: str) -> dict | None:
-    """Restituisce il dizionario del servizio corrispondente al codice (da DB)."""
-    con = db_conn(); cur = con.cursor()
-    cur.execute("SELECT code, title, duration_minutes, price FROM services WHERE code=?", (code,))
-    row = cur.fetchone()
-    con.close()
-    if row:
-        return {
-            "code": row[0],
-            "nome": row[1],
-            "durata": row[2],
-            "prezzo": row[3]
-        }
-    return None
-
-def normalize_price(value) -> float:
-    """Normalizza il prezzo in un float.
-
-    Accetta numeri, stringhe con simbolo € o virgole, spazi; altrimenti 0.0.
-    """
-    if value is None:
-        return 0.0
-    if isinstance(value, (int, float)):
-        return float(value)
-    if isinstance(value, str):
-        v = value.strip().replace("€", "").replace(" ", "").replace(",", ".")
-        try:
-            return float(v)
-        except Exception:
-            return 0.0
-    return 0.0
-
-def format_price_eur(value) -> str:
-    """Formatta un prezzo in euro, con fallback a '—'."""
-    try:
-        if value is None:
-            return "—"
-        v = float(value)
-        return f"€{v:.2f}"
-    except Exception:
-        return "—"
-
 # Conversation
 
 def build_conversation():
@@ -1782,9 +1678,14 @@ def build_conversation():
         },
         fallbacks=[CommandHandler("start", start)],
         allow_reentry=True,
+        name="booking",
+        persistent=PERSISTENCE_ENABLED,
     )
 
 # Start/main
+async def help_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.message.reply_text("Usa /start")
+
 async def privacy_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("Privacy: i dati sono usati per gestire prenotazioni.")
 
@@ -1792,10 +1693,14 @@ async def version_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(f"{BUILD_VERSION}\npython-telegram-bot: 22.x")
 
 async def debug_config_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    variant = os.environ.get("BOT_VARIANT", "minimal").strip().lower() or "minimal"
     await update.message.reply_text(
         "Config attuale:\n" \
         f"- TEST_MODE={TEST_MODE}\n" \
-        f"- REMINDER_DELAY={REMINDER_DELAY}s ({'5s in test' if TEST_MODE else '24h in produzione'})"
+        f"- REMINDER_DELAY={REMINDER_DELAY}s ({'5s in test' if TEST_MODE else '24h in produzione'})\n" \
+        f"- Task in background: {TASKS.summary()}\n" \
+        f"- Persistenza: {context.application.persistence.summary() if context.application.persistence else 'disattivata'}\n" \
+        f"Callback più costosi:\n{FULL_ROUTES.summary() if variant == 'full' else MENU_ROUTES.summary()}"
     )
 
 async def mode_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1865,6 +1770,8 @@ CREATE TABLE IF NOT EXISTS bookings (
     status TEXT DEFAULT 'CONFIRMED',
     created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
     reminder_sent INTEGER DEFAULT 0,
+    start_ts INTEGER,
+    end_ts INTEGER,
     FOREIGN KEY(center_id) REFERENCES centers(id),
     FOREIGN KEY(operator_id) REFERENCES operators(id),
     FOREIGN KEY(service_code) REFERENCES services(code),
@@ -1881,7 +1788,7 @@ CREATE TABLE IF NOT EXISTS waitlist_full (
 """
 
 def FULL_db_conn():
-    con = sqlite3.connect(FULL_DB_PATH, detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES, check_same_thread=False)
+    con = sqlite3.connect(FULL_DB_PATH, detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES, check_same_thread=False, factory=connection_factory())
     con.row_factory = sqlite3.Row
     con.execute("PRAGMA foreign_keys = ON")
     return con
@@ -1927,8 +1834,15 @@ def FULL_generate_slots_for_operator(operator_id: str, target_date: date, durati
         logger.debug("[FULL] free_slots_for_operator failed: %s", exc)
         return []
 
-def FULL_is_slot_available(operator_id: str, target_date: str, time_str: str) -> bool:
-    con = FULL_db_conn(); cur = con.cursor(); cur.execute("SELECT COUNT(*) FROM bookings WHERE operator_id=? AND date=? AND time=? AND status='CONFIRMED'", (operator_id, target_date, time_str)); ok = (cur.fetchone()[0] == 0); con.close(); return ok
+def FULL_is_slot_available(operator_id: str, target_date: str, time_str: str, duration: int) -> bool:
+    """True se nessuna prenotazione attiva (non disdetta) dell'operatore si sovrappone a [time_str, +duration)."""
+    start_ts, end_ts = booking_span(target_date, time_str, duration)
+    con = FULL_db_conn(); cur = con.cursor()
+    cur.execute(
+        "SELECT 1 FROM bookings WHERE operator_id=? AND start_ts >= ? AND start_ts < ? AND end_ts > ? AND " + ACTIVE_BOOKING_SQL + " LIMIT 1",
+        (operator_id, start_ts - DAY_MINUTES, end_ts, start_ts),
+    )
+    ok = cur.fetchone() is None; con.close(); return ok
 
 def FULL_day_status_symbol(target_date: date, op_id: str, duration_minutes: int) -> str:
     """Restituisce 🟢 se ci sono slot disponibili, 🔴 se è pieno, '' se chiuso"""
@@ -1936,13 +1850,8 @@ def FULL_day_status_symbol(target_date: date, op_id: str, duration_minutes: int)
     if len(slots) > 0:
         return "🟢"
     elif len(slots) == 0:
-        # Controlla se è un giorno chiuso o solo pieno
-        con = FULL_db_conn()
-        cur = con.cursor()
-        cur.execute("SELECT work_start, work_end FROM operators WHERE id=?", (op_id,))
-        op = cur.fetchone()
-        con.close()
-        if op and op["work_start"] and op["work_end"]:
+        # Controlla se è un giorno chiuso o solo pieno (template orari dell'operatore)
+        if operator_day_ranges(op_id, target_date):
             return "🔴"  # Giorno lavorativo ma pieno
     return ""  # Chiuso o non disponibile
 
@@ -2014,6 +1923,16 @@ def FULL_show_calendar_month(year: int, month: int, op_id: str, svc_code: str) -
     msg = f"*{ITALIAN_MONTHS[month-1]} {year}*\n\n{legend_text}\n\nScegli un giorno:"
     return msg, kb
 
+def FULL_calendar_month_view(year: int, month: int, op_id: str, svc_code: str, prefetch: bool = False) -> tuple[str, InlineKeyboardMarkup]:
+    """Come calendar_month_view per la variante Full (tastiera in cache per versione della disponibilità)."""
+    version = availability_version()
+    # La durata segue dal codice: le modifiche a services.duration_minutes cambiano la versione
+    key = None if version is None else ("full", op_id, svc_code, year, month, date.today(), version)
+    def render():
+        msg, kb = FULL_show_calendar_month(year, month, op_id, svc_code)
+        return msg, InlineKeyboardMarkup(kb)
+    return cached_render(key, render, prefetch)
+
 def FULL_find_or_create_client(tg_id: int, name: str | None = None, phone: str | None = None) -> int:
     con = FULL_db_conn(); cur = con.cursor(); cur.execute("SELECT id FROM clients WHERE tg_id=?", (tg_id,)); r = cur.fetchone()
     if r:
@@ -2039,8 +1958,9 @@ def FULL_add_booking(center_id:int, operator_id:str, service_code:str, client_id
             user_id, client_id, center_id,
             operator_id, service_code, service_name,
             date, time, duration,
-            price, created_at, status, reminder_sent
-        ) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?)
+            price, created_at, status, reminder_sent,
+            start_ts, end_ts
+        ) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)
         """,
         (
             tg_id,
@@ -2056,6 +1976,7 @@ def FULL_add_booking(center_id:int, operator_id:str, service_code:str, client_id
             datetime.utcnow().isoformat(),
             "CONFIRMED",
             0,
+            *booking_span(dstr, tstr, duration),
         ),
     )
     bid = cur.lastrowid; con.commit(); con.close(); return bid
@@ -2083,6 +2004,102 @@ async def FULL_notify_admin_startup(application):
     except Exception:
         pass
 
+# Report programmati (solo FULL): orario "HH:MM" nel fuso REPORT_TIMEZONE, vuoto = disattivati
+REPORT_TIME = os.environ.get("REPORT_TIME", "20:00").strip()
+REPORT_TIMEZONE = os.environ.get("REPORT_TIMEZONE", "Europe/Rome").strip()
+# Giorno del report settimanale (0 = lunedì ... 6 = domenica, -1 = mai)
+REPORT_WEEKDAY = int(os.environ.get("REPORT_WEEKDAY", "6"))
+# Pausa minima tra due messaggi: la Bot API accetta circa un messaggio al secondo per chat
+REPORT_SEND_INTERVAL = float(os.environ.get("REPORT_SEND_INTERVAL", "1.1"))
+
+def FULL_report_recipients() -> list[int]:
+    """FULL_ADMIN_CHAT_ID per primo, poi gli ADMIN_IDS, senza doppioni."""
+    return [FULL_ADMIN_CHAT_ID] + sorted(get_admin_ids() - {FULL_ADMIN_CHAT_ID})
+
+def FULL_build_reports(day: date, weekly: bool) -> list[tuple[str, str]]:
+    """(tipo, testo) dei report di ``day``; ogni generazione viene cronometrata (bot_report_build_seconds)."""
+    builders = [("daily", get_daily_stats_text)]
+    if weekly:
+        builders.append(("weekly", get_weekly_stats_text))
+    reports = []
+    for kind, build in builders:
+        started = monotonic()
+        text = build(day)
+        elapsed = monotonic() - started
+        REPORT_DURATION.observe(elapsed, kind)
+        logger.info("Report %s del %s generato in %.1f ms", kind, day, elapsed * 1000,
+                    extra={"event": "report_generated", "kind": kind, "ms": round(elapsed * 1000, 1)})
+        if not text:
+            period = "oggi" if kind == "daily" else "questa settimana"
+            text = f"📊 Report del {day.strftime('%d/%m/%Y')}: nessuna prenotazione {period}."
+        reports.append((kind, text))
+    return reports
+
+async def send_rate_limited(bot, messages, interval: float = REPORT_SEND_INTERVAL) -> int:
+    """Invia in sequenza i (chat_id, testo) con almeno ``interval`` secondi tra due invii.
+
+    Un RetryAfter sospende l'invio per il tempo chiesto da Telegram e ripete il messaggio
+    una volta; gli altri errori (chat bloccata, id errato) saltano solo quel messaggio.
+    Restituisce i messaggi inviati.
+    """
+    sent = 0
+    for i, (chat_id, text) in enumerate(messages):
+        if i and interval > 0:
+            await asyncio.sleep(interval)
+        for attempt in (1, 2):
+            try:
+                await bot.send_message(chat_id=chat_id, text=text, parse_mode=ParseMode.MARKDOWN)
+            except RetryAfter as e:
+                if attempt == 1:
+                    delay = e.retry_after
+                    await asyncio.sleep(delay.total_seconds() if isinstance(delay, timedelta) else float(delay))
+                    continue
+                logger.warning("Report a %s non inviato: limite Bot API ancora attivo", chat_id)
+            except TelegramError as e:
+                logger.warning("Report a %s non inviato: %s", chat_id, e)
+            else:
+                sent += 1
+                REPORT_SENT.inc("sent")
+                break
+            REPORT_SENT.inc("failed")
+            break
+    return sent
+
+def _report_timezone():
+    try:
+        from zoneinfo import ZoneInfo
+        return ZoneInfo(REPORT_TIMEZONE) if REPORT_TIMEZONE else None
+    except Exception as e:
+        logger.warning("REPORT_TIMEZONE %r non disponibile (%s): uso il fuso della JobQueue", REPORT_TIMEZONE, e)
+        return None
+
+async def FULL_report_job(context: ContextTypes.DEFAULT_TYPE):
+    """Report di fine giornata (e settimanale nel giorno REPORT_WEEKDAY) agli admin."""
+    tz = context.job.data if context.job is not None else None
+    today = datetime.now(tz).date()
+    try:
+        reports = await asyncio.to_thread(FULL_build_reports, today, today.weekday() == REPORT_WEEKDAY)
+    except Exception as e:
+        logger.exception("Generazione report programmati fallita: %s", e)
+        return
+    messages = [(chat_id, text) for chat_id in FULL_report_recipients() for _, text in reports]
+    sent = await send_rate_limited(context.bot, messages)
+    logger.info("Report programmati inviati: %d/%d messaggi", sent, len(messages),
+                extra={"event": "report_sent", "sent": sent, "total": len(messages)})
+
+def FULL_install_report_jobs(app):
+    """Pianifica FULL_report_job ogni giorno alle REPORT_TIME (la Full gira sempre su un solo processo)."""
+    if not REPORT_TIME or app.job_queue is None:
+        return
+    tz = _report_timezone()
+    try:
+        hh, mm = (int(part) for part in REPORT_TIME.split(":"))
+        at = time(hh, mm, tzinfo=tz)
+    except ValueError:
+        logger.warning("REPORT_TIME non valido (%r): report programmati disattivati", REPORT_TIME)
+        return
+    app.job_queue.run_daily(FULL_report_job, time=at, data=tz, name="full_reports")
+
 def FULL_category_emoji(cat: str) -> str:
     """Mappa categoria a emoji"""
     mapping = {
@@ -2114,292 +2131,324 @@ async def FULL_start_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         parse_mode=ParseMode.MARKDOWN
     )
 
+# Callback della variante Full: tabella prefisso -> handler (vedi dispatch_module)
+FULL_ROUTES = CallbackRouter("full")
+
 async def FULL_callback_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    q = update.callback_query; await q.answer(); data = q.data or ""
-    # Ignora callback placeholder
-    if data == "ignore": return
-    # Help
-    if data == "full_help":
-        await q.edit_message_text(
-            "Aiuto: usa /start per ricominciare.\nLegenda: 🟢 giorno con disponibilità · 🔴 giorno pieno.\nUsa ⬅️ per tornare.",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🏠 Menu", callback_data="full_home")]])
-        )
+    return await FULL_ROUTES.dispatch(update, context)
+
+# Ignora callback placeholder
+@FULL_ROUTES.route("ignore", exact=True)
+async def FULL_route_ignore(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    return None
+
+# Help
+@FULL_ROUTES.route("full_help", exact=True)
+async def FULL_route_help(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    q = update.callback_query
+    await q.edit_message_text(
+        "Aiuto: usa /start per ricominciare.\nLegenda: 🟢 giorno con disponibilità · 🔴 giorno pieno.\nUsa ⬅️ per tornare.",
+        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🏠 Menu", callback_data="full_home")]])
+    )
+
+# Selezione profilo: Donna/Uomo
+@FULL_ROUTES.route("full_gender_", name="gender")
+async def FULL_route_gender(update: Update, context: ContextTypes.DEFAULT_TYPE, gender: str):
+    q = update.callback_query
+    con = FULL_db_conn(); cur = con.cursor(); cur.execute("SELECT id FROM centers LIMIT 1"); center = cur.fetchone()
+    if not center:
+        await q.edit_message_text("Nessun centro configurato."); con.close(); return
+    center_id = center["id"]
+    cur.execute("SELECT DISTINCT category FROM services WHERE center_id=? AND gender=? ORDER BY category", (center_id, gender))
+    cats = [r[0] for r in cur.fetchall()]
+    # Aggiungi emoji alle categorie
+    kb = [[InlineKeyboardButton(FULL_category_emoji(cat), callback_data=f"full_cat_{gender}|{cat}")] for cat in cats]
+    kb.append([InlineKeyboardButton("⬅️ Indietro", callback_data="full_home")])
+    gender_emoji = "👩" if gender == "Donna" else "👨"
+    await q.edit_message_text(f"Profilo: {gender_emoji} {gender}\nScegli una categoria:", reply_markup=InlineKeyboardMarkup(kb))
+    con.close()
+
+# Selezione categoria → servizi
+@FULL_ROUTES.route("full_cat_", name="category")
+async def FULL_route_category(update: Update, context: ContextTypes.DEFAULT_TYPE, payload: str):
+    q = update.callback_query
+    if "|" not in payload:
+        await q.edit_message_text("Categoria non valida."); return
+    gender, category = payload.split("|", 1)
+    con = FULL_db_conn(); cur = con.cursor(); cur.execute("SELECT id FROM centers LIMIT 1"); center = cur.fetchone()
+    if not center:
+        await q.edit_message_text("Nessun centro configurato."); con.close(); return
+    center_id = center["id"]
+    cur.execute(
+        "SELECT code, title, duration_minutes FROM services WHERE center_id=? AND gender=? AND category=? ORDER BY title",
+        (center_id, gender, category)
+    )
+    services = cur.fetchall(); kb = []
+    for s in services:
+        kb.append([InlineKeyboardButton(f"{s['title']} ({s['duration_minutes']}m)", callback_data=f"full_svc_{s['code']}")])
+    kb.append([InlineKeyboardButton("⬅️ Indietro", callback_data=f"full_gender_{gender}")])
+    await q.edit_message_text("Scegli un trattamento:", reply_markup=InlineKeyboardMarkup(kb)); con.close()
+
+@FULL_ROUTES.route("full_home", exact=True)
+async def FULL_route_home(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    q = update.callback_query
+    kb = [
+        [InlineKeyboardButton("👩 Donna", callback_data="full_gender_Donna"), InlineKeyboardButton("👨 Uomo", callback_data="full_gender_Uomo")],
+        [InlineKeyboardButton("📋 Le mie prenotazioni", callback_data="full_my_bookings")],
+    ]
+    if FULL_is_admin(q.from_user.id):
+        kb.append([InlineKeyboardButton("📊 Statistiche", callback_data="full_stats_menu")])
+    await q.edit_message_text("Menu principale:", reply_markup=InlineKeyboardMarkup(kb))
+
+@FULL_ROUTES.route("full_svc_", name="service")
+async def FULL_route_service(update: Update, context: ContextTypes.DEFAULT_TYPE, svc_code: str):
+    q = update.callback_query
+    # Salva svc_code in context per eventuali ritorni
+    context.user_data["full_svc_code"] = svc_code
+    con = FULL_db_conn()
+    cur = con.cursor()
+    cur.execute("SELECT duration_minutes, title FROM services WHERE code=?", (svc_code,))
+    svc_row = cur.fetchone()
+    duration_minutes = svc_row["duration_minutes"] if svc_row and svc_row["duration_minutes"] else SLOT_MINUTES
+    context.user_data["full_service_duration"] = duration_minutes
+    context.user_data["full_service_title"] = svc_row["title"] if svc_row and svc_row["title"] else svc_code
+    cur.execute("SELECT id, name FROM operators ORDER BY name")
+    ops = cur.fetchall()
+    kb = []
+    for op in ops:
+        kb.append([InlineKeyboardButton(f"{op['name']}", callback_data=f"full_op_{op['id']}_svc_{svc_code}")])
+    # Il pulsante indietro deve tornare alla categoria - dobbiamo recuperare il gender
+    # Per ora torniamo all'home
+    kb.append([InlineKeyboardButton("⬅️ Indietro", callback_data="full_home")])
+    await q.edit_message_text("Scegli l'operatrice:", reply_markup=InlineKeyboardMarkup(kb))
+    con.close()
+
+@FULL_ROUTES.route("full_op_", parse=fields(str, str, sep="_svc_"), name="operator")
+async def FULL_route_operator(update: Update, context: ContextTypes.DEFAULT_TYPE, op_id: str, svc_code: str):
+    q = update.callback_query
+    # Salva in context per i callback successivi
+    context.user_data["full_op_id"] = op_id
+    context.user_data["full_svc_code"] = svc_code
+    # Mostra calendario grafico del mese corrente
+    today = date.today()
+    msg, markup = FULL_calendar_month_view(today.year, today.month, op_id, svc_code)
+    await edit_if_changed(q, msg, reply_markup=markup, parse_mode=ParseMode.MARKDOWN)
+    PREFETCH.after_render(FULL_calendar_month_view, today.year, today.month, op_id, svc_code)
+
+# Navigazione calendario (callback compatto fc_YYYY_MM)
+@FULL_ROUTES.route("fc_", parse=fields(int, int), name="calendar")
+async def FULL_route_calendar(update: Update, context: ContextTypes.DEFAULT_TYPE, year: int, month: int):
+    q = update.callback_query
+    # Recupera op_id e svc_code da context
+    op_id = context.user_data.get("full_op_id")
+    svc_code = context.user_data.get("full_svc_code")
+    logger.debug("[FULL] fc_ callback: op_id=%s svc_code=%s year=%s month=%s", op_id, svc_code, year, month)
+    if not op_id or not svc_code:
+        await q.edit_message_text("Sessione scaduta. Usa /start per ricominciare.")
         return
-    # Selezione profilo: Donna/Uomo
-    if data.startswith("full_gender_"):
-        gender = data.split("full_gender_")[1]
-        con = FULL_db_conn(); cur = con.cursor(); cur.execute("SELECT id FROM centers LIMIT 1"); center = cur.fetchone()
-        if not center:
-            await q.edit_message_text("Nessun centro configurato."); con.close(); return
-        center_id = center["id"]
-        cur.execute("SELECT DISTINCT category FROM services WHERE center_id=? AND gender=? ORDER BY category", (center_id, gender))
-        cats = [r[0] for r in cur.fetchall()]
-        # Aggiungi emoji alle categorie
-        kb = [[InlineKeyboardButton(FULL_category_emoji(cat), callback_data=f"full_cat_{gender}|{cat}")] for cat in cats]
-        kb.append([InlineKeyboardButton("⬅️ Indietro", callback_data="full_home")])
-        gender_emoji = "👩" if gender == "Donna" else "👨"
-        await q.edit_message_text(f"Profilo: {gender_emoji} {gender}\nScegli una categoria:", reply_markup=InlineKeyboardMarkup(kb))
-        con.close(); return
-    # Selezione categoria → servizi
-    if data.startswith("full_cat_"):
-        payload = data[len("full_cat_"):]
-        if "|" not in payload:
-            await q.edit_message_text("Categoria non valida."); return
-        gender, category = payload.split("|", 1)
-        con = FULL_db_conn(); cur = con.cursor(); cur.execute("SELECT id FROM centers LIMIT 1"); center = cur.fetchone()
-        if not center:
-            await q.edit_message_text("Nessun centro configurato."); con.close(); return
-        center_id = center["id"]
-        cur.execute(
-            "SELECT code, title, duration_minutes FROM services WHERE center_id=? AND gender=? AND category=? ORDER BY title",
-            (center_id, gender, category)
-        )
-        services = cur.fetchall(); kb = []
-        for s in services:
-            kb.append([InlineKeyboardButton(f"{s['title']} ({s['duration_minutes']}m)", callback_data=f"full_svc_{s['code']}")])
-        kb.append([InlineKeyboardButton("⬅️ Indietro", callback_data=f"full_gender_{gender}")])
-        await q.edit_message_text("Scegli un trattamento:", reply_markup=InlineKeyboardMarkup(kb)); con.close(); return
-    if data == "full_home":
-        kb = [
-            [InlineKeyboardButton("👩 Donna", callback_data="full_gender_Donna"), InlineKeyboardButton("👨 Uomo", callback_data="full_gender_Uomo")],
-            [InlineKeyboardButton("📋 Le mie prenotazioni", callback_data="full_my_bookings")],
-        ]
-        if FULL_is_admin(q.from_user.id):
-            kb.append([InlineKeyboardButton("📊 Statistiche", callback_data="full_stats_menu")])
-        await q.edit_message_text("Menu principale:", reply_markup=InlineKeyboardMarkup(kb)); return
-    if data.startswith("full_svc_"):
-        svc_code = data.split("full_svc_")[1]
-        # Salva svc_code in context per eventuali ritorni
-        context.user_data["full_svc_code"] = svc_code
-        con = FULL_db_conn()
-        cur = con.cursor()
-        cur.execute("SELECT duration_minutes, title FROM services WHERE code=?", (svc_code,))
-        svc_row = cur.fetchone()
-        duration_minutes = svc_row["duration_minutes"] if svc_row and svc_row["duration_minutes"] else SLOT_MINUTES
-        context.user_data["full_service_duration"] = duration_minutes
-        context.user_data["full_service_title"] = svc_row["title"] if svc_row and svc_row["title"] else svc_code
-        cur.execute("SELECT id, name FROM operators ORDER BY name")
-        ops = cur.fetchall()
-        kb = []
-        for op in ops:
-            kb.append([InlineKeyboardButton(f"{op['name']}", callback_data=f"full_op_{op['id']}_svc_{svc_code}")])
-        # Il pulsante indietro deve tornare alla categoria - dobbiamo recuperare il gender
-        # Per ora torniamo all'home
-        kb.append([InlineKeyboardButton("⬅️ Indietro", callback_data="full_home")])
-        await q.edit_message_text("Scegli l'operatrice:", reply_markup=InlineKeyboardMarkup(kb))
-        con.close()
+    if not await NAVIGATION.settle(q):
         return
-    if data.startswith("full_op_") and "_svc_" in data:
-        parts = data.split("_svc_")
-        op_part = parts[0]
-        svc_code = parts[1]
-        op_id = op_part[len("full_op_"):]
-        # Salva in context per i callback successivi
-        context.user_data["full_op_id"] = op_id
-        context.user_data["full_svc_code"] = svc_code
-        # Mostra calendario grafico del mese corrente
-        today = date.today()
-        msg, kb = FULL_show_calendar_month(today.year, today.month, op_id, svc_code)
-        await q.edit_message_text(msg, reply_markup=InlineKeyboardMarkup(kb), parse_mode=ParseMode.MARKDOWN)
+    msg, markup = await asyncio.to_thread(FULL_calendar_month_view, year, month, op_id, svc_code)
+    if NAVIGATION.superseded(q):
         return
-    # Navigazione calendario (callback compatto fc_YYYY_MM)
-    if data.startswith("fc_"):
-        # Recupera op_id e svc_code da context
-        op_id = context.user_data.get("full_op_id")
-        svc_code = context.user_data.get("full_svc_code")
-        logger.info(f"[FULL] fc_ callback: op_id={op_id}, svc_code={svc_code}, data={data}")
-        if not op_id or not svc_code:
-            await q.edit_message_text("Sessione scaduta. Usa /start per ricominciare.")
-            return
-        parts = data[3:].split("_")
-        year, month = int(parts[0]), int(parts[1])
-        msg, kb = FULL_show_calendar_month(year, month, op_id, svc_code)
-        await q.edit_message_text(msg, reply_markup=InlineKeyboardMarkup(kb), parse_mode=ParseMode.MARKDOWN)
+    await edit_if_changed(q, msg, reply_markup=markup, parse_mode=ParseMode.MARKDOWN)
+    PREFETCH.after_render(FULL_calendar_month_view, year, month, op_id, svc_code)
+
+# Selezione data (callback compatto fd_YYYY-MM-DD)
+@FULL_ROUTES.route("fd_", name="day")
+async def FULL_route_day(update: Update, context: ContextTypes.DEFAULT_TYPE, date_str: str):
+    q = update.callback_query
+    # Recupera op_id e svc_code da context
+    op_id = context.user_data.get("full_op_id")
+    svc_code = context.user_data.get("full_svc_code")
+    logger.debug("[FULL] fd_ callback: op_id=%s svc_code=%s date=%s", op_id, svc_code, date_str)
+    if not op_id or not svc_code:
+        await q.edit_message_text("Sessione scaduta. Usa /start per ricominciare.")
         return
-    # Selezione data (callback compatto fd_YYYY-MM-DD)
-    # Selezione data (callback compatto fd_YYYY-MM-DD)
-    if data.startswith("fd_"):
-        date_str = data[3:]  # Rimuove "fd_"
-        # Recupera op_id e svc_code da context
-        op_id = context.user_data.get("full_op_id")
-        svc_code = context.user_data.get("full_svc_code")
-        logger.info(f"[FULL] fd_ callback: op_id={op_id}, svc_code={svc_code}, date={date_str}")
-        if not op_id or not svc_code:
-            await q.edit_message_text("Sessione scaduta. Usa /start per ricominciare.")
-            return
-        # Salva la data scelta per eventuale ritorno
-        context.user_data["full_date_str"] = date_str
-        # Mostra gli orari disponibili
-        duration_minutes = context.user_data.get("full_service_duration")
-        if duration_minutes is None:
-            duration_minutes = FULL_get_service_duration(svc_code)
-            context.user_data["full_service_duration"] = duration_minutes
-        slots = FULL_generate_slots_for_operator(op_id, date.fromisoformat(date_str), duration_minutes)
-        kb = []
-        for t in slots:
-            kb.append([InlineKeyboardButton(t, callback_data=f"ft_{date_str}_{t}")])
-        if not kb:
-            await q.edit_message_text("Nessun orario disponibile per questo giorno.")
-            return
-        # Aggiungi pulsante Indietro per tornare al calendario
-        d = date.fromisoformat(date_str)
-        kb.append([InlineKeyboardButton("⬅️ Indietro al calendario", callback_data=f"fc_{d.year}_{d.month}")])
-        await q.edit_message_text("Scegli orario:", reply_markup=InlineKeyboardMarkup(kb))
+    # Salva la data scelta per eventuale ritorno
+    context.user_data["full_date_str"] = date_str
+    # Mostra gli orari disponibili
+    duration_minutes = context.user_data.get("full_service_duration")
+    if duration_minutes is None:
+        duration_minutes = FULL_get_service_duration(svc_code)
+        context.user_data["full_service_duration"] = duration_minutes
+    slots = FULL_generate_slots_for_operator(op_id, date.fromisoformat(date_str), duration_minutes)
+    kb = []
+    for t in slots:
+        kb.append([InlineKeyboardButton(t, callback_data=f"ft_{date_str}_{t}")])
+    if not kb:
+        await q.edit_message_text("Nessun orario disponibile per questo giorno.")
         return
-    # Selezione orario (callback compatto ft_YYYY-MM-DD_HH:MM)
-    if data.startswith("ft_"):
-        parts = data[3:].split("_")
-        date_str = parts[0]
-        time_str = parts[1]
-        # Recupera op_id e svc_code da context
-        op_id = context.user_data.get("full_op_id")
-        svc_code = context.user_data.get("full_svc_code")
-        if not op_id or not svc_code:
-            await q.edit_message_text("Sessione scaduta. Usa /start per ricominciare.")
-            return
-        # Crea prenotazione
-        user = update.effective_user
-        client_id = FULL_find_or_create_client(user.id, name=user.full_name)
-        con = FULL_db_conn()
-        cur = con.cursor()
-        cur.execute("SELECT duration_minutes FROM services WHERE code=?", (svc_code,))
-        svc = cur.fetchone()
-        duration = svc["duration_minutes"] if svc else 30
-        
-        if not FULL_is_slot_available(op_id, date_str, time_str):
-            await q.answer("Slot non più disponibile.", show_alert=True)
-            con.close()
-            return
-        
-        center_id = 1
-        cur.execute("SELECT id FROM centers LIMIT 1")
-        r = cur.fetchone()
-        center_id = r["id"] if r else 1
-        bid = FULL_add_booking(center_id, op_id, svc_code, client_id, date_str, time_str, duration)
-        
-        # Recupera dettagli per il messaggio
-        cur.execute("SELECT title, price FROM services WHERE code=?", (svc_code,))
-        svc_row = cur.fetchone()
-        svc_title = svc_row["title"] if svc_row else svc_code
-        svc_price = svc_row["price"] if svc_row and svc_row["price"] else None
-        
-        # Recupera nome operatore
-        cur.execute("SELECT name FROM operators WHERE id=?", (op_id,))
-        op_row = cur.fetchone()
-        op_name = op_row["name"] if op_row else None
+    # Aggiungi pulsante Indietro per tornare al calendario
+    d = date.fromisoformat(date_str)
+    kb.append([InlineKeyboardButton("⬅️ Indietro al calendario", callback_data=f"fc_{d.year}_{d.month}")])
+    await q.edit_message_text("Scegli orario:", reply_markup=InlineKeyboardMarkup(kb))
+
+# Selezione orario (callback compatto ft_YYYY-MM-DD_HH:MM)
+@FULL_ROUTES.route("ft_", parse=fields(str, str), name="time", dedup=True)
+async def FULL_route_time(update: Update, context: ContextTypes.DEFAULT_TYPE, date_str: str, time_str: str):
+    q = update.callback_query
+    # Recupera op_id e svc_code da context
+    op_id = context.user_data.get("full_op_id")
+    svc_code = context.user_data.get("full_svc_code")
+    if not op_id or not svc_code:
+        await q.edit_message_text("Sessione scaduta. Usa /start per ricominciare.")
+        return
+    # Crea prenotazione
+    user = update.effective_user
+    client_id = FULL_find_or_create_client(user.id, name=user.full_name)
+    con = FULL_db_conn()
+    cur = con.cursor()
+    cur.execute("SELECT duration_minutes FROM services WHERE code=?", (svc_code,))
+    svc = cur.fetchone()
+    duration = svc["duration_minutes"] if svc else 30
+
+    if not FULL_is_slot_available(op_id, date_str, time_str, duration):
+        await q.answer("Slot non più disponibile.", show_alert=True)
         con.close()
-        
-        # Usa modulo UX per messaggio migliorato
-        booking_info = {
-            'date': date_str,
-            'time': time_str,
-            'service': svc_title,
-            'operator': op_name,
-            'price': svc_price,
-            'booking_id': bid
-        }
-        
-        # Pulsanti per navigazione
-        kb = [
-            [InlineKeyboardButton("📋 Le mie prenotazioni", callback_data="full_my_bookings")],
-            [InlineKeyboardButton("🏠 Menu principale", callback_data="full_home")]
-        ]
-        
-        await send_confirm(update, context, booking_info, via_callback=True, 
-                          reply_markup=InlineKeyboardMarkup(kb), skip_warm_message=True)
         return
-    if data == "full_my_bookings":
-        user = update.effective_user
-        con = FULL_db_conn(); cur = con.cursor()
-        cur.execute("SELECT id FROM clients WHERE tg_id=?", (user.id,))
-        client_row = cur.fetchone()
-        client_id = client_row["id"] if client_row else None
 
-        cur.execute(
-            """
-            SELECT b.id, b.date, b.time, b.service_code, b.duration, b.operator_id, s.title
-            FROM bookings b
-            LEFT JOIN services s ON b.service_code = s.code
-            WHERE b.status='CONFIRMED' AND (b.client_id=? OR b.user_id=?)
-            ORDER BY b.date, b.time
-            """,
-            (client_id, user.id),
-        )
-        bookings = cur.fetchall()
+    center_id = 1
+    cur.execute("SELECT id FROM centers LIMIT 1")
+    r = cur.fetchone()
+    center_id = r["id"] if r else 1
+    bid = FULL_add_booking(center_id, op_id, svc_code, client_id, date_str, time_str, duration)
 
-        cur.execute(
-            """
-            SELECT w.id, w.date, w.service_code
-            FROM waitlist w
-            WHERE (w.client_id=? OR w.user_id=?)
-            ORDER BY w.date, w.id
-            """,
-            (client_id, user.id),
-        )
-        waitlist_rows = cur.fetchall(); con.close()
+    # Recupera dettagli per il messaggio
+    cur.execute("SELECT title, price FROM services WHERE code=?", (svc_code,))
+    svc_row = cur.fetchone()
+    svc_title = svc_row["title"] if svc_row else svc_code
+    svc_price = svc_row["price"] if svc_row and svc_row["price"] else None
 
-        if not bookings and not waitlist_rows:
-            await update.callback_query.edit_message_text("Non hai prenotazioni o liste d'attesa attive.")
-            return
+    # Recupera nome operatore
+    cur.execute("SELECT name FROM operators WHERE id=?", (op_id,))
+    op_row = cur.fetchone()
+    op_name = op_row["name"] if op_row else None
+    con.close()
 
-        lines: list[str] = []
-        if bookings:
-            lines.append(f"*📌 Prenotazioni confermate ({len(bookings)}):*")
-            for row in bookings:
-                bid, dstr, tstr, svc_code, duration, op_id, title = row
-                titolo = title or svc_code
-                giorno = datetime.strptime(dstr, "%Y-%m-%d").strftime("%d/%m/%Y")
-                lines.append(f"• ID {bid}: {giorno} {tstr} – {titolo} ({duration} min) – {operator_name(op_id)}")
-
-        if waitlist_rows:
-            if bookings:
-                lines.append("")
-            lines.append(f"*⏳ Liste d'attesa ({len(waitlist_rows)}):*")
-            for wid, dstr, svc_code in waitlist_rows:
-                svc = find_service_by_code(svc_code)
-                svc_name = svc["nome"] if svc else svc_code
-                giorno = datetime.strptime(dstr, "%Y-%m-%d").strftime("%d/%m/%Y")
-                lines.append(f"• W{wid}: {svc_name} – {giorno}")
-
-        kb_resp = [[InlineKeyboardButton("🏠 Menu", callback_data="full_home")]]
-        await update.callback_query.edit_message_text("\n".join(lines), reply_markup=InlineKeyboardMarkup(kb_resp), parse_mode=ParseMode.MARKDOWN)
+    # Usa modulo UX per messaggio migliorato
+    booking_info = {
+        'date': date_str,
+        'time': time_str,
+        'service': svc_title,
+        'operator': op_name,
+        'price': svc_price,
+        'booking_id': bid
+    }
+
+    # Pulsanti per navigazione
+    kb = [
+        [InlineKeyboardButton("📋 Le mie prenotazioni", callback_data="full_my_bookings")],
+        [InlineKeyboardButton("🏠 Menu principale", callback_data="full_home")]
+    ]
+
+    await send_confirm(update, context, booking_info, via_callback=True, 
+                      reply_markup=InlineKeyboardMarkup(kb), skip_warm_message=True)
+
+@FULL_ROUTES.route("full_my_bookings", exact=True)
+async def FULL_route_my_bookings(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    con = FULL_db_conn(); cur = con.cursor()
+    cur.execute("SELECT id FROM clients WHERE tg_id=?", (user.id,))
+    client_row = cur.fetchone()
+    client_id = client_row["id"] if client_row else None
+
+    cur.execute(
+        """
+        SELECT b.id, b.date, b.time, b.service_code, b.duration, b.operator_id, s.title
+        FROM bookings b
+        LEFT JOIN services s ON b.service_code = s.code
+        WHERE b.status='CONFIRMED' AND (b.client_id=? OR b.user_id=?)
+        ORDER BY b.date, b.time
+        """,
+        (client_id, user.id),
+    )
+    bookings = cur.fetchall()
+
+    cur.execute(
+        """
+        SELECT w.id, w.date, w.service_code
+        FROM waitlist w
+        WHERE (w.client_id=? OR w.user_id=?)
+        ORDER BY w.date, w.id
+        """,
+        (client_id, user.id),
+    )
+    waitlist_rows = cur.fetchall(); con.close()
+
+    if not bookings and not waitlist_rows:
+        await update.callback_query.edit_message_text("Non hai prenotazioni o liste d'attesa attive.")
         return
-    if data == "full_stats_menu":
-        if not FULL_is_admin(q.from_user.id):
-            await q.answer("Accesso negato", show_alert=True)
-            return
-        kb = [
-            [InlineKeyboardButton("📊 Statistiche oggi", callback_data="full_stats_day")],
-            [InlineKeyboardButton("📈 Statistiche settimana", callback_data="full_stats_week")],
-            [InlineKeyboardButton("⬅️ Indietro", callback_data="full_home")],
-        ]
-        await q.edit_message_text("Scegli il report statistico:", reply_markup=InlineKeyboardMarkup(kb))
+
+    lines: list[str] = []
+    if bookings:
+        lines.append(f"*📌 Prenotazioni confermate ({len(bookings)}):*")
+        for row in bookings:
+            bid, dstr, tstr, svc_code, duration, op_id, title = row
+            titolo = title or svc_code
+            giorno = datetime.strptime(dstr, "%Y-%m-%d").strftime("%d/%m/%Y")
+            lines.append(f"• ID {bid}: {giorno} {tstr} – {titolo} ({duration} min) – {operator_name(op_id)}")
+
+    if waitlist_rows:
+        if bookings:
+            lines.append("")
+        lines.append(f"*⏳ Liste d'attesa ({len(waitlist_rows)}):*")
+        for wid, dstr, svc_code in waitlist_rows:
+            svc = find_service_by_code(svc_code)
+            svc_name = svc["nome"] if svc else svc_code
+            giorno = datetime.strptime(dstr, "%Y-%m-%d").strftime("%d/%m/%Y")
+            lines.append(f"• W{wid}: {svc_name} – {giorno}")
+
+    kb_resp = [[InlineKeyboardButton("🏠 Menu", callback_data="full_home")]]
+    await update.callback_query.edit_message_text("\n".join(lines), reply_markup=InlineKeyboardMarkup(kb_resp), parse_mode=ParseMode.MARKDOWN)
+
+@FULL_ROUTES.route("full_stats_menu", exact=True)
+async def FULL_route_stats_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    q = update.callback_query
+    if not FULL_is_admin(q.from_user.id):
+        await q.answer("Accesso negato", show_alert=True)
         return
-    if data == "full_stats_day":
-        if not FULL_is_admin(q.from_user.id):
-            await q.answer("Accesso negato", show_alert=True)
-            return
-        report = get_daily_stats_text()
-        kb = InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Indietro", callback_data="full_stats_menu")]])
-        if not report:
-            await q.edit_message_text("Nessuna prenotazione oggi.", reply_markup=kb)
-        else:
-            await q.edit_message_text(report, reply_markup=kb, parse_mode=ParseMode.MARKDOWN)
+    kb = [
+        [InlineKeyboardButton("📊 Statistiche oggi", callback_data="full_stats_day")],
+        [InlineKeyboardButton("📈 Statistiche settimana", callback_data="full_stats_week")],
+        [InlineKeyboardButton("⬅️ Indietro", callback_data="full_home")],
+    ]
+    await q.edit_message_text("Scegli il report statistico:", reply_markup=InlineKeyboardMarkup(kb))
+
+@FULL_ROUTES.route("full_stats_day", exact=True)
+async def FULL_route_stats_day(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    q = update.callback_query
+    if not FULL_is_admin(q.from_user.id):
+        await q.answer("Accesso negato", show_alert=True)
         return
-    if data == "full_stats_week":
-        if not FULL_is_admin(q.from_user.id):
-            await q.answer("Accesso negato", show_alert=True)
-            return
-        report = get_weekly_stats_text()
-        kb = InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Indietro", callback_data="full_stats_menu")]])
-        if not report:
-            await q.edit_message_text("Nessuna prenotazione registrata questa settimana.", reply_markup=kb)
-        else:
-            await q.edit_message_text(report, reply_markup=kb, parse_mode=ParseMode.MARKDOWN)
+    report = get_daily_stats_text()
+    kb = InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Indietro", callback_data="full_stats_menu")]])
+    if not report:
+        await q.edit_message_text("Nessuna prenotazione oggi.", reply_markup=kb)
+    else:
+        await q.edit_message_text(report, reply_markup=kb, parse_mode=ParseMode.MARKDOWN)
+
+@FULL_ROUTES.route("full_stats_week", exact=True)
+async def FULL_route_stats_week(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    q = update.callback_query
+    if not FULL_is_admin(q.from_user.id):
+        await q.answer("Accesso negato", show_alert=True)
         return
-    if data == "full_cancel":
-        await update.callback_query.edit_message_text("Operazione annullata. Usa /start."); return
-    await update.callback_query.answer()
+    report = get_weekly_stats_text()
+    kb = InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Indietro", callback_data="full_stats_menu")]])
+    if not report:
+        await q.edit_message_text("Nessuna prenotazione registrata questa settimana.", reply_markup=kb)
+    else:
+        await q.edit_message_text(report, reply_markup=kb, parse_mode=ParseMode.MARKDOWN)
+
+@FULL_ROUTES.route("full_cancel", exact=True)
+async def FULL_route_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.callback_query.edit_message_text("Operazione annullata. Usa /start.")
+
+@FULL_ROUTES.fallback
+async def FULL_route_fallback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Callback sconosciuto: la query è già stata confermata da dispatch
+    return None
 
 async def FULL_admin_today(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id != FULL_ADMIN_CHAT_ID:
@@ -2409,7 +2458,7 @@ async def FULL_admin_today(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def FULL_export_csv_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id != FULL_ADMIN_CHAT_ID:
         await update.message.reply_text("Accesso negato."); return
-    con = FULL_db_conn(); cur = con.cursor(); cur.execute("SELECT * FROM bookings ORDER BY date,time"); rows = cur.fetchall(); si = StringIO(); si.write("id,center_id,operator_id,service_code,client_id,date,time,duration,status,created_at\n");
+    con = FULL_db_conn(); cur = con.cursor(); cur.execute(f"SELECT * FROM {bookings_source(con, None)} ORDER BY date,time"); rows = cur.fetchall(); si = StringIO(); si.write("id,center_id,operator_id,service_code,client_id,date,time,duration,status,created_at\n");
     for r in rows: si.write(f"{r['id']},{r['center_id']},{r['operator_id']},{r['service_code']},{r['client_id']},{r['date']},{r['time']},{r['duration']},{r['status']},{r['created_at']}\n"); si.seek(0); await update.message.reply_document(document=si.getvalue().encode("utf-8"), filename="bookings_export.csv"); con.close()
 
 async def FULL_ping_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -2436,7 +2485,9 @@ def FULL_build_application():
     from stats_module import stat_giorno, stat_settimana
     
     # Crea Application normalmente - il problema era nella versione di PTB
-    app = Application.builder().token(TOKEN).build()
+    app = build_app_builder(load_token()).build()
+    bind_runtime(app)
+    FULL_install_report_jobs(app)
     app.add_handler(CommandHandler("start", FULL_start_cmd))
     app.add_handler(CallbackQueryHandler(FULL_callback_router, pattern=r"^(full_|fd_|fc_|ft_)"))
     app.add_handler(CommandHandler("admin_today", FULL_admin_today))
@@ -2445,6 +2496,11 @@ def FULL_build_application():
     app.add_handler(CommandHandler("stat_giorno", stat_giorno))
     app.add_handler(CommandHandler("stat_settimana", stat_settimana))
     app.add_handler(CommandHandler("debug_config", debug_config_cmd))
+    app.add_handler(CommandHandler("metrics", metrics_cmd))
+    app.add_handler(CommandHandler("slow_queries", slow_queries_cmd))
+    app.add_handler(CommandHandler("chiusura", closure_cmd))
+    app.add_handler(CommandHandler("orario_speciale", special_hours_cmd))
+    app.add_handler(CommandHandler("eccezioni", exceptions_cmd))
     # Allinea comandi di servizio
     app.add_handler(CommandHandler("ping", FULL_ping_cmd))
     app.add_handler(CommandHandler("version", FULL_version_cmd))
@@ -2468,12 +2524,22 @@ async def FULL_main_async():
 
 
 def main():
+    # Log JSON su file a rotazione, scritto da un thread dedicato (logging_module)
+    setup_logging()
+    # /metrics locale (METRICS_PORT); con l'ingress webhook è servito anche sulla sua porta
+    if METRICS_ENABLED:
+        start_metrics_server()
     # Se richiesto, esegui la variante FULL integrata
     try:
         variant = os.environ.get("BOT_VARIANT", "minimal").strip().lower()
     except Exception:
         variant = "minimal"
     if variant == "full":
+        if CLUSTER_MODE:
+            # La Full riceve gli update in polling: niente webhook condiviso né lease del leader
+            # (i job leader_only, es. report e archivio, non partirebbero mai)
+            logger.error("CLUSTER_MODE non è supportato con BOT_VARIANT=full: usa la variante minimal per il cluster.")
+            raise SystemExit(1)
         # Inizializza DB e dati
         FULL_init_db()
         ensure_unified_schema()
@@ -2487,6 +2553,8 @@ def main():
             await FULL_notify_admin_startup(app)
             logger.info("PrenotaFacile FULL: avvio polling...")
             await app.initialize()
+            # post_init/post_stop non vengono invocati fuori da run_polling
+            await on_application_start(app)
             await app.start()
             await app.updater.start_polling(drop_pending_updates=True)
             # Attendi indefinitamente
@@ -2496,6 +2564,7 @@ def main():
             finally:
                 await app.updater.stop()
                 await app.stop()
+                await on_application_stop(app)
                 await app.shutdown()
         
         # Usa asyncio.run per PTB 21+ e Python 3.13
@@ -2508,16 +2577,22 @@ def main():
     ensure_unified_schema()
     migrate_db()
     ensure_sample_data()
-    app = Application.builder().token(TOKEN).build()
+    if CLUSTER_MODE:
+        # DB condiviso tra worker: WAL per letture concorrenti, tabelle lease/eventi
+        enable_wal()
+        ensure_cluster_tables()
+    token = load_token()
+    app = build_app_builder(token).build()
+    bind_runtime(app)
     app.add_handler(build_conversation())
     app.add_handler(CallbackQueryHandler(confirm_router, pattern=r"^confirm_(yes|no)$"))
     # Catch-all di sicurezza per i principali callback se uscissi dalla Conversation
     app.add_handler(CallbackQueryHandler(menu_callback_router, pattern=r"^(gender_|cat_|svc_|op_|cal_|pickmonths_|day_|time_|waitlist_join|accept_slot_|acsl_|cancel_|remove_waitlist_)"))
     # Admin callback router
     app.add_handler(CallbackQueryHandler(admin_cb_router, pattern=r"^admin_"))
-    app.add_handler(CommandHandler("help", lambda u,c: asyncio.create_task(u.message.reply_text("Usa /start"))))
-    app.add_handler(CommandHandler("mie_prenotazioni", lambda u,c: asyncio.create_task(show_my_bookings(u,c))))
-    app.add_handler(CommandHandler("privacy", lambda u,c: asyncio.create_task(privacy_cmd(u,c))))
+    app.add_handler(CommandHandler("help", help_cmd))
+    app.add_handler(CommandHandler("mie_prenotazioni", show_my_bookings))
+    app.add_handler(CommandHandler("privacy", privacy_cmd))
     # Ping semplice per testare rapidamente la responsività
     async def ping_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         try:
@@ -2529,15 +2604,24 @@ def main():
                     await context.application.bot.send_message(cid, "pong")
         except Exception:
             logger.exception("/ping failed")
-    app.add_handler(CommandHandler("ping", lambda u,c: asyncio.create_task(ping_cmd(u,c))))
-    app.add_handler(CommandHandler("test_reminder", lambda u,c: asyncio.create_task(test_reminder_cmd(u,c))))
-    app.add_handler(CommandHandler("test_after_confirm", lambda u,c: asyncio.create_task(test_after_confirm_cmd(u,c))))
-    app.add_handler(CommandHandler("version", lambda u,c: asyncio.create_task(version_cmd(u,c))))
-    app.add_handler(CommandHandler("mode", lambda u,c: asyncio.create_task(mode_cmd(u,c))))
-    app.add_handler(CommandHandler("debug_config", lambda u,c: asyncio.create_task(debug_config_cmd(u,c))))
-    app.add_handler(CommandHandler("admin", lambda u,c: asyncio.create_task(admin_cmd(u,c))))
-    app.add_handler(CommandHandler("purge_day", lambda u,c: asyncio.create_task(purge_day_cmd(u,c))))
-    app.add_handler(CommandHandler("process_waitlist", lambda u,c: asyncio.create_task(process_waitlist_cmd(u,c))))
+    app.add_handler(CommandHandler("ping", ping_cmd))
+    app.add_handler(CommandHandler("test_reminder", test_reminder_cmd))
+    app.add_handler(CommandHandler("test_after_confirm", test_after_confirm_cmd))
+    app.add_handler(CommandHandler("version", version_cmd))
+    app.add_handler(CommandHandler("mode", mode_cmd))
+    app.add_handler(CommandHandler("debug_config", debug_config_cmd))
+    app.add_handler(CommandHandler("admin", admin_cmd))
+    app.add_handler(CommandHandler("purge_day", purge_day_cmd))
+    app.add_handler(CommandHandler("disdici_periodo", cancel_period_cmd))
+    app.add_handler(CommandHandler("process_waitlist", process_waitlist_cmd))
+    app.add_handler(CommandHandler("cluster", cluster_cmd))
+    app.add_handler(CommandHandler("metrics", metrics_cmd))
+    app.add_handler(CommandHandler("slow_queries", slow_queries_cmd))
+    app.add_handler(CommandHandler("chiusura", closure_cmd))
+    app.add_handler(CommandHandler("orario_speciale", special_hours_cmd))
+    app.add_handler(CommandHandler("eccezioni", exceptions_cmd))
+    if CLUSTER_MODE:
+        install_cluster_jobs(app)
     # Error handler per diagnosticare blocchi imprevisti
     async def _err_handler(update: object, context: ContextTypes.DEFAULT_TYPE):
         logger.exception("Unhandled error", exc_info=context.error)
@@ -2549,30 +2633,60 @@ def main():
     logger.info("PrenotaFacile minimal avviato. %s", BUILD_VERSION)
     logger.info("Config: TEST_MODE=%s REMINDER_DELAY=%ss", TEST_MODE, REMINDER_DELAY)
     force_webhook = os.environ.get("FORCE_WEBHOOK", "0").lower() in {"1","true","yes"}
+    if CLUSTER_MODE and not (force_webhook and os.environ.get("PUBLIC_URL")):
+        # Il polling non si può condividere tra processi (getUpdates in conflitto)
+        logger.error("CLUSTER_MODE richiede FORCE_WEBHOOK=1 e PUBLIC_URL (URL del reverse proxy).")
+        raise SystemExit(1)
+    if CLUSTER_MODE and not CLUSTER_CHAT_AFFINITY:
+        # Stati ASK_*, user_data, DEDUP e NAVIGATION sono del processo: un utente che passa da
+        # un worker all'altro perderebbe la prenotazione a metà e l'ordine dei suoi update
+        logger.error("CLUSTER_MODE richiede un proxy con affinità per utente (hash sull'id del mittente) "
+                     "e CLUSTER_CHAT_AFFINITY=1: vedi README, sezione Multi-worker.")
+        raise SystemExit(1)
     if force_webhook:
         # Avvio in webhook con ngrok (se disponibile)
         try:
-            from pyngrok import ngrok
             port = int(os.environ.get("WEBHOOK_PORT", "8080"))
             # Avvia tunnel
             public_url = os.environ.get("PUBLIC_URL")
             if not public_url:
+                from pyngrok import ngrok
                 auth = os.environ.get("NGROK_AUTHTOKEN")
                 if auth:
                     ngrok.set_auth_token(auth)
                 tunnel = ngrok.connect(port)
                 public_url = tunnel.public_url
-            webhook_url = f"{public_url}/{TOKEN}"
+            webhook_url = f"{public_url}/{token}"
             logger.info("Webhook URL: %s", webhook_url)
+            if env_flag("WEBHOOK_INGRESS"):
+                # Ingress locale: coda limitata, /healthz, /readyz, /queue (vedi ingress_module)
+                from ingress_module import run_webhook_ingress
+                try:
+                    asyncio.run(run_webhook_ingress(
+                        app,
+                        listen=os.environ.get("WEBHOOK_LISTEN", "0.0.0.0"),
+                        port=port,
+                        url_path=token,
+                        webhook_url=webhook_url,
+                        secret_token=os.environ.get("WEBHOOK_SECRET") or None,
+                        drop_pending_updates=not CLUSTER_MODE,
+                    ))
+                except KeyboardInterrupt:
+                    logger.info("Arresto manuale (ingress)")
+                return
             app.run_webhook(
                 listen="0.0.0.0",
                 port=port,
-                url_path=TOKEN,
+                url_path=token,
                 webhook_url=webhook_url,
-                drop_pending_updates=True,
+                # In cluster un worker che riparte non deve scartare gli update degli altri
+                drop_pending_updates=not CLUSTER_MODE,
             )
             return
         except Exception as e:
+            if CLUSTER_MODE:
+                logger.exception("Avvio webhook fallito in modalità cluster: %s", e)
+                raise SystemExit(1)
             logger.warning("Falling back to polling (webhook error): %s", e)
     
     app.run_polling()
@@ -0,0 +1,300 @@
+# -*- coding: utf-8 -*-
+"""
+Modulo calendar - cache delle tastiere dei calendari e modifiche dei messaggi senza doppioni.
+
+Un calendario mensile sono 40+ bottoni, ciascuno con la disponibilità del giorno. La
+tastiera renderizzata viene tenuta in una LRU con chiave (variante, operatore, servizio,
+durata, anno, mese, giorno corrente, versione della disponibilità): la versione è il
+contatore `availability_version` mantenuto da trigger sul DB, quindi ogni nuova
+prenotazione, disdetta o eccezione di calendario invalida le voci senza coordinazione.
+
+`NAVIGATION` fonde le raffiche di tocchi di navigazione (mese prec./succ.) sullo stesso
+messaggio: l'update processor le registra all'arrivo, prima che attendano il turno
+della chat, e ogni handler prima del calcolo e prima della modifica controlla di essere
+ancora l'ultimo tocco; quelli superati non calcolano né inviano nulla.
+
+`PREFETCH` precalcola in background i mesi adiacenti a quello appena mostrato, così il
+tocco successivo trova la tastiera già in cache. Lavora solo entro un budget globale
+(calcoli contemporanei e al minuto) e solo se il bot non è impegnato con altre chat.
+
+`edit_if_changed` salta le `edit_message_text` il cui testo e tastiera hanno la stessa
+impronta di quanto il messaggio mostra già (es. tocco sul mese corrente), risparmiando
+una chiamata alla Bot API e l'errore "message is not modified".
+"""
+import asyncio, logging, os, threading, time
+from collections import OrderedDict
+from datetime import date
+
+from telegram.error import BadRequest
+
+from metrics_module import CALENDAR_PREFETCH, EDITS_SKIPPED, NAVIGATION_COALESCED, cache_hit, cache_miss
+
+logger = logging.getLogger(__name__)
+
+CALENDAR_CACHE_SIZE = int(os.environ.get("CALENDAR_CACHE_SIZE", "512"))
+# Attesa (ms) prima di calcolare un mese, per lasciar arrivare i tocchi successivi; 0 = nessuna
+NAV_DEBOUNCE_MS = float(os.environ.get("NAV_DEBOUNCE_MS", "150"))
+# Callback di navigazione tra mesi (entrambe le varianti)
+NAV_PREFIXES = ("cal_", "fc_", "pickmonths_")
+# Precalcolo dei mesi adiacenti: attivo, calcoli contemporanei, calcoli al minuto, chat attive oltre cui rinunciare
+CALENDAR_PREFETCH_ENABLED = os.environ.get("CALENDAR_PREFETCH", "1").strip().lower() in {"1", "true", "yes", "on"}
+CALENDAR_PREFETCH_CONCURRENCY = int(os.environ.get("CALENDAR_PREFETCH_CONCURRENCY", "2"))
+CALENDAR_PREFETCH_PER_MINUTE = int(os.environ.get("CALENDAR_PREFETCH_PER_MINUTE", "60"))
+CALENDAR_PREFETCH_MAX_ACTIVE_CHATS = int(os.environ.get("CALENDAR_PREFETCH_MAX_ACTIVE_CHATS", "2"))
+
+
+class LRUCache:
+    """Dizionario limitato a ``maxsize`` voci, scarta la meno usata (thread-safe)."""
+
+    def __init__(self, maxsize: int, name: str | None = None):
+        self.maxsize = max(1, maxsize)
+        self.name = name
+        self._data: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            value = self._data.get(key, self)
+            if value is self:
+                if self.name:
+                    cache_miss(self.name)
+                return default
+            self._data.move_to_end(key)
+        if self.name:
+            cache_hit(self.name)
+        return value
+
+    def put(self, key, value) -> None:
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._data.pop(key, default)
+
+    def __contains__(self, key) -> bool:
+        with self._lock:
+            return key in self._data
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+
+# (testo, InlineKeyboardMarkup) per chiave di calendario
+CALENDARS = LRUCache(CALENDAR_CACHE_SIZE, "calendar")
+
+
+# Chiavi messe in cache dal precalcolo e non ancora lette da un utente
+_prefetched = LRUCache(CALENDAR_CACHE_SIZE)
+
+
+def cached_render(key, render, prefetch: bool = False):
+    """Restituisce ``render()`` dalla cache; ``key`` None (versione ignota) = nessuna cache.
+
+    Con ``prefetch`` la voce viene solo preparata: niente metriche di hit/miss, che
+    restano quelle viste dagli utenti.
+    """
+    if key is None:
+        return render()
+    if prefetch:
+        if key in CALENDARS:
+            CALENDAR_PREFETCH.inc("cached")
+            return None
+        CALENDARS.put(key, render())
+        _prefetched.put(key, True)
+        CALENDAR_PREFETCH.inc("computed")
+        return None
+    rendered = CALENDARS.get(key)
+    if rendered is None:
+        rendered = render()
+        CALENDARS.put(key, rendered)
+    elif _prefetched.pop(key) is not None:
+        # Conta solo il primo tocco servito da un precalcolo, non le letture successive
+        CALENDAR_PREFETCH.inc("used")
+    return rendered
+
+
+def adjacent_months(year: int, month: int) -> list[tuple[int, int]]:
+    """Mese successivo e precedente (quest'ultimo solo se non è nel passato)."""
+    next_ym = (year + month // 12, month % 12 + 1)
+    prev_ym = (year - (month == 1), (month - 2) % 12 + 1)
+    today = date.today()
+    return [next_ym] + ([prev_ym] if prev_ym >= (today.year, today.month) else [])
+
+
+class CalendarPrefetcher:
+    """Precalcolo a bassa priorità dei mesi adiacenti, entro un budget globale.
+
+    Ogni richiesta oltre il budget (calcoli in corso o al minuto) o con il bot impegnato
+    viene scartata, mai messa in coda: il lavoro interattivo ha sempre la precedenza.
+    """
+
+    def __init__(self, enabled: bool = CALENDAR_PREFETCH_ENABLED, concurrency: int = CALENDAR_PREFETCH_CONCURRENCY,
+                 per_minute: int = CALENDAR_PREFETCH_PER_MINUTE, max_active_chats: int = CALENDAR_PREFETCH_MAX_ACTIVE_CHATS):
+        self.enabled = enabled
+        self.concurrency = max(1, concurrency)
+        self.per_minute = max(1, per_minute)
+        self.max_active_chats = max_active_chats
+        self._inflight: set = set()
+        self._tokens = float(self.per_minute)
+        self._refilled_at = time.monotonic()
+        self._processor = None
+        self._tasks = None
+
+    def bind(self, processor, tasks) -> None:
+        """Update processor (per sapere quante chat sono attive) e supervisore dei task."""
+        self._processor, self._tasks = processor, tasks
+
+    def _busy(self) -> bool:
+        active = getattr(self._processor, "active_chats", 0)
+        return active > self.max_active_chats
+
+    def _take_token(self) -> bool:
+        now = time.monotonic()
+        self._tokens = min(self.per_minute, self._tokens + (now - self._refilled_at) * self.per_minute / 60)
+        self._refilled_at = now
+        if self._tokens < 1:
+            return False
+        self._tokens -= 1
+        return True
+
+    def after_render(self, view, year: int, month: int, *args) -> None:
+        """Da chiamare dopo aver mostrato un mese: ``view(y, m, *args, prefetch=True)`` per i mesi adiacenti."""
+        if not self.enabled or self._tasks is None:
+            return
+        for y, m in adjacent_months(year, month):
+            job = (view.__name__, y, m, tuple(tuple(sorted(a.items())) if isinstance(a, dict) else a for a in args))
+            if job in self._inflight:
+                continue
+            if self._busy():
+                CALENDAR_PREFETCH.inc("skipped_busy")
+                return
+            if len(self._inflight) >= self.concurrency or not self._take_token():
+                CALENDAR_PREFETCH.inc("skipped_budget")
+                return
+            self._inflight.add(job)
+            self._tasks.spawn(self._run(job, view, y, m, args), kind="prefetch", name=f"prefetch:{y}-{m:02d}")
+
+    async def _run(self, job, view, year: int, month: int, args: tuple) -> None:
+        try:
+            # Lascia prima terminare l'update in corso, poi ricontrolla il carico
+            await asyncio.sleep(0)
+            if self._busy():
+                CALENDAR_PREFETCH.inc("skipped_busy")
+                return
+            await asyncio.to_thread(view, year, month, *args, prefetch=True)
+        finally:
+            self._inflight.discard(job)
+
+
+PREFETCH = CalendarPrefetcher()
+
+
+def _message_key(q):
+    if getattr(q, "inline_message_id", None):
+        return q.inline_message_id
+    message = getattr(q, "message", None)
+    return (message.chat_id, message.message_id) if message is not None else None
+
+
+class NavigationCoalescer:
+    """Ultimo tocco di navigazione per messaggio: i precedenti ancora in coda sono superati."""
+
+    def __init__(self, prefixes: tuple = NAV_PREFIXES, debounce_ms: float = NAV_DEBOUNCE_MS):
+        self.prefixes = prefixes
+        self.debounce = max(0.0, debounce_ms) / 1000
+        self._latest: dict = {}
+        self._pending: dict = {}
+
+    def _navigation(self, update):
+        q = getattr(update, "callback_query", None)
+        if q is None or not (q.data or "").startswith(self.prefixes):
+            return None, None
+        return q, _message_key(q)
+
+    def arrived(self, update) -> None:
+        q, key = self._navigation(update)
+        if key is not None:
+            self._latest[key] = q.id
+            self._pending[key] = self._pending.get(key, 0) + 1
+
+    def done(self, update) -> None:
+        q, key = self._navigation(update)
+        if key is None or key not in self._pending:
+            return
+        remaining = self._pending[key] - 1
+        if remaining:
+            self._pending[key] = remaining
+        else:
+            self._pending.pop(key, None)
+            self._latest.pop(key, None)
+
+    def is_stale(self, q) -> bool:
+        """True se dopo ``q`` è arrivato un altro tocco di navigazione sullo stesso messaggio."""
+        key = _message_key(q)
+        latest = self._latest.get(key) if key is not None else None
+        return latest is not None and latest != q.id
+
+    async def settle(self, q) -> bool:
+        """Attende la finestra di debounce; False se nel frattempo il tocco è stato superato."""
+        if self.debounce and not self.is_stale(q) and self._latest.get(_message_key(q)) is not None:
+            await asyncio.sleep(self.debounce)
+        if self.is_stale(q):
+            NAVIGATION_COALESCED.inc("before_render")
+            return False
+        return True
+
+    def superseded(self, q) -> bool:
+        """Controllo dopo il calcolo: True (e metrica) se il risultato non va più inviato."""
+        if self.is_stale(q):
+            NAVIGATION_COALESCED.inc("before_edit")
+            return True
+        return False
+
+
+NAVIGATION = NavigationCoalescer()
+
+
+_MARKDOWN_MARKS = str.maketrans("", "", "*_`")
+
+
+def markup_digest(text: str, reply_markup=None) -> int:
+    """Impronta di testo (senza formattazione) e tastiera; valida nel processo (usa ``hash``)."""
+    rows = ()
+    if reply_markup is not None:
+        rows = tuple(tuple((b.text, b.callback_data, b.url) for b in row) for row in reply_markup.inline_keyboard)
+    return hash((text, rows))
+
+
+def _plain(text: str, parse_mode) -> str:
+    # Il messaggio ricevuto da Telegram ha il testo senza i marcatori Markdown (finiscono nelle entities)
+    return text.translate(_MARKDOWN_MARKS) if parse_mode and parse_mode.upper().startswith("MARKDOWN") else text
+
+
+async def edit_if_changed(q, text: str, reply_markup=None, parse_mode=None, **kwargs) -> bool:
+    """``q.edit_message_text`` solo se il messaggio cambia; True se la modifica è stata inviata.
+
+    Il confronto è con il messaggio allegato al callback, cioè con ciò che l'utente vede
+    nel momento del tocco: niente stato da mantenere, vale anche tra worker e riavvii.
+    """
+    message = getattr(q, "message", None)
+    current = getattr(message, "text", None)
+    if current is not None and markup_digest(current, message.reply_markup) == markup_digest(_plain(text, parse_mode), reply_markup):
+        EDITS_SKIPPED.inc("unchanged")
+        return False
+    try:
+        await q.edit_message_text(text, reply_markup=reply_markup, parse_mode=parse_mode, **kwargs)
+    except BadRequest as e:
+        if "not modified" not in str(e).lower():
+            raise
+        # Stesso contenuto con formattazione diversa dal previsto: la Bot API lo rifiuta
+        EDITS_SKIPPED.inc("not_modified")
+        return False
+    return True
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+"""
+Modulo cluster - più worker webhook sullo stesso DB SQLite.
+
+Tutti i worker elaborano gli update ricevuti dal reverse proxy; i job periodici
+(reminder, lista d'attesa, backup) li esegue un solo worker, il leader, che detiene
+un lease nella tabella `leases`. Il lease va rinnovato prima della scadenza: se il
+leader muore, alla scadenza un altro worker lo acquisisce (failover automatico).
+
+Il proxy deve instradare gli update di uno stesso utente sempre allo stesso worker
+(`CLUSTER_CHAT_AFFINITY=1` lo dichiara): conversazioni e sessioni non sono condivise.
+
+Non importa Telegram: il lease si può ispezionare anche da script/tool admin.
+"""
+import os, socket, time, logging
+
+from core_module import db_conn, env_flag
+
+logger = logging.getLogger(__name__)
+
+CLUSTER_MODE = env_flag("CLUSTER_MODE", default=False)
+WORKER_ID = os.environ.get("WORKER_ID", "").strip() or f"{socket.gethostname()}-{os.getpid()}"
+# Durata del lease e frequenza di rinnovo (secondi)
+LEASE_TTL = float(os.environ.get("CLUSTER_LEASE_TTL", "30"))
+LEASE_RENEW_INTERVAL = max(1.0, float(os.environ.get("CLUSTER_LEASE_RENEW", str(LEASE_TTL / 3))))
+JOBS_LEASE_NAME = "jobs"
+# Conferma che il proxy instrada ogni utente sempre allo stesso worker (hash sull'id del
+# mittente): stato della conversazione, user_data, deduplica dei tocchi e ordine per chat
+# vivono nel processo. Senza affinità il cluster non parte.
+CLUSTER_CHAT_AFFINITY = env_flag("CLUSTER_CHAT_AFFINITY", default=False)
+
+
+def ensure_cluster_tables():
+    """Crea le tabelle del lease e della coda eventi della lista d'attesa."""
+    con = db_conn(); cur = con.cursor()
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS leases (
+            name TEXT PRIMARY KEY,
+            holder TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        )
+    """)
+    # Slot liberati da qualunque worker, consumati dal leader (cascata lista d'attesa)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS waitlist_events (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            date TEXT,
+            time TEXT,
+            operator_id TEXT,
+            service_code TEXT,
+            service_name TEXT,
+            created_at REAL
+        )
+    """)
+    con.commit(); con.close()
+
+
+class LeaseElector:
+    """Elezione del leader tramite una riga di lease in SQLite.
+
+    `try_acquire()` acquisisce il lease se libero/scaduto o lo rinnova se già nostro,
+    in un'unica transazione IMMEDIATE. Localmente ci si considera leader solo fino a
+    `LEASE_TTL` secondi dall'ultimo rinnovo riuscito meno un margine, così un worker
+    che non riesce a rinnovare smette di eseguire i job prima che un altro subentri.
+    """
+
+    def __init__(self, name: str = JOBS_LEASE_NAME, holder: str = WORKER_ID, ttl: float = LEASE_TTL):
+        self.name = name
+        self.holder = holder
+        self.ttl = ttl
+        self._valid_until = 0.0
+
+    @property
+    def is_leader(self) -> bool:
+        return time.time() < self._valid_until
+
+    def try_acquire(self) -> bool:
+        was_leader = self.is_leader
+        now = time.time()
+        con = db_conn()
+        try:
+            con.isolation_level = None
+            con.execute("BEGIN IMMEDIATE")
+            con.execute(
+                """
+                INSERT INTO leases (name, holder, expires_at) VALUES (?,?,?)
+                ON CONFLICT(name) DO UPDATE SET holder=excluded.holder, expires_at=excluded.expires_at
+                WHERE leases.holder=excluded.holder OR leases.expires_at < ?
+                """,
+                (self.name, self.holder, now + self.ttl, now),
+            )
+            row = con.execute("SELECT holder FROM leases WHERE name=?", (self.name,)).fetchone()
+            con.execute("COMMIT")
+        except Exception as e:
+            logger.warning("Rinnovo lease '%s' fallito: %s", self.name, e)
+            return self.is_leader
+        finally:
+            con.close()
+        acquired = bool(row) and row[0] == self.holder
+        # Margine di sicurezza: scade localmente prima che gli altri worker lo vedano scaduto
+        self._valid_until = now + self.ttl * 0.8 if acquired else 0.0
+        if acquired and not was_leader:
+            logger.info("Worker %s è ora leader (lease '%s')", self.holder, self.name)
+        elif was_leader and not acquired:
+            logger.warning("Worker %s ha perso la leadership (lease '%s')", self.holder, self.name)
+        return acquired
+
+    def release(self) -> None:
+        """Rilascia il lease (allo shutdown) per un failover immediato."""
+        self._valid_until = 0.0
+        con = db_conn()
+        try:
+            con.execute("DELETE FROM leases WHERE name=? AND holder=?", (self.name, self.holder))
+            con.commit()
+        finally:
+            con.close()
+
+    def current_holder(self) -> tuple[str, float] | None:
+        con = db_conn()
+        try:
+            row = con.execute("SELECT holder, expires_at FROM leases WHERE name=?", (self.name,)).fetchone()
+        finally:
+            con.close()
+        return (row[0], row[1]) if row else None
+
+
+def enqueue_waitlist_event(date_str: str, time_str: str, op_id: str, svc_code: str, svc_name: str) -> None:
+    con = db_conn()
+    con.execute(
+        "INSERT INTO waitlist_events (date, time, operator_id, service_code, service_name, created_at) VALUES (?,?,?,?,?,?)",
+        (date_str, time_str, op_id, svc_code, svc_name, time.time()),
+    )
+    con.commit(); con.close()
+
+
+def claim_waitlist_events(limit: int = 50) -> list[tuple]:
+    """Preleva (e rimuove) gli eventi in coda: (date, time, operator_id, service_code, service_name)."""
+    con = db_conn()
+    try:
+        con.isolation_level = None
+        con.execute("BEGIN IMMEDIATE")
+        rows = con.execute(
+            "SELECT id, date, time, operator_id, service_code, service_name FROM waitlist_events ORDER BY id LIMIT ?",
+            (limit,),
+        ).fetchall()
+        if rows:
+            con.executemany("DELETE FROM waitlist_events WHERE id=?", [(r[0],) for r in rows])
+        con.execute("COMMIT")
+    finally:
+        con.close()
+    return [tuple(r[1:]) for r in rows]
+
+
+# Elettore condiviso dal processo
+ELECTOR = LeaseElector()
@@ -0,0 +1,1693 @@
+# -*- coding: utf-8 -*-
+"""
+PrenotaFacile – core
+
+Logica di prenotazione senza dipendenze da Telegram: configurazione, schema DB,
+catalogo servizi/operatori e calcolo degli slot. L'import non ha effetti collaterali
+(nessun token, nessuna configurazione del logging, nessun accesso al DB), quindi
+script, benchmark e tool di amministrazione possono riusarla liberamente.
+"""
+import os, glob, heapq, json, sqlite3, logging, threading
+from datetime import datetime, date, time, timedelta
+from time import monotonic
+from typing import List
+
+from metrics_module import BOOKING_STATEMENTS, connection_factory, cache_hit, cache_miss
+from schedule_module import (
+    compile_week, compile_day, slot_starts, start_mask, fits, availability_mask, MASK_UNIT, DAY_MINUTES, hhmm_to_min, min_to_hhmm, parse_hours,
+    ScheduleException, ExceptionIndex, EMPTY_INDEX,
+)
+
+logger = logging.getLogger(__name__)
+
+# Usa un percorso assoluto relativo a questo file per evitare di creare DB in cartelle diverse
+# (BOT_DB_PATH permette di puntare a un DB diverso, es. per test o worker multipli)
+DB_PATH = os.environ.get("BOT_DB_PATH", "").strip() or os.path.join(os.path.dirname(os.path.abspath(__file__)), "prenotafacile.db")
+SLOT_MINUTES = 30
+
+# Modalità Test/Produzione per Reminder Intelligente
+def env_flag(name: str, default: bool = False) -> bool:
+    raw = os.environ.get(name)
+    if raw is None:
+        return default
+    raw = raw.strip().lower()
+    return raw in {"1", "true", "yes", "on"}
+
+
+TEST_MODE = env_flag("TEST_MODE", default=True)
+REMINDER_DELAY = 5 if TEST_MODE else 24 * 60 * 60  # 5 secondi in test, 24 ore in produzione
+
+# Attesa tra notifiche consecutive della lista d'attesa (secondi)
+WAITLIST_STEP_SECONDS = int(os.environ.get("WAITLIST_STEP_SECONDS", "120"))
+
+# Admin
+def get_admin_ids() -> set[int]:
+    raw = os.environ.get("ADMIN_IDS", "").strip()
+    ids: set[int] = set()
+    if raw:
+        for part in raw.replace(";", ",").split(","):
+            part = part.strip()
+            if not part:
+                continue
+            try:
+                ids.add(int(part))
+            except Exception:
+                pass
+    return ids
+
+def is_admin(user_id: int) -> bool:
+    return user_id in get_admin_ids()
+
+ORARI_SETTIMANA = {
+    0: [("09:00","13:00"),("15:00","19:00")],
+    1: [("09:00","13:00"),("15:00","19:00")],
+    2: [("09:00","13:00"),("15:00","19:00")],
+    3: [("09:00","13:00"),("15:00","19:00")],
+    4: [("09:00","13:00"),("15:00","19:00")],
+    5: [("09:00","13:00")],
+    6: []
+}
+
+# Operatori: aggiornati per riflettere i nomi proposti dall'utente
+OPERATRICI = [
+    {"id":"op_sara","name":"Sara"},
+    {"id":"op_giulia","name":"Giulia"},
+    {"id":"op_martina","name":"Martina"},
+]
+
+SERVIZI = {
+    "Donna": {
+        "Trattamenti Viso": [
+            {"code":"d_viso_pulizia","nome":"Pulizia del viso","durata":60,"prezzo":40},
+            {"code":"d_viso_antiage","nome":"Trattamento anti-age","durata":75,"prezzo":60},
+            {"code":"d_viso_trattamento","nome":"Trattamento viso","durata":45,"prezzo":35},
+        ],
+        "Unghie": [
+            {"code":"d_unghie_semipermanente","nome":"Semipermanente mani","durata":60,"prezzo":30},
+            {"code":"d_unghie_refill_gel","nome":"Refill gel","durata":75,"prezzo":40},
+            {"code":"d_unghie_manicure","nome":"Manicure classica","durata":40,"prezzo":20},
+            {"code":"d_unghie_pedicure","nome":"Pedicure","durata":45,"prezzo":25},
+        ],
+        "Estetica": [
+            {"code":"d_estetica_epilazione","nome":"Epilazione completa","durata":60,"prezzo":35},
+            {"code":"d_estetica_sopracciglia","nome":"Definizione sopracciglia","durata":15,"prezzo":8},
+            {"code":"d_estetica_ceretta_completa","nome":"Ceretta completa","durata":60,"prezzo":40},
+            {"code":"d_estetica_extension_ciglia","nome":"Extension ciglia","durata":90,"prezzo":60},
+        ],
+        "Massaggi": [
+            {"code":"d_massaggio_decontr","nome":"Massaggio decontratturante","durata":50,"prezzo":50},
+            {"code":"d_massaggio_rilass","nome":"Massaggio rilassante","durata":50,"prezzo":45},
+        ],
+    },
+    "Uomo": {
+        "Trattamenti Viso": [
+            {"code":"u_viso_pulizia","nome":"Pulizia del viso","durata":60,"prezzo":40},
+            {"code":"u_viso_purificante","nome":"Trattamento viso purificante","durata":45,"prezzo":35},
+        ],
+        "Estetica": [
+            {"code":"u_estetica_sopracciglia","nome":"Definizione sopracciglia","durata":15,"prezzo":8},
+            {"code":"u_estetica_epilazione_schiena","nome":"Epilazione schiena","durata":40,"prezzo":30},
+        ],
+    },
+}
+
+# DB
+
+# Attesa massima (secondi) su un DB bloccato da un altro processo/worker
+DB_BUSY_TIMEOUT = float(os.environ.get("DB_BUSY_TIMEOUT", "10"))
+
+def db_conn():
+    # Connessione strumentata: durata e numero di query per statement (metrics_module)
+    return sqlite3.connect(DB_PATH, check_same_thread=False, timeout=DB_BUSY_TIMEOUT, factory=connection_factory())
+
+
+def enable_wal():
+    """Attiva il journal WAL (persistente nel file): letture concorrenti tra più processi."""
+    con = db_conn()
+    try:
+        mode = con.execute("PRAGMA journal_mode=WAL").fetchone()[0]
+    finally:
+        con.close()
+    return mode
+
+
+def backup_database(dest_dir: str, keep: int = 7) -> str:
+    """Copia consistente del DB (API backup di SQLite) in dest_dir; conserva le ultime `keep` copie."""
+    os.makedirs(dest_dir, exist_ok=True)
+    base = os.path.splitext(os.path.basename(DB_PATH))[0]
+    dest = os.path.join(dest_dir, f"{base}-{datetime.now().strftime('%Y%m%d-%H%M%S')}.db")
+    src = db_conn(); dst = sqlite3.connect(dest)
+    try:
+        src.backup(dst)
+    finally:
+        dst.close(); src.close()
+    old_copies = sorted(glob.glob(os.path.join(dest_dir, f"{base}-*.db")))
+    for path in old_copies[:-keep] if keep > 0 else []:
+        try:
+            os.remove(path)
+        except OSError:
+            logger.warning("Impossibile rimuovere il backup %s", path)
+    return dest
+
+
+# Archivio delle prenotazioni passate: dopo ARCHIVE_AFTER_DAYS giorni (0 = mai) le righe
+# passano da bookings a bookings_archive, a lotti di ARCHIVE_BATCH per transazione
+ARCHIVE_AFTER_DAYS = int(os.environ.get("ARCHIVE_AFTER_DAYS", "90"))
+ARCHIVE_BATCH = max(1, int(os.environ.get("ARCHIVE_BATCH", "500")))
+# Colonne comuni ai due livelli (e alla vista bookings_all)
+BOOKING_COLUMNS = (
+    "id", "user_id", "client_id", "center_id", "service_code", "service_name", "date", "time", "duration",
+    "operator_id", "price", "created_at", "status", "reminder_sent", "start_ts", "end_ts",
+)
+
+def archive_old_bookings(days: int = ARCHIVE_AFTER_DAYS, today: date | None = None) -> int:
+    """Sposta in bookings_archive le prenotazioni iniziate prima di ``days`` giorni fa.
+
+    Ogni lotto è una transazione (copia + cancellazione), così le scritture del bot non
+    restano bloccate a lungo. Restituisce il numero di prenotazioni archiviate.
+    """
+    if days <= 0:
+        return 0
+    cutoff = to_epoch_minutes(datetime.combine((today or date.today()) - timedelta(days=days), time()))
+    columns = ", ".join(BOOKING_COLUMNS)
+    archived_at = datetime.utcnow().isoformat()
+    moved = 0
+    con = db_conn()
+    try:
+        con.isolation_level = None
+        while True:
+            con.execute("BEGIN IMMEDIATE")
+            ids = [r[0] for r in con.execute(
+                "SELECT id FROM bookings WHERE start_ts < ? ORDER BY start_ts LIMIT ?", (cutoff, ARCHIVE_BATCH)
+            )]
+            if not ids:
+                con.execute("COMMIT")
+                break
+            marks = ",".join("?" * len(ids))
+            con.execute(
+                f"INSERT INTO bookings_archive ({columns}, archived_at) "
+                f"SELECT {columns}, ? FROM bookings WHERE id IN ({marks})",
+                (archived_at, *ids),
+            )
+            con.execute(f"DELETE FROM bookings WHERE id IN ({marks})", ids)
+            con.execute("COMMIT")
+            moved += len(ids)
+    except Exception:
+        if con.in_transaction:
+            con.execute("ROLLBACK")
+        raise
+    finally:
+        con.close()
+    return moved
+
+def bookings_source(con, date_from: str | None) -> str:
+    """Tabella da leggere per prenotazioni dal ``date_from`` in poi (None = tutte).
+
+    "bookings" se il periodo è tutto nel livello attivo, altrimenti la vista "bookings_all"
+    (attive + archivio). Il confine è la data più recente archiviata (indice su date).
+    """
+    try:
+        row = con.execute("SELECT MAX(date) FROM bookings_archive").fetchone()
+    except sqlite3.OperationalError:
+        return "bookings"
+    if row is None or row[0] is None or (date_from is not None and date_from > row[0]):
+        return "bookings"
+    return "bookings_all"
+
+# Le prenotazioni disdette restano in tabella (status='CANCELLED') ma non occupano lo slot
+ACTIVE_BOOKING_SQL = "status IS NOT 'CANCELLED'"
+
+# start_ts calcolato in SQL da date/time (stessa convenzione di booking_span)
+BOOKING_START_TS_SQL = "CAST(strftime('%s', date || ' ' || time) AS INTEGER) / 60"
+
+# Tabelle ed eventi che cambiano la disponibilità (trigger su availability_version)
+AVAILABILITY_TRIGGERS = {
+    "bookings": ("INSERT", "DELETE", "UPDATE OF date, time, duration, operator_id, status"),
+    "operators": ("INSERT", "DELETE", "UPDATE OF work_start, work_end, breaks_json"),
+    "schedule_exceptions": ("INSERT", "DELETE", "UPDATE"),
+    "services": ("UPDATE OF duration_minutes",),
+}
+
+def availability_version() -> int | None:
+    """Contatore globale delle modifiche alla disponibilità; None se il DB non è migrato.
+
+    Allinea anche orari ed eccezioni in memoria alla versione letta: ciò che viene messo in
+    cache con questa chiave è calcolato su dati almeno altrettanto recenti.
+    """
+    con = db_conn()
+    try:
+        row = con.execute("SELECT version FROM availability_version WHERE id = 1").fetchone()
+    except sqlite3.OperationalError:
+        return None
+    finally:
+        con.close()
+    version = row[0] if row else None
+    if version is not None:
+        _refresh_schedules(version)
+    return version
+
+def ensure_availability_triggers(cur) -> None:
+    """Trigger su availability_version per le tabelle di AVAILABILITY_TRIGGERS già presenti.
+
+    Su un DB nuovo operators e services nascono in migrate_db, dopo ensure_unified_schema:
+    le tabelle mancanti vengono saltate e migrate_db richiama questa funzione alla fine.
+    """
+    cur.execute("SELECT name FROM sqlite_master WHERE type='table'")
+    existing = {row[0] for row in cur.fetchall()}
+    for table, events in AVAILABILITY_TRIGGERS.items():
+        if table not in existing:
+            continue
+        for event in events:
+            name = f"trg_availability_{table}_{event.split()[0].lower()}"
+            cur.execute(
+                f"CREATE TRIGGER IF NOT EXISTS {name} AFTER {event} ON {table} "
+                "BEGIN UPDATE availability_version SET version = version + 1 WHERE id = 1; END"
+            )
+
+def ensure_unified_schema():
+    """Allinea lo schema del DB per l'uso con entrambe le varianti."""
+    con = db_conn(); cur = con.cursor()
+
+    # Tabella clients principale (migrazione da schema legacy se necessario)
+    cur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='clients'")
+    has_clients_table = cur.fetchone() is not None
+
+    if not has_clients_table:
+        cur.execute(
+            """
+            CREATE TABLE clients (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                tg_id INTEGER UNIQUE,
+                username TEXT,
+                name TEXT,
+                phone TEXT,
+                notes TEXT,
+                last_seen TEXT
+            )
+            """
+        )
+        has_clients_table = True
+    else:
+        cur.execute("PRAGMA table_info(clients)")
+        client_cols = {row[1] for row in cur.fetchall()}
+        if "id" not in client_cols:
+            cur.execute(
+                """
+                CREATE TABLE IF NOT EXISTS clients_tmp (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    tg_id INTEGER UNIQUE,
+                    username TEXT,
+                    name TEXT,
+                    phone TEXT,
+                    notes TEXT,
+                    last_seen TEXT
+                )
+                """
+            )
+            cur.execute(
+                """
+                INSERT OR IGNORE INTO clients_tmp (tg_id, username, name, phone, notes, last_seen)
+                SELECT COALESCE(tg_id, user_id), username, name, phone, notes, last_seen FROM clients
+                """
+            )
+            cur.execute("DROP TABLE clients")
+            cur.execute("ALTER TABLE clients_tmp RENAME TO clients")
+
+    # Copia eventuali record legacy dalla tabella users nella nuova struttura
+    cur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='users'")
+    if cur.fetchone():
+        cur.execute(
+            """
+            INSERT OR IGNORE INTO clients (tg_id, username, name, phone, notes)
+            SELECT user_id, username, name, phone, notes FROM users
+            """
+        )
+
+    # Colonne mancanti su bookings
+    cur.execute("PRAGMA table_info(bookings)")
+    booking_cols = {row[1] for row in cur.fetchall()}
+
+    def ensure_booking_column(col_name: str, ddl: str, post_update_sql: str | None = None):
+        if col_name not in booking_cols:
+            cur.execute(f"ALTER TABLE bookings ADD COLUMN {ddl}")
+            if post_update_sql:
+                cur.execute(post_update_sql)
+            booking_cols.add(col_name)
+
+    ensure_booking_column("client_id", "client_id INTEGER", None)
+    ensure_booking_column("center_id", "center_id INTEGER DEFAULT 1", "UPDATE bookings SET center_id=1 WHERE center_id IS NULL")
+    ensure_booking_column("status", "status TEXT DEFAULT 'CONFIRMED'", "UPDATE bookings SET status='CONFIRMED' WHERE status IS NULL")
+    ensure_booking_column("reminder_sent", "reminder_sent INTEGER DEFAULT 0", "UPDATE bookings SET reminder_sent=0 WHERE reminder_sent IS NULL")
+
+    # Inizio/fine in minuti dall'epoca: sovrapposizioni e promemoria diventano range query
+    # sull'indice. I percorsi di inserimento li scrivono già; i trigger coprono le righe
+    # scritte da altri strumenti e le modifiche di data, ora o durata.
+    ensure_booking_column("start_ts", "start_ts INTEGER", f"UPDATE bookings SET start_ts={BOOKING_START_TS_SQL}")
+    ensure_booking_column("end_ts", "end_ts INTEGER", "UPDATE bookings SET end_ts=start_ts + COALESCE(duration, 0)")
+    cur.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_bookings_span_insert AFTER INSERT ON bookings
+        WHEN NEW.start_ts IS NULL OR NEW.end_ts IS NULL
+        BEGIN
+            UPDATE bookings SET start_ts={BOOKING_START_TS_SQL}, end_ts={BOOKING_START_TS_SQL} + COALESCE(duration, 0)
+            WHERE id=NEW.id;
+        END
+    """)
+    cur.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_bookings_span_update AFTER UPDATE OF date, time, duration ON bookings
+        BEGIN
+            UPDATE bookings SET start_ts={BOOKING_START_TS_SQL}, end_ts={BOOKING_START_TS_SQL} + COALESCE(duration, 0)
+            WHERE id=NEW.id;
+        END
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_bookings_operator_start ON bookings(operator_id, start_ts)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_bookings_start ON bookings(start_ts)")
+    # Report e viste per giorno (stats_module): aggregazione per data senza scansione
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_bookings_date_status ON bookings(date, status)")
+
+    # Livello freddo: prenotazioni passate spostate da archive_old_bookings, stesso id.
+    # bookings_all unisce i due livelli per statistiche ed esportazioni sul passato.
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS bookings_archive (
+            id INTEGER PRIMARY KEY,
+            user_id INTEGER,
+            client_id INTEGER,
+            center_id INTEGER,
+            service_code TEXT,
+            service_name TEXT,
+            date TEXT,
+            time TEXT,
+            duration INTEGER,
+            operator_id TEXT,
+            price REAL,
+            created_at TEXT,
+            status TEXT,
+            reminder_sent INTEGER,
+            start_ts INTEGER,
+            end_ts INTEGER,
+            archived_at TEXT
+        )
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_bookings_archive_date ON bookings_archive(date)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_bookings_archive_user ON bookings_archive(user_id)")
+    columns = ", ".join(BOOKING_COLUMNS)
+    cur.execute(f"""
+        CREATE VIEW IF NOT EXISTS bookings_all AS
+        SELECT {columns} FROM bookings UNION ALL SELECT {columns} FROM bookings_archive
+    """)
+
+    # Pause degli operatori (come in FULL_DB_SCHEMA)
+    cur.execute("PRAGMA table_info(operators)")
+    operator_cols = {row[1] for row in cur.fetchall()}
+    if operator_cols and "breaks_json" not in operator_cols:
+        cur.execute("ALTER TABLE operators ADD COLUMN breaks_json TEXT DEFAULT '[]'")
+
+    # Registro delle assegnazioni automatiche dell'operatore (opzione "Indifferente")
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS assignment_audit (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            booking_id INTEGER,
+            user_id INTEGER,
+            service_code TEXT,
+            date TEXT,
+            time TEXT,
+            operator_id TEXT,
+            candidates_json TEXT,
+            created_at TEXT
+        )
+        """
+    )
+
+    # Chiusure, ferie e orari speciali (operator_id NULL = tutto il centro; hours_json NULL = chiuso)
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS schedule_exceptions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            operator_id TEXT,
+            date_from TEXT NOT NULL,
+            date_to TEXT NOT NULL,
+            hours_json TEXT,
+            note TEXT,
+            created_at TEXT
+        )
+        """
+    )
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_schedule_exceptions_to ON schedule_exceptions(date_to)")
+
+    # Slot proposti dalla cascata della lista d'attesa (bottone acsl_<waitlist_id>): nel DB e
+    # non in bot_data, così il tocco arriva a qualunque worker del cluster
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS slot_offers (
+            waitlist_id INTEGER PRIMARY KEY,
+            date TEXT NOT NULL,
+            time TEXT NOT NULL,
+            operator_id TEXT,
+            service_code TEXT NOT NULL,
+            created_at TEXT
+        )
+        """
+    )
+
+    # Versione della disponibilità: cresce a ogni modifica di prenotazioni, orari o eccezioni
+    # (trigger nel DB, quindi anche per scritture di altri worker o da script esterni)
+    cur.execute("CREATE TABLE IF NOT EXISTS availability_version (id INTEGER PRIMARY KEY CHECK (id = 1), version INTEGER NOT NULL)")
+    cur.execute("INSERT OR IGNORE INTO availability_version (id, version) VALUES (1, 0)")
+    ensure_availability_triggers(cur)
+
+    # Colonne mancanti su waitlist
+    cur.execute("PRAGMA table_info(waitlist)")
+    waitlist_cols = {row[1] for row in cur.fetchall()}
+    if "client_id" not in waitlist_cols:
+        cur.execute("ALTER TABLE waitlist ADD COLUMN client_id INTEGER")
+        waitlist_cols.add("client_id")
+
+    # Assicura che esistano record clients per ogni user_id visto in bookings/waitlist
+    cur.execute(
+        """
+        INSERT OR IGNORE INTO clients (tg_id, last_seen)
+        SELECT DISTINCT user_id, datetime('now') FROM bookings WHERE user_id IS NOT NULL
+        """
+    )
+    cur.execute(
+        """
+        INSERT OR IGNORE INTO clients (tg_id, last_seen)
+        SELECT DISTINCT user_id, datetime('now') FROM waitlist WHERE user_id IS NOT NULL
+        """
+    )
+
+    # Popola/Reallinea client_id sfruttando tg_id
+    cur.execute(
+        """
+        UPDATE bookings
+        SET client_id = (
+            SELECT id FROM clients WHERE tg_id = bookings.user_id
+        )
+        WHERE user_id IS NOT NULL
+        """
+    )
+    cur.execute(
+        """
+        UPDATE waitlist
+        SET client_id = (
+            SELECT id FROM clients WHERE tg_id = waitlist.user_id
+        )
+        WHERE user_id IS NOT NULL
+        """
+    )
+
+    con.commit(); con.close()
+
+
+def upsert_client(con, user_id: int, username: str | None = None, name: str | None = None, phone: str | None = None, notes: str | None = None) -> int:
+    """Crea/aggiorna il client ``tg_id=user_id`` (e la riga legacy in users) sulla connessione data.
+
+    Un solo statement per tabella (upsert con RETURNING), nessun commit: il chiamante
+    decide la transazione. I campi None non sovrascrivono i valori già salvati.
+    """
+    now = datetime.utcnow().isoformat()
+    client_id = con.execute(
+        """
+        INSERT INTO clients (tg_id, username, name, phone, notes, last_seen)
+        VALUES (?,?,?,?,?,?)
+        ON CONFLICT(tg_id) DO UPDATE SET
+            username=COALESCE(excluded.username, username),
+            name=COALESCE(excluded.name, name),
+            phone=COALESCE(excluded.phone, phone),
+            notes=COALESCE(excluded.notes, notes),
+            last_seen=excluded.last_seen
+        RETURNING id
+        """,
+        (user_id, username, name, phone, notes, now),
+    ).fetchone()[0]
+    try:
+        # Tabella legacy users, mantenuta finché esiste
+        con.execute(
+            """
+            INSERT INTO users (user_id, username, name, phone, notes) VALUES (?,?,?,?,?)
+            ON CONFLICT(user_id) DO UPDATE SET
+                username=COALESCE(excluded.username, username),
+                name=COALESCE(excluded.name, name),
+                phone=COALESCE(excluded.phone, phone),
+                notes=COALESCE(excluded.notes, notes)
+            """,
+            (user_id, username, name, phone, notes),
+        )
+    except sqlite3.OperationalError:
+        pass
+    return client_id
+
+
+def ensure_client_for_user(user_id: int, username: str | None = None, name: str | None = None, phone: str | None = None, notes: str | None = None) -> int | None:
+    """Crea/aggiorna il mapping verso clients e restituisce l'id client."""
+    con = db_conn()
+    try:
+        client_id = upsert_client(con, user_id, username, name, phone, notes)
+        con.commit()
+    finally:
+        con.close()
+    return client_id
+
+
+def get_client_id_for_user(user_id: int) -> int | None:
+    con = db_conn(); cur = con.cursor(); cur.execute("SELECT id FROM clients WHERE tg_id=?", (user_id,)); row = cur.fetchone(); con.close(); return row[0] if row else None
+
+
+# Il centro predefinito non cambia a runtime: letto (o creato) una volta per processo
+_default_center_id: int | None = None
+
+def default_center_id(con) -> int:
+    """Id del primo centro, creato se manca, usando la connessione (e la transazione) data."""
+    global _default_center_id
+    if _default_center_id is None:
+        row = con.execute("SELECT id FROM centers ORDER BY id LIMIT 1").fetchone()
+        if not row:
+            # Non ancora in cache: la transazione del chiamante potrebbe essere annullata
+            return con.execute("INSERT INTO centers(name) VALUES(?)", ("Centro Principale",)).lastrowid
+        _default_center_id = row[0]
+    return _default_center_id
+
+
+def resolve_default_center_id() -> int:
+    if _default_center_id is not None:
+        return _default_center_id
+    con = db_conn()
+    try:
+        center_id = default_center_id(con)
+        con.commit()
+    finally:
+        con.close()
+    return center_id
+
+def init_db():
+    con = db_conn(); cur = con.cursor()
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            name TEXT,
+            phone TEXT,
+            notes TEXT
+        )
+    """)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS bookings (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            client_id INTEGER,
+            center_id INTEGER,
+            service_code TEXT,
+            service_name TEXT,
+            date TEXT,
+            time TEXT,
+            duration INTEGER,
+            operator_id TEXT,
+            price REAL,
+            created_at TEXT,
+            status TEXT DEFAULT 'CONFIRMED',
+            reminder_sent INTEGER DEFAULT 0,
+            start_ts INTEGER,
+            end_ts INTEGER
+        )
+    """)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS waitlist (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            client_id INTEGER,
+            date TEXT,
+            service_code TEXT,
+            created_at TEXT
+        )
+    """)
+    con.commit(); con.close()
+
+def migrate_db():
+    """Aggiunge tabelle mancanti per supportare servizi/operatori/categorie da DB"""
+    con = db_conn(); cur = con.cursor()
+    # Tabella centers
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS centers (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            address TEXT,
+            phone TEXT
+        )
+    """)
+    # Tabella operators
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS operators (
+            id TEXT PRIMARY KEY,
+            center_id INTEGER,
+            name TEXT NOT NULL,
+            work_start TEXT DEFAULT '09:00',
+            work_end TEXT DEFAULT '19:00',
+            breaks_json TEXT DEFAULT '[]',
+            FOREIGN KEY(center_id) REFERENCES centers(id)
+        )
+    """)
+    # Tabella services con gender e category
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS services (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            center_id INTEGER,
+            code TEXT UNIQUE NOT NULL,
+            title TEXT NOT NULL,
+            duration_minutes INTEGER DEFAULT 30,
+            price REAL DEFAULT 0,
+            gender TEXT,
+            category TEXT,
+            FOREIGN KEY(center_id) REFERENCES centers(id)
+        )
+    """)
+    # Rinomina users -> clients per consistenza
+    cur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='clients'")
+    if not cur.fetchone():
+        cur.execute("ALTER TABLE users RENAME TO clients")
+    # Aggiungi colonne mancanti in clients
+    try:
+        cur.execute("ALTER TABLE clients ADD COLUMN tg_id INTEGER")
+    except Exception:
+        pass  # Colonna già esiste
+    try:
+        cur.execute("ALTER TABLE clients ADD COLUMN last_seen TEXT")
+    except Exception:
+        pass
+    # Trigger di disponibilità sulle tabelle appena create (operators, services)
+    cur.execute("CREATE TABLE IF NOT EXISTS availability_version (id INTEGER PRIMARY KEY CHECK (id = 1), version INTEGER NOT NULL)")
+    cur.execute("INSERT OR IGNORE INTO availability_version (id, version) VALUES (1, 0)")
+    ensure_availability_triggers(cur)
+    con.commit(); con.close()
+
+def category_emoji(cat: str) -> str:
+    """Mappa categoria a emoji"""
+    mapping = {
+        "Trattamenti Viso": "💆",
+        "Unghie": "💅",
+        "Estetica": "✨",
+        "Massaggi": "💆‍♀️"
+    }
+    emoji = mapping.get(cat, "📋")
+    return f"{emoji} {cat}"
+
+def ensure_sample_data():
+    """Popola DB con centro, operatori e servizi completi (Donna/Uomo con categorie)"""
+    con = db_conn(); cur = con.cursor()
+    # Centro
+    cur.execute("SELECT COUNT(*) FROM centers")
+    if cur.fetchone()[0] == 0:
+        cur.execute("INSERT INTO centers(name, address, phone) VALUES(?,?,?)",
+                    ("Centro Estetico Bella Vita", "Via Roma 123", "0123456789"))
+        center_id = cur.lastrowid
+    else:
+        cur.execute("SELECT id FROM centers LIMIT 1")
+        center_id = cur.fetchone()[0]
+    
+    # Operatori
+    cur.execute("SELECT COUNT(*) FROM operators")
+    if cur.fetchone()[0] == 0:
+        operators_data = [
+            ("op_sara", center_id, "Sara", "09:00", "19:00"),
+            ("op_giulia", center_id, "Giulia", "09:00", "19:00"),
+            ("op_martina", center_id, "Martina", "09:00", "18:00"),
+        ]
+        cur.executemany("INSERT INTO operators(id, center_id, name, work_start, work_end) VALUES(?,?,?,?,?)", operators_data)
+        invalidate_schedules()
+    
+    # Servizi completi (39 totali: 24 Donna + 15 Uomo)
+    cur.execute("SELECT COUNT(*) FROM services")
+    if cur.fetchone()[0] == 0:
+        services_data = [
+            # DONNA - Trattamenti Viso (8)
+            (center_id, "d_viso_pulizia", "Pulizia del viso profonda", 60, 40, "Donna", "Trattamenti Viso"),
+            (center_id, "d_viso_antiage", "Trattamento anti-age", 75, 60, "Donna", "Trattamenti Viso"),
+            (center_id, "d_viso_idratante", "Trattamento viso idratante", 50, 45, "Donna", "Trattamenti Viso"),
+            (center_id, "d_viso_purificante", "Trattamento viso purificante", 55, 38, "Donna", "Trattamenti Viso"),
+            (center_id, "d_viso_schiarente", "Trattamento viso schiarente", 65, 50, "Donna", "Trattamenti Viso"),
+            (center_id, "d_viso_lifting", "Trattamento lifting viso", 80, 70, "Donna", "Trattamenti Viso"),
+            (center_id, "d_viso_peeling", "Peeling chimico viso", 45, 55, "Donna", "Trattamenti Viso"),
+            (center_id, "d_viso_acne", "Trattamento acne", 60, 50, "Donna", "Trattamenti Viso"),
+            
+            # DONNA - Unghie (7)
+            (center_id, "d_unghie_semipermanente", "Semipermanente mani", 60, 30, "Donna", "Unghie"),
+            (center_id, "d_unghie_refill_gel", "Refill gel", 75, 40, "Donna", "Unghie"),
+            (center_id, "d_unghie_manicure", "Manicure classica", 40, 20, "Donna", "Unghie"),
+            (center_id, "d_unghie_pedicure", "Pedicure", 45, 25, "Donna", "Unghie"),
+            (center_id, "d_unghie_ricostruzione", "Ricostruzione unghie", 90, 50, "Donna", "Unghie"),
+            (center_id, "d_unghie_nail_art", "Nail art decorazioni", 30, 15, "Donna", "Unghie"),
+            (center_id, "d_unghie_french", "French manicure", 50, 28, "Donna", "Unghie"),
+            
+            # DONNA - Estetica (5)
+            (center_id, "d_estetica_epilazione", "Epilazione completa", 60, 35, "Donna", "Estetica"),
+            (center_id, "d_estetica_sopracciglia", "Definizione sopracciglia", 15, 8, "Donna", "Estetica"),
+            (center_id, "d_estetica_ceretta_completa", "Ceretta completa", 60, 40, "Donna", "Estetica"),
+            (center_id, "d_estetica_extension_ciglia", "Extension ciglia", 90, 60, "Donna", "Estetica"),
+            (center_id, "d_estetica_laminazione", "Laminazione ciglia", 45, 35, "Donna", "Estetica"),
+            
+            # DONNA - Massaggi (4)
+            (center_id, "d_massaggio_decontr", "Massaggio decontratturante", 50, 50, "Donna", "Massaggi"),
+            (center_id, "d_massaggio_rilass", "Massaggio rilassante", 50, 45, "Donna", "Massaggi"),
+            (center_id, "d_massaggio_drenante", "Massaggio drenante", 60, 55, "Donna", "Massaggi"),
+            (center_id, "d_massaggio_stone", "Massaggio hot stone", 70, 65, "Donna", "Massaggi"),
+            
+            # UOMO - Trattamenti Viso (6)
+            (center_id, "u_viso_pulizia", "Pulizia del viso profonda", 60, 40, "Uomo", "Trattamenti Viso"),
+            (center_id, "u_viso_purificante", "Trattamento viso purificante", 45, 35, "Uomo", "Trattamenti Viso"),
+            (center_id, "u_viso_anti_fatica", "Trattamento anti-fatica", 50, 42, "Uomo", "Trattamenti Viso"),
+            (center_id, "u_viso_barba", "Trattamento barba", 30, 25, "Uomo", "Trattamenti Viso"),
+            (center_id, "u_viso_idratante", "Trattamento idratante", 40, 38, "Uomo", "Trattamenti Viso"),
+            (center_id, "u_viso_peeling", "Peeling viso uomo", 45, 50, "Uomo", "Trattamenti Viso"),
+            
+            # UOMO - Unghie (3)
+            (center_id, "u_unghie_manicure", "Manicure uomo", 35, 18, "Uomo", "Unghie"),
+            (center_id, "u_unghie_pedicure", "Pedicure uomo", 40, 22, "Uomo", "Unghie"),
+            (center_id, "u_unghie_cura", "Cura unghie", 25, 15, "Uomo", "Unghie"),
+            
+            # UOMO - Estetica (3)
+            (center_id, "u_estetica_sopracciglia", "Definizione sopracciglia", 15, 8, "Uomo", "Estetica"),
+            (center_id, "u_estetica_epilazione_schiena", "Epilazione schiena", 40, 30, "Uomo", "Estetica"),
+            (center_id, "u_estetica_ceretta_corpo", "Ceretta corpo", 50, 35, "Uomo", "Estetica"),
+            
+            # UOMO - Massaggi (3)
+            (center_id, "u_massaggio_sportivo", "Massaggio sportivo", 50, 55, "Uomo", "Massaggi"),
+            (center_id, "u_massaggio_decontr", "Massaggio decontratturante", 50, 50, "Uomo", "Massaggi"),
+            (center_id, "u_massaggio_schiena", "Massaggio schiena", 40, 40, "Uomo", "Massaggi"),
+        ]
+        
+        # 🆕 NUOVI SERVIZI BEAUTY - DONNA (aggiuntivi)
+        new_services_donna = [
+            # Estetica
+            (center_id, "epilazione_completa_corpo", "Epilazione completa corpo", 60, 35, "Donna", "Estetica"),
+            (center_id, "sopracciglia_baffetti", "Sopracciglia / Baffetti", 20, 10, "Donna", "Estetica"),
+            (center_id, "ceretta_parziale", "Ceretta parziale (gambe o braccia)", 30, 25, "Donna", "Estetica"),
+            (center_id, "corpo_anticellulite", "Trattamento corpo anticellulite", 50, 55, "Donna", "Estetica"),
+            (center_id, "laminazione_ciglia_sopracciglia", "Laminazione ciglia / sopracciglia", 40, 40, "Donna", "Estetica"),
+            (center_id, "solarium", "Solarium", 20, 15, "Donna", "Estetica"),
+            (center_id, "trucco_giorno_sera", "Trucco giorno / sera", 45, 50, "Donna", "Estetica"),
+            
+            # Unghie
+            (center_id, "manicure_pedicure_base", "Manicure / Pedicure base", 40, 25, "Donna", "Unghie"),
+            (center_id, "smalto_semipermanente_mani", "Smalto semipermanente mani", 30, 28, "Donna", "Unghie"),
+            (center_id, "ricostruzione_unghie_gel_completa", "Ricostruzione unghie in gel", 60, 45, "Donna", "Unghie"),
+            
+            # Trattamenti Viso
+            (center_id, "pulizia_viso_base_donna", "Pulizia viso base", 40, 35, "Donna", "Trattamenti Viso"),
+            (center_id, "trattamento_viso_antiage_premium", "Trattamento viso anti-age premium", 50, 60, "Donna", "Trattamenti Viso"),
+            
+            # Massaggi
+            (center_id, "massaggio_rilassante_donna", "Massaggio rilassante completo", 50, 50, "Donna", "Massaggi"),
+            (center_id, "massaggio_drenante_gambe", "Massaggio drenante gambe", 45, 45, "Donna", "Massaggi"),
+        ]
+        
+        # 🆕 NUOVI SERVIZI BEAUTY - UOMO (aggiuntivi)
+        new_services_uomo = [
+            # Trattamenti Viso
+            (center_id, "taglio_barba_completo", "Taglio capelli + Barba", 30, 25, "Uomo", "Trattamenti Viso"),
+            (center_id, "viso_purificante_uomo", "Trattamento viso purificante uomo", 40, 38, "Uomo", "Trattamenti Viso"),
+            (center_id, "anticaduta_capelli", "Trattamento anticaduta capelli", 40, 45, "Uomo", "Trattamenti Viso"),
+            (center_id, "viso_energizzante", "Trattamento viso energizzante", 45, 42, "Uomo", "Trattamenti Viso"),
+            
+            # Massaggi
+            (center_id, "massaggio_decontratturante_uomo", "Massaggio decontratturante completo", 50, 55, "Uomo", "Massaggi"),
+            (center_id, "massaggio_rilassante_uomo_full", "Massaggio rilassante uomo", 50, 50, "Uomo", "Massaggi"),
+            (center_id, "trattamento_corpo_tonificante", "Trattamento corpo tonificante", 45, 50, "Uomo", "Massaggi"),
+            
+            # Estetica
+            (center_id, "ceretta_torace_schiena", "Ceretta torace / schiena", 35, 30, "Uomo", "Estetica"),
+            (center_id, "solarium_uomo", "Solarium uomo", 20, 15, "Uomo", "Estetica"),
+            
+            # Unghie
+            (center_id, "cura_mani_piedi_uomo", "Cura mani / piedi uomo", 40, 20, "Uomo", "Unghie"),
+        ]
+        
+        # Inserisci servizi esistenti
+        cur.executemany(
+            "INSERT INTO services(center_id, code, title, duration_minutes, price, gender, category) VALUES(?,?,?,?,?,?,?)",
+            services_data
+        )
+        
+        # Inserisci nuovi servizi Donna
+        cur.executemany(
+            "INSERT INTO services(center_id, code, title, duration_minutes, price, gender, category) VALUES(?,?,?,?,?,?,?)",
+            new_services_donna
+        )
+        
+        # Inserisci nuovi servizi Uomo
+        cur.executemany(
+            "INSERT INTO services(center_id, code, title, duration_minutes, price, gender, category) VALUES(?,?,?,?,?,?,?)",
+            new_services_uomo
+        )
+        con.commit()
+        logger.info("[MINIMAL] Dati di demo inseriti (Donna/Uomo con servizi completi).")
+    con.close()
+
+# ------------------------
+# UTENTE - SALVATAGGIO E AGGIORNAMENTO
+# ------------------------
+def save_or_update_user(user_id: int, username: str | None = None, name: str | None = None, phone: str | None = None, notes: str | None = None) -> int | None:
+    """Salva/aggiorna i dati utente su clients e mantiene la tabella legacy users."""
+    return ensure_client_for_user(user_id, username=username, name=name, phone=phone, notes=notes)
+
+# ------------------------
+# SLOT E DISPONIBILITÀ
+# ------------------------
+def parse_time_hhmm(s: str) -> time:
+    h, m = map(int, s.split(":")); return time(hour=h, minute=m)
+
+def datetime_from_date_time_str(date_str: str, time_str: str) -> datetime:
+    d = datetime.strptime(date_str, "%Y-%m-%d").date(); t = parse_time_hhmm(time_str); return datetime.combine(d, t)
+
+# start_ts/end_ts delle prenotazioni: minuti dal 1970-01-01 dell'orario locale (come se fosse
+# UTC, senza fuso), lo stesso valore di strftime('%s', date || ' ' || time) / 60 in SQLite
+EPOCH = datetime(1970, 1, 1)
+
+def to_epoch_minutes(dt: datetime) -> int:
+    return (dt - EPOCH) // timedelta(minutes=1)
+
+def booking_span(date_str: str, time_str: str, durata: int) -> tuple[int, int]:
+    """(start_ts, end_ts) di una prenotazione in minuti dall'epoca."""
+    start = to_epoch_minutes(datetime_from_date_time_str(date_str, time_str))
+    return start, start + int(durata or 0)
+
+# Template settimanali compilati ed eccezioni (schedule_module), ricaricati dal DB dopo il
+# TTL, subito con invalidate_schedules() quando cambiano orari, pause o eccezioni, e quando
+# availability_version è diversa da quella letta all'ultimo caricamento (modifiche da altri worker)
+SCHEDULE_CACHE_TTL = float(os.environ.get("SCHEDULE_CACHE_TTL", "300"))
+CENTER_WEEK = compile_week(ORARI_SETTIMANA)
+_schedules: dict[str, tuple] = {}
+_operator_hours: dict[str, tuple] = {}
+_exceptions = EMPTY_INDEX
+_schedules_loaded_at = 0.0
+_schedules_version: int | None = None
+_schedules_lock = threading.Lock()
+
+def invalidate_schedules() -> None:
+    global _schedules_loaded_at
+    _schedules_loaded_at = 0.0
+
+def _load_schedules() -> tuple[dict, dict, ExceptionIndex, int | None]:
+    con = db_conn(); cur = con.cursor()
+    # Versione letta prima delle tabelle: i dati caricati sono almeno recenti quanto lei
+    try:
+        row = cur.execute("SELECT version FROM availability_version WHERE id = 1").fetchone()
+        version = row[0] if row else None
+    except sqlite3.OperationalError:
+        version = None
+    try:
+        cur.execute("SELECT id, work_start, work_end, breaks_json FROM operators")
+    except sqlite3.OperationalError:
+        # DB non ancora migrato (manca breaks_json)
+        cur.execute("SELECT id, work_start, work_end, NULL FROM operators")
+    rows = cur.fetchall()
+    try:
+        cur.execute("SELECT id, operator_id, date_from, date_to, hours_json, note FROM schedule_exceptions")
+        exc_rows = cur.fetchall()
+    except sqlite3.OperationalError:
+        exc_rows = []
+    con.close()
+    schedules, hours = {}, {}
+    for op_id, work_start, work_end, breaks_json in rows:
+        try:
+            schedules[op_id] = compile_week(ORARI_SETTIMANA, work_start, work_end, breaks_json)
+            hours[op_id] = (work_start, work_end, breaks_json)
+        except ValueError:
+            logger.warning("Orario non valido per %s (%s-%s): uso l'orario del centro", op_id, work_start, work_end)
+            schedules[op_id] = CENTER_WEEK
+            hours[op_id] = (None, None, None)
+    exceptions = []
+    for exc_id, op_id, date_from, date_to, hours_json, note in exc_rows:
+        try:
+            exceptions.append(ScheduleException(
+                exc_id, op_id or None, date.fromisoformat(date_from), date.fromisoformat(date_to or date_from),
+                parse_hours(hours_json) if hours_json else (), note,
+            ))
+        except ValueError:
+            logger.warning("Eccezione di calendario %s non valida ignorata", exc_id)
+    return schedules, hours, ExceptionIndex(exceptions), version
+
+def _schedules_stale(version: int | None) -> bool:
+    return monotonic() - _schedules_loaded_at > SCHEDULE_CACHE_TTL or (version is not None and version != _schedules_version)
+
+def _refresh_schedules(version: int | None = None) -> None:
+    """Ricarica orari ed eccezioni se scaduti o se ``version`` (availability_version) è cambiata."""
+    global _schedules, _operator_hours, _exceptions, _schedules_loaded_at, _schedules_version
+    if _schedules_stale(version):
+        cache_miss("schedule")
+        with _schedules_lock:
+            if _schedules_stale(version):
+                _schedules, _operator_hours, _exceptions, _schedules_version = _load_schedules(); _schedules_loaded_at = monotonic()
+    else:
+        cache_hit("schedule")
+
+def operator_week(operator_id: str | None) -> tuple:
+    """Template settimanale dell'operatore (orario del centro se sconosciuto o None), senza eccezioni."""
+    if operator_id is None:
+        return CENTER_WEEK
+    _refresh_schedules()
+    return _schedules.get(operator_id, CENTER_WEEK)
+
+def schedule_exception_for(operator_id: str | None, d: date) -> ScheduleException | None:
+    """Eccezione in vigore nel giorno: prima quella dell'operatore, poi quella del centro."""
+    _refresh_schedules()
+    if operator_id is not None:
+        exc = _exceptions.lookup(operator_id, d)
+        if exc is not None:
+            return exc
+    return _exceptions.lookup(None, d)
+
+def operator_day_ranges(operator_id: str | None, d: date) -> tuple:
+    """Intervalli lavorativi (minuti) dell'operatore nel giorno ``d``; vuoto se non lavora.
+
+    Chiusure e orari speciali hanno la precedenza sul template settimanale: un orario
+    speciale dell'operatore vale così com'è, uno del centro viene ristretto al turno e
+    alle pause dell'operatore.
+    """
+    week = operator_week(operator_id)
+    exc = schedule_exception_for(operator_id, d)
+    if exc is None:
+        return week[d.weekday()]
+    if exc.closed:
+        return ()
+    if exc.operator_id is not None or operator_id is None:
+        return compile_day(exc.hours, d.weekday())
+    work_start, work_end, breaks_json = _operator_hours.get(operator_id, (None, None, None))
+    return compile_day(exc.hours, d.weekday(), work_start, work_end, breaks_json)
+
+def add_schedule_exception(date_from: str, date_to: str | None = None, operator_id: str | None = None,
+                           hours: str | None = None, note: str | None = None) -> int:
+    """Registra una chiusura (``hours`` None) o un orario speciale, es. hours="10:00-20:00"."""
+    first = date.fromisoformat(date_from); last = date.fromisoformat(date_to or date_from)
+    if last < first:
+        raise ValueError("la data finale precede quella iniziale")
+    hours_json = json.dumps([list(h) for h in parse_hours(hours)]) if hours else None
+    con = db_conn(); cur = con.cursor()
+    cur.execute(
+        "INSERT INTO schedule_exceptions(operator_id, date_from, date_to, hours_json, note, created_at) VALUES(?,?,?,?,?,?)",
+        (operator_id, first.isoformat(), last.isoformat(), hours_json, note, datetime.utcnow().isoformat()),
+    )
+    exc_id = cur.lastrowid; con.commit(); con.close()
+    invalidate_schedules()
+    return exc_id
+
+def delete_schedule_exception(exc_id: int) -> bool:
+    con = db_conn(); cur = con.cursor()
+    cur.execute("DELETE FROM schedule_exceptions WHERE id=?", (exc_id,))
+    deleted = cur.rowcount; con.commit(); con.close()
+    invalidate_schedules()
+    return deleted > 0
+
+def list_schedule_exceptions(since: str | None = None) -> list[tuple]:
+    """Eccezioni non ancora concluse: (id, operator_id, date_from, date_to, hours_json, note)."""
+    since = since or date.today().isoformat()
+    con = db_conn(); cur = con.cursor()
+    cur.execute(
+        "SELECT id, operator_id, date_from, date_to, hours_json, note FROM schedule_exceptions WHERE date_to >= ? ORDER BY date_from, id",
+        (since,),
+    )
+    rows = cur.fetchall(); con.close()
+    return rows
+
+def list_all_slots_for_day(d: date, durata: int, operator_id: str | None = None) -> List[str]:
+    """Orari di inizio possibili nel giorno secondo l'orario dell'operatore (o del centro)."""
+    return list(slot_starts(operator_day_ranges(operator_id, d), int(durata), SLOT_MINUTES))
+
+def is_within_schedule(date_str: str, time_str: str, durata: int, operator_id: str) -> bool:
+    """True se [time_str, +durata) cade nell'orario di lavoro dell'operatore."""
+    d = datetime.strptime(date_str, "%Y-%m-%d").date()
+    return fits(operator_day_ranges(operator_id, d), hhmm_to_min(time_str), int(durata))
+
+def is_slot_free_for_operator(date_str: str, time_str: str, durata: int, operator_id: str) -> bool:
+    """Verifica se uno slot è libero per un operatore.
+
+    Calcola new_start/new_end (minuti dall'epoca) e cerca in SQL, sull'indice
+    (operator_id, start_ts), una prenotazione dello stesso operatore che si sovrapponga.
+    Ritorna sempre True/False in modo affidabile.
+    Uno slot fuori orario (chiusura, ferie, pausa) non è mai libero: così conferme e
+    cascata della waitlist rispettano le eccezioni di calendario.
+    """
+    try:
+        if not is_within_schedule(date_str, time_str, durata, operator_id):
+            return False
+    except ValueError:
+        return False
+    try:
+        new_start, new_end = booking_span(date_str, time_str, durata)
+    except ValueError:
+        return False
+    con = None
+    try:
+        con = db_conn()
+        # [new_start,new_end) e [start_ts,end_ts) si intersecano; il limite inferiore tiene la
+        # scansione dell'indice (operator_id, start_ts) entro un giorno prima dello slot
+        row = con.execute(
+            "SELECT 1 FROM bookings WHERE operator_id=? AND start_ts >= ? AND start_ts < ? AND end_ts > ? AND "
+            + ACTIVE_BOOKING_SQL + " LIMIT 1",
+            (operator_id, new_start - DAY_MINUTES, new_end, new_start),
+        ).fetchone()
+    except Exception as e:
+        logger.debug("Errore DB in is_slot_free_for_operator: %s", e)
+        # Conservativo: considera non libero in caso di errore DB
+        return False
+    finally:
+        try:
+            if con:
+                con.close()
+        except Exception:
+            pass
+    return row is None
+
+def booked_ranges(con, date_str: str, operator_id: str) -> list[tuple[int, int]]:
+    """Prenotazioni dell'operatore nel giorno come intervalli (inizio, fine) in minuti."""
+    cur = con.execute("SELECT time, duration FROM bookings WHERE date=? AND operator_id=? AND " + ACTIVE_BOOKING_SQL, (date_str, operator_id))
+    return [(hhmm_to_min(t), hhmm_to_min(t) + int(d or 0)) for t, d in cur.fetchall()]
+
+def free_starts(day_ranges: tuple, booked: list[tuple[int, int]], durata: int, not_before: int = 0) -> List[int]:
+    """Minuti di inizio liberi (passo SLOT_MINUTES) dati orario del giorno e prenotazioni."""
+    out = []
+    for label in slot_starts(day_ranges, durata, SLOT_MINUTES):
+        start = hhmm_to_min(label)
+        if start < not_before:
+            continue
+        end = start + durata
+        if all(end <= b_start or start >= b_end for b_start, b_end in booked):
+            out.append(start)
+    return out
+
+def free_slots_for_operator(d: date, durata: int, operator_id: str) -> List[str]:
+    # Una sola query per giorno (prima: una per ogni slot candidato)
+    day_ranges = operator_day_ranges(operator_id, d)
+    if not day_ranges:
+        return []
+    try:
+        con = db_conn()
+        try:
+            booked = booked_ranges(con, d.strftime("%Y-%m-%d"), operator_id)
+        finally:
+            con.close()
+    except Exception as e:
+        logger.debug("Errore DB in free_slots_for_operator: %s", e)
+        return []
+    return [min_to_hhmm(m) for m in free_starts(day_ranges, booked, int(durata))]
+
+# Ricerca "Prima disponibilità": orizzonte in giorni e numero di slot proposti
+FIRST_AVAILABLE_DAYS = int(os.environ.get("FIRST_AVAILABLE_DAYS", "60"))
+FIRST_AVAILABLE_COUNT = int(os.environ.get("FIRST_AVAILABLE_COUNT", "6"))
+
+def first_available_slots(durata: int, n: int = FIRST_AVAILABLE_COUNT, horizon_days: int = FIRST_AVAILABLE_DAYS,
+                          now: datetime | None = None, operator_ids: list[str] | None = None) -> list[tuple[date, str, str]]:
+    """Gli ``n`` slot liberi più vicini tra tutti gli operatori: [(giorno, "HH:MM", op_id)].
+
+    Ricerca best-first su un heap di nodi (giorno, minuto, operatore). Un nodo "giorno"
+    ha come chiave l'inizio del suo orario (limite inferiore di ogni suo slot): quando
+    esce dall'heap si leggono le prenotazioni di quel giorno (una query) e si inseriscono
+    i suoi slot liberi come nodi finali, più il giorno lavorativo successivo dello stesso
+    operatore. Gli slot escono in ordine cronologico e la ricerca si ferma al n-esimo;
+    i giorni in cui l'operatore non lavora non costano query.
+    """
+    now = now or datetime.now()
+    today = now.date(); last_day = today + timedelta(days=horizon_days)
+    durata = int(durata)
+    if operator_ids is None:
+        con = db_conn(); operator_ids = [r[0] for r in con.execute("SELECT id FROM operators ORDER BY name").fetchall()]; con.close()
+
+    def next_working_day(op_id: str, d: date):
+        while d <= last_day:
+            ranges = operator_day_ranges(op_id, d)
+            if ranges and slot_starts(ranges, durata, SLOT_MINUTES):
+                return d, ranges
+            d += timedelta(days=1)
+        return None, ()
+
+    heap: list = []
+    for op_id in operator_ids:
+        d, ranges = next_working_day(op_id, today)
+        if d is not None:
+            # (giorno, minuto, 0 = giorno da espandere, op_id, intervalli)
+            heapq.heappush(heap, (d, ranges[0][0], 0, op_id, ranges))
+    results: list[tuple[date, str, str]] = []
+    con = db_conn()
+    try:
+        while heap and len(results) < n:
+            d, minute, is_slot, op_id, ranges = heapq.heappop(heap)
+            if is_slot:
+                results.append((d, min_to_hhmm(minute), op_id))
+                continue
+            not_before = now.hour * 60 + now.minute if d == today else 0
+            for start in free_starts(ranges, booked_ranges(con, d.isoformat(), op_id), durata, not_before):
+                heapq.heappush(heap, (d, start, 1, op_id, ()))
+            nd, nranges = next_working_day(op_id, d + timedelta(days=1))
+            if nd is not None:
+                heapq.heappush(heap, (nd, nranges[0][0], 0, op_id, nranges))
+    finally:
+        con.close()
+    return results
+
+# Assegnazione automatica ("Indifferente"): valore di operator_id finché non si conferma
+ANY_OPERATOR = "any"
+
+def operator_ids() -> List[str]:
+    """Operatori noti (dalla cache degli orari, senza query)."""
+    _refresh_schedules()
+    return sorted(_schedules)
+
+def _capacity_minutes(ranges: tuple) -> int:
+    return sum(e - s for s, e in ranges)
+
+def load_occupancy(con, d: date) -> tuple[dict, dict]:
+    """Prenotazioni della settimana di ``d`` con una sola query.
+
+    Restituisce (intervalli prenotati nel giorno per operatore, minuti prenotati nella
+    settimana per operatore): la stessa lettura serve a disponibilità e carico.
+    """
+    monday = d - timedelta(days=d.weekday()); sunday = monday + timedelta(days=6)
+    day_str = d.isoformat()
+    cur = con.execute(
+        "SELECT operator_id, date, time, duration FROM bookings WHERE date BETWEEN ? AND ? AND " + ACTIVE_BOOKING_SQL,
+        (monday.isoformat(), sunday.isoformat()),
+    )
+    day: dict[str, list] = {}; week: dict[str, int] = {}
+    for op_id, ds, t, dur in cur.fetchall():
+        dur = int(dur or 0)
+        week[op_id] = week.get(op_id, 0) + dur
+        if ds == day_str:
+            start = hhmm_to_min(t)
+            day.setdefault(op_id, []).append((start, start + dur))
+    return day, week
+
+def free_slots_any_operator(d: date, durata: int) -> List[str]:
+    """Orari in cui almeno un operatore è libero nel giorno (una query in tutto)."""
+    con = db_conn()
+    try:
+        day, _ = load_occupancy(con, d)
+    finally:
+        con.close()
+    starts: set[int] = set()
+    for op_id in operator_ids():
+        ranges = operator_day_ranges(op_id, d)
+        if ranges:
+            starts.update(free_starts(ranges, day.get(op_id, []), int(durata)))
+    return [min_to_hhmm(m) for m in sorted(starts)]
+
+def assign_least_loaded(date_str: str, time_str: str, durata: int) -> tuple[str | None, list[dict]]:
+    """Sceglie tra gli operatori liberi a quell'ora quello meno carico.
+
+    Carico = minuti prenotati / minuti di orario, prima nel giorno poi nella settimana
+    (a parità vince l'id); il turno più corto di un operatore non lo penalizza. Restituisce
+    (operatore scelto o None se nessuno è libero, candidati con i loro carichi).
+    """
+    d = date.fromisoformat(date_str); start = hhmm_to_min(time_str); durata = int(durata)
+    monday = d - timedelta(days=d.weekday())
+    con = db_conn()
+    try:
+        day, week = load_occupancy(con, d)
+    finally:
+        con.close()
+    candidates = []
+    for op_id in operator_ids():
+        ranges = operator_day_ranges(op_id, d)
+        if not fits(ranges, start, durata):
+            continue
+        booked = day.get(op_id, [])
+        if not all(start + durata <= b_start or start >= b_end for b_start, b_end in booked):
+            continue
+        day_capacity = _capacity_minutes(ranges)
+        week_capacity = sum(_capacity_minutes(operator_day_ranges(op_id, monday + timedelta(days=i))) for i in range(7))
+        candidates.append({
+            "operator_id": op_id,
+            "day_load": round(sum(e - s for s, e in booked) / day_capacity, 3) if day_capacity else 1.0,
+            "week_load": round(week.get(op_id, 0) / week_capacity, 3) if week_capacity else 1.0,
+        })
+    if not candidates:
+        return None, []
+    chosen = min(candidates, key=lambda c: (c["day_load"], c["week_load"], c["operator_id"]))
+    return chosen["operator_id"], candidates
+
+def record_assignment(booking_id: int | None, user_id: int | None, service_code: str, date_str: str, time_str: str,
+                      chosen: str, candidates: list[dict]) -> None:
+    """Traccia nel DB (assignment_audit) e nel log una scelta automatica dell'operatore."""
+    con = db_conn()
+    try:
+        con.execute(
+            "INSERT INTO assignment_audit(booking_id, user_id, service_code, date, time, operator_id, candidates_json, created_at) VALUES(?,?,?,?,?,?,?,?)",
+            (booking_id, user_id, service_code, date_str, time_str, chosen, json.dumps(candidates), datetime.utcnow().isoformat()),
+        )
+        con.commit()
+    finally:
+        con.close()
+    logger.info("Operatore assegnato automaticamente: %s per %s %s (booking=%s)", chosen, date_str, time_str, booking_id,
+                extra={"event": "operator_assigned", "booking_id": booking_id, "candidates": candidates})
+
+# Pacchetti: più trattamenti consecutivi nella stessa visita
+PACKAGE_MAX_SERVICES = int(os.environ.get("PACKAGE_MAX_SERVICES", "3"))
+PACKAGE_OPTIONS = int(os.environ.get("PACKAGE_OPTIONS", "6"))
+
+def bookings_by_operator(con, date_str: str) -> dict[str, list[tuple[int, int]]]:
+    """Prenotazioni del giorno per operatore (una query): {op_id: [(inizio, fine), ...]}."""
+    out: dict[str, list] = {}
+    for op_id, t, dur in con.execute("SELECT operator_id, time, duration FROM bookings WHERE date=? AND " + ACTIVE_BOOKING_SQL, (date_str,)).fetchall():
+        start = hhmm_to_min(t)
+        out.setdefault(op_id, []).append((start, start + int(dur or 0)))
+    return out
+
+def free_mask(day_ranges: tuple, booked: list[tuple[int, int]], unit: int = MASK_UNIT) -> int:
+    """Bitmask delle unità lavorative e non prenotate (prenotazioni arrotondate per eccesso)."""
+    mask = availability_mask(day_ranges, unit)
+    for start, end in booked:
+        first, last = start // unit, -(-end // unit)
+        if last > first:
+            mask &= ~(((1 << (last - first)) - 1) << first)
+    return mask
+
+def fit_mask(free: int, units: int) -> int:
+    """Bit s acceso se le unità [s, s+units) sono tutte libere (AND di ``free`` traslata)."""
+    fit = free
+    shift = 1
+    # Raddoppio: log2(units) AND invece di units
+    while shift < units and fit:
+        step = min(shift, units - shift)
+        fit &= fit >> step
+        shift += step
+    return fit
+
+def package_sequences(durations: list[int], d: date, booked: dict[str, list], ops: list[str],
+                      not_before: int = 0, limit: int = PACKAGE_OPTIONS) -> list[list[tuple[int, str]]]:
+    """Sequenze consecutive possibili nel giorno: [[(minuto di inizio, op_id) per servizio], ...].
+
+    Per ogni operatore e servizio la maschera degli inizi possibili è ``fit_mask`` sulla
+    sua maschera libera; l'unione tra operatori, traslata della durata dei servizi
+    precedenti, si interseca con quella del primo servizio. I bit rimasti sono inizi
+    di sequenze senza buchi; a ogni servizio va il primo operatore libero, preferendo
+    chi ha fatto il servizio precedente. Gli intervalli dei servizi sono disgiunti,
+    quindi lo stesso operatore può farli tutti.
+    """
+    unit = MASK_UNIT
+    units = [-(-int(dur) // unit) for dur in durations]
+    free = {op: free_mask(operator_day_ranges(op, d), booked.get(op, []), unit) for op in ops}
+    fits_by_service = [{op: fit_mask(free[op], k) for op in ops} for k in units]
+    chain = 0
+    for op in ops:
+        chain |= fits_by_service[0][op]
+    offset = 0
+    for i in range(1, len(units)):
+        offset += units[i - 1]
+        any_op = 0
+        for op in ops:
+            any_op |= fits_by_service[i][op]
+        chain &= any_op >> offset
+        if not chain:
+            return []
+    # Inizi allineati agli slot del calendario e non nel passato, dal più presto
+    chain &= ~((1 << -(-not_before // unit)) - 1)
+    out = []
+    while chain and len(out) < limit:
+        low = chain & -chain
+        chain ^= low
+        bit = low.bit_length() - 1
+        if (bit * unit) % SLOT_MINUTES:
+            continue
+        sequence, cursor, previous = [], bit, None
+        for i, k in enumerate(units):
+            mine = fits_by_service[i]
+            op = previous if previous is not None and mine[previous] >> cursor & 1 else next(o for o in ops if mine[o] >> cursor & 1)
+            sequence.append((cursor * unit, op))
+            previous = op; cursor += k
+        out.append(sequence)
+    return out
+
+def first_package_slots(services: list[dict], n: int = PACKAGE_OPTIONS, horizon_days: int = FIRST_AVAILABLE_DAYS,
+                        now: datetime | None = None) -> list[tuple[date, list[tuple[str, str, str]]]]:
+    """Le prime ``n`` sequenze consecutive dei servizi: [(giorno, [(codice, "HH:MM", op_id), ...])].
+
+    Una query per giorno visitato; i giorni in cui nessuno lavora non costano query.
+    """
+    now = now or datetime.now()
+    today = now.date()
+    durations = [int(s["durata"]) for s in services]
+    ops = operator_ids()
+    results: list = []
+    con = db_conn()
+    try:
+        for offset in range(horizon_days + 1):
+            d = today + timedelta(days=offset)
+            if not any(operator_day_ranges(op, d) for op in ops):
+                continue
+            not_before = now.hour * 60 + now.minute if d == today else 0
+            for sequence in package_sequences(durations, d, bookings_by_operator(con, d.isoformat()), ops, not_before, n - len(results)):
+                results.append((d, [(svc["code"], min_to_hhmm(start), op) for svc, (start, op) in zip(services, sequence)]))
+            if len(results) >= n:
+                break
+    finally:
+        con.close()
+    return results
+
+class StatementCount:
+    """Statement eseguiti da SQLite su una connessione (``set_trace_callback``), trigger compresi."""
+    __slots__ = ("n",)
+
+    def __init__(self):
+        self.n = 0
+
+    def __call__(self, sql: str) -> None:
+        self.n += 1
+
+
+def _booking_connection():
+    con = db_conn()
+    con.isolation_level = None
+    counter = StatementCount()
+    con.set_trace_callback(counter)
+    return con, counter
+
+
+def _insert_booking(con, user_id: int, client_id: int, center_id: int, svc: dict, date_str: str, time_str: str, op_id: str) -> int:
+    cur = con.execute(
+        """
+        INSERT INTO bookings (
+            user_id, client_id, center_id,
+            service_code, service_name,
+            date, time, duration,
+            operator_id, price, created_at,
+            status, reminder_sent, start_ts, end_ts
+        ) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)
+        """,
+        (user_id, client_id, center_id, svc["code"], svc["nome"], date_str, time_str, svc["durata"],
+         op_id, normalize_price(svc.get("prezzo")), datetime.utcnow().isoformat(), "CONFIRMED", 0,
+         *booking_span(date_str, time_str, svc["durata"])),
+    )
+    return cur.lastrowid
+
+
+def _slot_still_free(con, svc: dict, date_str: str, time_str: str, op_id: str, booked_by_day: dict) -> bool:
+    """Da chiamare con il lock di scrittura preso: orario e sovrapposizioni riletti dal DB.
+
+    Se lo slot è libero lo aggiunge a ``booked_by_day`` ({data: {op_id: [(inizio, fine)]}}),
+    così le voci successive della stessa transazione lo vedono occupato.
+    """
+    start = hhmm_to_min(time_str); durata = int(svc["durata"]); end = start + durata
+    if not fits(operator_day_ranges(op_id, date.fromisoformat(date_str)), start, durata):
+        return False
+    booked = booked_by_day.setdefault(date_str, bookings_by_operator(con, date_str)).setdefault(op_id, [])
+    if not all(end <= b_start or start >= b_end for b_start, b_end in booked):
+        return False
+    booked.append((start, end))
+    return True
+
+
+def save_booking(user_id: int, svc: dict, date_str: str, time_str: str, op_id: str, client: dict | None = None,
+                 waitlist_entry_id: int | None = None, clear_waitlist: bool = False) -> tuple[int, int] | None:
+    """Unità di lavoro di una conferma: client, prenotazione e lista d'attesa in una transazione.
+
+    ``client`` = campi di :func:`upsert_client` (username, name, phone, notes). La voce di
+    waitlist rimossa è ``waitlist_entry_id`` oppure, con ``clear_waitlist``, quelle
+    dell'utente per la stessa data e servizio. Con il lock di scrittura preso (BEGIN
+    IMMEDIATE) ricontrolla lo slot: se nel frattempo è stato preso annulla e restituisce
+    None, altrimenti (id prenotazione, voci rimosse).
+    """
+    con, statements = _booking_connection()
+    try:
+        con.execute("BEGIN IMMEDIATE")
+        if not _slot_still_free(con, svc, date_str, time_str, op_id, {}):
+            con.execute("ROLLBACK"); return None
+        client_id = upsert_client(con, user_id, **(client or {}))
+        booking_id = _insert_booking(con, user_id, client_id, default_center_id(con), svc, date_str, time_str, op_id)
+        removed = 0
+        if waitlist_entry_id is not None:
+            removed = con.execute("DELETE FROM waitlist WHERE id=?", (waitlist_entry_id,)).rowcount
+        elif clear_waitlist:
+            removed = con.execute("DELETE FROM waitlist WHERE user_id=? AND date=? AND service_code=?",
+                                  (user_id, date_str, svc["code"])).rowcount
+        con.execute("COMMIT")
+    except Exception:
+        if con.in_transaction:
+            con.execute("ROLLBACK")
+        raise
+    finally:
+        con.close()
+    BOOKING_STATEMENTS.observe(statements.n, "booking" if waitlist_entry_id is None else "waitlist_accept")
+    return booking_id, removed
+
+def book_package(user_id: int, items: list[tuple[dict, str, str, str]], client: dict | None = None) -> list[int] | None:
+    """Salva tutti i trattamenti del pacchetto (e il client) in una sola transazione, o nessuno.
+
+    ``items`` = [(servizio, data, ora, op_id)]. Con il lock di scrittura preso (BEGIN
+    IMMEDIATE) ricontrolla orario e sovrapposizioni di ogni voce; se una non è più
+    libera annulla tutto e restituisce None, altrimenti gli id delle prenotazioni.
+    """
+    con, statements = _booking_connection()
+    try:
+        con.execute("BEGIN IMMEDIATE")
+        booked_by_day: dict[str, dict] = {}
+        ids = []
+        for svc, date_str, time_str, op_id in items:
+            if not _slot_still_free(con, svc, date_str, time_str, op_id, booked_by_day):
+                con.execute("ROLLBACK"); return None
+        # Tutte le voci sono libere (le successive vedono anche le precedenti): si scrive
+        client_id = upsert_client(con, user_id, **(client or {}))
+        center_id = default_center_id(con)
+        for svc, date_str, time_str, op_id in items:
+            ids.append(_insert_booking(con, user_id, client_id, center_id, svc, date_str, time_str, op_id))
+        con.execute("COMMIT")
+    except Exception:
+        if con.in_transaction:
+            con.execute("ROLLBACK")
+        raise
+    finally:
+        con.close()
+    BOOKING_STATEMENTS.observe(statements.n / max(1, len(ids)), "package")
+    return ids
+
+def bulk_update_bookings(date_from: str, date_to: str, operator_ids: list[str] | None, cancel: bool) -> tuple[int, list[tuple]]:
+    """Disdice (status CANCELLED) o elimina in blocco le prenotazioni di un periodo.
+
+    ``operator_ids`` None = tutte le operatrici. Un solo statement set-based (UPDATE o
+    DELETE ... RETURNING) in una transazione. Restituisce (righe toccate, intervalli
+    liberati) con intervalli = [(data, ora, durata, op_id)] delle prenotazioni che erano attive.
+    """
+    where = "date BETWEEN ? AND ?"
+    params: list = [date_from, date_to]
+    if operator_ids:
+        where += f" AND operator_id IN ({','.join('?' * len(operator_ids))})"
+        params += operator_ids
+    if cancel:
+        sql = (f"UPDATE bookings SET status='CANCELLED' WHERE {where} AND {ACTIVE_BOOKING_SQL} "
+               "RETURNING date, time, duration, operator_id, 'ACTIVE'")
+    else:
+        sql = f"DELETE FROM bookings WHERE {where} RETURNING date, time, duration, operator_id, status"
+    con = db_conn()
+    try:
+        con.isolation_level = None
+        con.execute("BEGIN IMMEDIATE")
+        rows = con.execute(sql, params).fetchall()
+        con.execute("COMMIT")
+    except Exception:
+        if con.in_transaction:
+            con.execute("ROLLBACK")
+        raise
+    finally:
+        con.close()
+    freed = sorted((d, t, int(dur or 0), op) for d, t, dur, op, status in rows if status != "CANCELLED")
+    return len(rows), freed
+
+# Offerte non accettate più vecchie di così vengono eliminate alla prossima offerta
+SLOT_OFFER_TTL_DAYS = int(os.environ.get("SLOT_OFFER_TTL_DAYS", "7"))
+
+def save_slot_offer(waitlist_id: int, date_str: str, time_str: str, op_id: str, svc_code: str) -> None:
+    """Registra lo slot proposto alla voce ``waitlist_id`` (sostituisce un'offerta precedente)."""
+    con = db_conn()
+    try:
+        con.execute("DELETE FROM slot_offers WHERE created_at < ?",
+                    ((datetime.utcnow() - timedelta(days=SLOT_OFFER_TTL_DAYS)).isoformat(),))
+        con.execute(
+            "INSERT OR REPLACE INTO slot_offers (waitlist_id, date, time, operator_id, service_code, created_at) VALUES (?,?,?,?,?,?)",
+            (waitlist_id, date_str, time_str, op_id, svc_code, datetime.utcnow().isoformat()),
+        )
+        con.commit()
+    finally:
+        con.close()
+
+def take_slot_offer(waitlist_id: int) -> dict | None:
+    """Legge e consuma l'offerta (uso singolo, atomico tra worker); None se scaduta o già usata."""
+    con = db_conn()
+    try:
+        row = con.execute(
+            "DELETE FROM slot_offers WHERE waitlist_id=? RETURNING date, time, operator_id, service_code", (waitlist_id,),
+        ).fetchone()
+        con.commit()
+    finally:
+        con.close()
+    if row is None:
+        return None
+    return {"date": row[0], "time": row[1], "op_id": row[2], "svc_code": row[3], "waitlist_id": waitlist_id}
+
+def match_waitlist(freed: list[tuple]) -> list[tuple]:
+    """Un solo passaggio di abbinamento tra intervalli liberati e lista d'attesa.
+
+    ``freed`` = [(data, ora, durata, op_id)]. Legge in una query la waitlist del periodo
+    e, per ogni giorno, una volta le prenotazioni rimaste; per ogni (data, servizio) in
+    attesa sceglie il primo orario libero che cade in un intervallo liberato. Un orario
+    già proposto a un servizio non viene proposto a un altro. Restituisce
+    [(data, ora, op_id, codice servizio, nome servizio, voci [{"id", "user_id"}])].
+    """
+    if not freed:
+        return []
+    by_day: dict[str, list] = {}
+    for d, t, dur, op in freed:
+        start = hhmm_to_min(t)
+        by_day.setdefault(d, []).append((op, start, start + dur))
+    con = db_conn()
+    try:
+        waiting = con.execute(
+            "SELECT w.id, w.user_id, w.date, w.service_code, s.title, s.duration_minutes FROM waitlist w "
+            "JOIN services s ON s.code = w.service_code WHERE w.date BETWEEN ? AND ? ORDER BY w.date, w.id",
+            (min(by_day), max(by_day)),
+        ).fetchall()
+        groups: dict[tuple, dict] = {}
+        for wid, uid, d, code, title, dur in waiting:
+            if d in by_day and dur:
+                group = groups.setdefault((d, code), {"name": title or code, "durata": int(dur), "entries": []})
+                group["entries"].append({"id": wid, "user_id": uid})
+        booked_by_day = {d: bookings_by_operator(con, d) for d in {d for d, _ in groups}}
+    finally:
+        con.close()
+    matches = []
+    for (d, code), group in sorted(groups.items()):
+        day = date.fromisoformat(d)
+        durata = group["durata"]
+        booked = booked_by_day[d]
+        candidates = []
+        for op, lo, hi in by_day[d]:
+            for start in free_starts(operator_day_ranges(op, day), booked.get(op, []), durata):
+                if lo <= start < hi:
+                    candidates.append((start, op))
+        if not candidates:
+            continue
+        start, op = min(candidates)
+        # Lo stesso orario non va proposto a due servizi diversi
+        booked.setdefault(op, []).append((start, start + durata))
+        matches.append((d, min_to_hhmm(start), op, code, group["name"], group["entries"]))
+    return matches
+
+def month_availability(operator_ids: list[str], durata: int, year: int, month: int, months: int = 12,
+                       now: datetime | None = None) -> dict[tuple[int, int], tuple[int, int]]:
+    """Giorni con almeno uno slot libero e giorni lavorativi per ciascuno di ``months`` mesi.
+
+    Una sola query per tutte le prenotazioni dell'intervallo; per ogni giorno la
+    disponibilità è una bitmask (template dell'operatore meno prenotazioni) intersecata
+    con gli inizi di slot del giorno (gli stessi di free_starts, passo SLOT_MINUTES da ogni
+    intervallo). I giorni passati non contano.
+    Restituisce {(anno, mese): (giorni liberi, giorni lavorativi)}.
+    """
+    now = now or datetime.now()
+    today = now.date(); durata = int(durata)
+    first = date(year, month, 1)
+    end_y, end_m = year + (month - 1 + months) // 12, (month - 1 + months) % 12 + 1
+    last = date(end_y, end_m, 1) - timedelta(days=1)
+    start = max(first, today)
+    out = {(year + (month - 1 + i) // 12, (month - 1 + i) % 12 + 1): (0, 0) for i in range(months)}
+    if last < start:
+        return out
+    con = db_conn()
+    try:
+        rows = con.execute(
+            "SELECT operator_id, date, time, duration FROM bookings WHERE date BETWEEN ? AND ? AND " + ACTIVE_BOOKING_SQL,
+            (start.isoformat(), last.isoformat()),
+        ).fetchall()
+    finally:
+        con.close()
+    booked: dict[tuple[str, str], list] = {}
+    for op_id, ds, t, dur in rows:
+        s = hhmm_to_min(t)
+        booked.setdefault((op_id, ds), []).append((s, s + int(dur or 0)))
+    units = -(-durata // MASK_UNIT)
+    d = start
+    while d <= last:
+        ds = d.isoformat()
+        not_before = now.hour * 60 + now.minute if d == today else 0
+        later = ~((1 << -(-not_before // MASK_UNIT)) - 1)
+        working = free = False
+        for op_id in operator_ids:
+            ranges = operator_day_ranges(op_id, d)
+            if not ranges:
+                continue
+            working = True
+            starts = start_mask(ranges, durata, SLOT_MINUTES)
+            if starts is None:
+                # Orari fuori dalla griglia della bitmask: controllo esatto slot per slot
+                free = bool(free_starts(ranges, booked.get((op_id, ds), []), durata, not_before))
+            else:
+                free = bool(fit_mask(free_mask(ranges, booked.get((op_id, ds), [])), units) & starts & later)
+            if free:
+                break
+        if working:
+            free_days, working_days = out[(d.year, d.month)]
+            out[(d.year, d.month)] = (free_days + free, working_days + 1)
+        d += timedelta(days=1)
+    return out
+
+def day_status_symbol(d: date, durata: int) -> str:
+    # Usa DB per operatori
+    con = db_conn(); cur = con.cursor()
+    cur.execute("SELECT id FROM operators")
+    operators = cur.fetchall()
+    con.close()
+    working = False
+    for op in operators:
+        # Salta chi quel giorno non lavora (orario, ferie, chiusure) senza interrogare le prenotazioni
+        if not operator_day_ranges(op[0], d): continue
+        working = True
+        if free_slots_for_operator(d, durata, op[0]): return "🟢"
+    return "🔴" if working else ""
+
+# Operatrici
+
+def operator_name(op_id: str) -> str:
+    # Usa DB invece di OPERATRICI hardcoded
+    con = db_conn(); cur = con.cursor()
+    cur.execute("SELECT name FROM operators WHERE id=?", (op_id,))
+    row = cur.fetchone()
+    con.close()
+    return row[0] if row else "—"
+
+# Catalogo / prezzi
+
+def find_service_by_code(code: str) -> dict | None:
+    """Restituisce il dizionario del servizio corrispondente al codice (da DB)."""
+    con = db_conn(); cur = con.cursor()
+    cur.execute("SELECT code, title, duration_minutes, price FROM services WHERE code=?", (code,))
+    row = cur.fetchone()
+    con.close()
+    if row:
+        return {
+            "code": row[0],
+            "nome": row[1],
+            "durata": row[2],
+            "prezzo": row[3]
+        }
+    return None
+
+def normalize_price(value) -> float:
+    """Normalizza il prezzo in un float.
+
+    Accetta numeri, stringhe con simbolo € o virgole, spazi; altrimenti 0.0.
+    """
+    if value is None:
+        return 0.0
+    if isinstance(value, (int, float)):
+        return float(value)
+    if isinstance(value, str):
+        v = value.strip().replace("€", "").replace(" ", "").replace(",", ".")
+        try:
+            return float(v)
+        except Exception:
+            return 0.0
+    return 0.0
+
+def format_price_eur(value) -> str:
+    """Formatta un prezzo in euro, con fallback a '—'."""
+    try:
+        if value is None:
+            return "—"
+        v = float(value)
+        return f"€{v:.2f}"
+    except Exception:
+        return "—"
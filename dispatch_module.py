@@ -0,0 +1,308 @@
+# -*- coding: utf-8 -*-
+"""
+Modulo dispatch - instradamento dei callback dei bottoni inline.
+
+Ogni variante dichiara una tabella di rotte (prefisso o valore esatto -> handler)
+invece di una catena di `if data.startswith(...)`. La ricerca è un dizionario per
+i valori esatti più un dizionario per ciascuna lunghezza di prefisso registrata
+(pochi accessi a prescindere dal numero di rotte). Il payload dopo il prefisso viene
+convertito nei tipi dichiarati dalla rotta; se non è valido si passa al fallback.
+Per ogni rotta vengono contati chiamate, errori, payload non validi e tempi.
+
+Le rotte con effetti non ripetibili (conferme, disdette) si registrano con
+``dedup=True``: un secondo tocco dello stesso utente sullo stesso bottone dello stesso
+messaggio entro `CALLBACK_DEDUP_SECONDS` non riesegue l'handler e restituisce l'esito
+del primo (vedi `CallbackDedup`).
+"""
+import logging, os, time
+from collections import OrderedDict
+from dataclasses import dataclass
+
+from metrics_module import CALLBACK_DUPLICATES, CALLBACK_LATENCY, CALLBACK_ERRORS, CALLBACK_INVALID
+
+logger = logging.getLogger(__name__)
+
+# Oltre questa durata (ms) il callback viene segnalato nel log
+CALLBACK_SLOW_MS = float(os.environ.get("CALLBACK_SLOW_MS", "500"))
+# Finestra (secondi) in cui un tocco ripetuto sullo stesso bottone è un doppione; 0 = disattivato
+CALLBACK_DEDUP_SECONDS = float(os.environ.get("CALLBACK_DEDUP_SECONDS", "10"))
+CALLBACK_DEDUP_MAX = int(os.environ.get("CALLBACK_DEDUP_MAX", "10000"))
+# Risposta mostrata (toast) al tocco ripetuto
+DUPLICATE_ANSWER = "⏳ Richiesta già ricevuta."
+
+
+def fields(*types, sep: str = "_"):
+    """Parser di payload a campi: ``fields(int, int)`` trasforma "2025_10" in (2025, 10).
+
+    L'ultimo campo prende il resto della stringa (può contenere il separatore).
+    """
+    def parse(payload: str) -> tuple:
+        parts = payload.split(sep, len(types) - 1)
+        if len(parts) != len(types):
+            raise ValueError(f"attesi {len(types)} campi in {payload!r}")
+        return tuple(t(p) for t, p in zip(types, parts))
+    return parse
+
+
+def text(payload: str) -> tuple:
+    """Parser di default: il payload come unica stringa."""
+    return (payload,)
+
+
+def no_payload(payload: str) -> tuple:
+    return ()
+
+
+@dataclass
+class RouteStats:
+    calls: int = 0
+    errors: int = 0
+    invalid: int = 0
+    total_ms: float = 0.0
+    max_ms: float = 0.0
+
+    @property
+    def avg_ms(self) -> float:
+        return self.total_ms / self.calls if self.calls else 0.0
+
+
+@dataclass
+class Route:
+    name: str
+    handler: object
+    parse: object
+    stats: RouteStats
+    dedup: bool = False
+
+
+_PENDING = object()
+
+
+def _callback_key(q) -> tuple | None:
+    if getattr(q, "inline_message_id", None):
+        where = q.inline_message_id
+    elif getattr(q, "message", None) is not None:
+        where = (q.message.chat_id, q.message.message_id)
+    else:
+        return None
+    return (q.from_user.id, where, q.data)
+
+
+class CallbackDedup:
+    """Esiti recenti per (utente, messaggio, callback data), scaduti dopo ``window`` secondi.
+
+    Il primo tocco esegue l'handler e ne memorizza il valore di ritorno (es. lo stato
+    della conversazione); i tocchi uguali successivi, anche mentre il primo è ancora in
+    corso, ricevono quel valore senza rieseguire nulla. Se l'handler solleva un'eccezione
+    l'esito non viene memorizzato e un nuovo tocco è di nuovo valido.
+    """
+
+    def __init__(self, window: float = CALLBACK_DEDUP_SECONDS, maxsize: int = CALLBACK_DEDUP_MAX):
+        self.window = window
+        self.maxsize = max(1, maxsize)
+        # chiave -> (scadenza, esito); in ordine di scadenza
+        self._seen: OrderedDict = OrderedDict()
+
+    def _prune(self, now: float) -> None:
+        while self._seen:
+            key, (expires, _) = next(iter(self._seen.items()))
+            if expires > now and len(self._seen) <= self.maxsize:
+                break
+            self._seen.popitem(last=False)
+
+    def lookup(self, q):
+        """(chiave, esito precedente) per il callback ``q``; esito ``_PENDING`` se in corso.
+
+        Chiave None = deduplicazione non applicabile; esito None = primo tocco.
+        """
+        key = _callback_key(q) if self.window > 0 else None
+        if key is None:
+            return None, None
+        now = time.monotonic()
+        self._prune(now)
+        entry = self._seen.get(key)
+        if entry is not None:
+            return key, entry
+        self._seen[key] = (now + self.window, _PENDING)
+        return key, None
+
+    def store(self, key, outcome) -> None:
+        self._seen.pop(key, None)
+        self._seen[key] = (time.monotonic() + self.window, outcome)
+
+    def forget(self, key) -> None:
+        self._seen.pop(key, None)
+
+    async def run(self, router: str, route: str, update, call):
+        """Esegue ``call()`` al primo tocco; ai doppioni risponde e restituisce l'esito del primo."""
+        q = update.callback_query
+        key, previous = self.lookup(q)
+        if previous is not None:
+            CALLBACK_DUPLICATES.inc(router, route)
+            logger.info("[%s] tocco ripetuto ignorato su %s", router, route,
+                        extra={"event": "callback_duplicate", "route": route})
+            try:
+                await q.answer(DUPLICATE_ANSWER)
+            except Exception:
+                pass
+            outcome = previous[1]
+            return None if outcome is _PENDING else outcome
+        try:
+            outcome = await call()
+        except BaseException:
+            if key is not None:
+                self.forget(key)
+            raise
+        if key is not None:
+            self.store(key, outcome)
+        return outcome
+
+
+DEDUP = CallbackDedup()
+
+
+def deduplicated(router: str, route: str | None = None):
+    """Decoratore per handler ``(update, context)`` fuori da un CallbackRouter (es. stati
+    della ConversationHandler): i tocchi ripetuti non rieseguono l'handler."""
+    def decorator(handler):
+        name = route or handler.__name__
+
+        async def wrapper(update, context, *args):
+            return await DEDUP.run(router, name, update, lambda: handler(update, context, *args))
+        wrapper.__name__ = handler.__name__
+        wrapper.__doc__ = handler.__doc__
+        return wrapper
+    return decorator
+
+
+class CallbackRouter:
+    """Tabella di rotte per i callback query di una variante del bot.
+
+    Uso::
+
+        ROUTES = CallbackRouter("minimal")
+
+        @ROUTES.route("cal_", parse=fields(int, int))
+        async def route_calendar(update, context, year, month): ...
+
+        async def menu_callback_router(update, context):
+            return await ROUTES.dispatch(update, context)
+
+    L'handler riceve ``(update, context, *campi)`` e il suo valore di ritorno (es. lo
+    stato della ConversationHandler) viene restituito da :meth:`dispatch`.
+    """
+
+    def __init__(self, name: str, *, answer: bool = True):
+        self.name = name
+        self.answer = answer
+        self._exact: dict[str, Route] = {}
+        self._prefixes: dict[int, dict[str, Route]] = {}
+        self._lengths: list[int] = []
+        self._routes: dict[str, Route] = {}
+        self._fallback: Route | None = None
+
+    def _register(self, name: str, handler, parse, dedup: bool = False) -> Route:
+        route = self._routes.get(name)
+        if route is None:
+            route = self._routes[name] = Route(name, handler, parse, RouteStats(), dedup)
+        return route
+
+    def route(self, *keys: str, exact: bool = False, parse=None, name: str | None = None, dedup: bool = False):
+        """Registra l'handler per uno o più prefissi (o valori esatti con ``exact=True``).
+
+        Più chiavi (alias storici come ``op_``/``opid_``) condividono handler e metriche.
+        Con ``dedup`` i tocchi ripetuti sullo stesso bottone non rieseguono l'handler.
+        """
+        def decorator(handler):
+            route = self._register(name or keys[0], handler, parse or (no_payload if exact else text), dedup)
+            for key in keys:
+                if exact:
+                    self._exact[key] = route
+                else:
+                    self._prefixes.setdefault(len(key), {})[key] = route
+            # Prefissi più lunghi prima: "full_op_" vince su un eventuale "full_"
+            self._lengths = sorted(self._prefixes, reverse=True)
+            return handler
+        return decorator
+
+    def fallback(self, handler):
+        """Handler per callback sconosciuti o con payload non valido: ``(update, context)``."""
+        self._fallback = Route("fallback", handler, no_payload, RouteStats())
+        return handler
+
+    def resolve(self, data: str) -> tuple[Route | None, str]:
+        """Restituisce (rotta, payload) per il callback ``data``."""
+        route = self._exact.get(data)
+        if route is not None:
+            return route, ""
+        for length in self._lengths:
+            route = self._prefixes[length].get(data[:length])
+            if route is not None:
+                return route, data[length:]
+        return None, data
+
+    async def dispatch(self, update, context):
+        q = update.callback_query
+        data = q.data or ""
+        route, payload = self.resolve(data)
+        if route is not None and route.dedup:
+            # La risposta al callback la dà DEDUP (toast per i doppioni) o il giro normale
+            return await DEDUP.run(self.name, route.name, update, lambda: self._dispatch(update, context, route, payload))
+        return await self._dispatch(update, context, route, payload)
+
+    async def _dispatch(self, update, context, route: Route | None, payload: str):
+        q = update.callback_query
+        if self.answer:
+            await q.answer()
+        data = q.data or ""
+        args: tuple = ()
+        if route is not None:
+            try:
+                args = route.parse(payload)
+            except (ValueError, TypeError):
+                route.stats.invalid += 1
+                CALLBACK_INVALID.inc(self.name, route.name)
+                logger.warning("[%s] payload non valido per %s: %r", self.name, route.name, data)
+                route = None
+        if route is None:
+            route = self._fallback
+            if route is None:
+                return None
+        return await self._run(route, update, context, args)
+
+    async def _run(self, route: Route, update, context, args: tuple):
+        t0 = time.perf_counter()
+        try:
+            return await route.handler(update, context, *args)
+        except Exception:
+            route.stats.errors += 1
+            CALLBACK_ERRORS.inc(self.name, route.name)
+            raise
+        finally:
+            elapsed = (time.perf_counter() - t0) * 1000
+            CALLBACK_LATENCY.observe(elapsed / 1000, self.name, route.name)
+            stats = route.stats
+            stats.calls += 1
+            stats.total_ms += elapsed
+            stats.max_ms = max(stats.max_ms, elapsed)
+            if elapsed > CALLBACK_SLOW_MS:
+                logger.warning("[%s] callback lento %s: %.0f ms", self.name, route.name, elapsed)
+
+    def stats(self) -> dict[str, RouteStats]:
+        routes = dict(self._routes)
+        if self._fallback is not None:
+            routes["fallback"] = self._fallback
+        return {name: route.stats for name, route in routes.items()}
+
+    def summary(self, top: int = 5) -> str:
+        """Le rotte più costose (tempo totale) in una riga per rotta."""
+        used = [(name, s) for name, s in self.stats().items() if s.calls or s.invalid]
+        if not used:
+            return "nessun callback"
+        used.sort(key=lambda item: item[1].total_ms, reverse=True)
+        return "\n".join(
+            f"{name}: {s.calls}× media {s.avg_ms:.0f} ms, max {s.max_ms:.0f} ms"
+            + (f", {s.errors} errori" if s.errors else "")
+            + (f", {s.invalid} non validi" if s.invalid else "")
+            for name, s in used[:top]
+        )
@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+"""
+Modulo ingress - server webhook locale dietro un qualunque reverse proxy (senza ngrok).
+
+Il server risponde subito a Telegram e mette l'update in una coda interna limitata;
+un pump lo passa all'Application solo quando l'update processor ha capacità libera.
+Sotto carico gli update a bassa priorità (navigazione del calendario) vengono scartati
+rispondendo direttamente al callback; a coda piena gli altri ricevono 503, così
+Telegram li riconsegna più tardi.
+
+Endpoint:
+    POST /<url_path>   update Telegram
+    GET  /healthz      processo vivo
+    GET  /readyz       Application avviata e coda sotto la soglia
+    GET  /queue        profondità della coda e contatori (JSON)
+    GET  /metrics      metriche in formato Prometheus (metrics_module)
+"""
+import asyncio, json, logging, os, time
+
+import tornado.web
+from tornado.httpserver import HTTPServer
+from telegram import Update
+
+import metrics_module
+
+logger = logging.getLogger(__name__)
+
+INGRESS_QUEUE_SIZE = max(1, int(os.environ.get("INGRESS_QUEUE_SIZE", "1000")))
+# Oltre questa frazione di riempimento gli update a bassa priorità vengono scartati
+INGRESS_SHED_RATIO = float(os.environ.get("INGRESS_SHED_RATIO", "0.75"))
+INGRESS_RETRY_AFTER = int(os.environ.get("INGRESS_RETRY_AFTER", "5"))
+# Callback di sola navigazione: perderne una costa all'utente solo un secondo tap
+LOW_PRIORITY_CALLBACK_PREFIXES = ("cal_", "fc_", "pickmonths_", "ignore")
+BUSY_CALLBACK_TEXT = "⏳ Sistema occupato, riprova tra un attimo."
+
+
+def is_low_priority(data: dict) -> bool:
+    """Classifica l'update grezzo (dict JSON) senza deserializzarlo."""
+    cq = data.get("callback_query")
+    if cq:
+        return str(cq.get("data") or "").startswith(LOW_PRIORITY_CALLBACK_PREFIXES)
+    return "edited_message" in data
+
+
+class WebhookIngress:
+    """Coda limitata tra il server HTTP e l'Application, con admission control."""
+
+    def __init__(self, application, url_path: str, secret_token: str | None = None,
+                 queue_size: int = INGRESS_QUEUE_SIZE, max_inflight: int | None = None):
+        self.application = application
+        self.url_path = url_path.strip("/")
+        self.secret_token = secret_token
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self.max_inflight = max_inflight or application.update_processor.max_concurrent_updates
+        self._slots = asyncio.Semaphore(self.max_inflight)
+        self._admitted = 0
+        self._pump_task: asyncio.Task | None = None
+        self._server: HTTPServer | None = None
+        self.started_at = time.time()
+        self.stats = {"accepted": 0, "shed": 0, "rejected": 0, "invalid": 0}
+        add_done = getattr(application.update_processor, "add_done_callback", None)
+        if add_done is None:
+            raise RuntimeError("L'ingress richiede PerChatUpdateProcessor (runtime_module)")
+        add_done(self._on_update_done)
+
+    @property
+    def depth(self) -> int:
+        """Update ricevuti e non ancora completati (in coda + nell'Application)."""
+        return self.queue.qsize() + self._admitted
+
+    @property
+    def capacity(self) -> int:
+        return self.queue.maxsize + self.max_inflight
+
+    @property
+    def overloaded(self) -> bool:
+        return self.queue.qsize() >= self.queue.maxsize * INGRESS_SHED_RATIO
+
+    def is_ready(self) -> bool:
+        return bool(self.application.running) and not self.queue.full()
+
+    def snapshot(self) -> dict:
+        return {
+            "depth": self.depth,
+            "queue_depth": self.queue.qsize(),
+            "queue_size": self.queue.maxsize,
+            "in_flight": self._admitted,
+            "max_inflight": self.max_inflight,
+            "overloaded": self.overloaded,
+            "uptime_s": round(time.time() - self.started_at, 1),
+            **self.stats,
+        }
+
+    def offer(self, data: dict) -> tuple[int, dict | None]:
+        """Accoda un update grezzo. Restituisce (status HTTP, body di risposta opzionale)."""
+        if is_low_priority(data) and self.overloaded:
+            self.stats["shed"] += 1
+            cq = data.get("callback_query") or {}
+            if cq.get("id"):
+                # Risposta al webhook con un metodo Bot API: nessuna chiamata aggiuntiva
+                return 200, {"method": "answerCallbackQuery", "callback_query_id": cq["id"], "text": BUSY_CALLBACK_TEXT}
+            return 200, None
+        try:
+            update = Update.de_json(data, self.application.bot)
+        except Exception as e:
+            self.stats["invalid"] += 1
+            logger.warning("Update non valido scartato: %s", e)
+            return 200, None
+        try:
+            self.queue.put_nowait(update)
+        except asyncio.QueueFull:
+            self.stats["rejected"] += 1
+            return 503, None
+        self.stats["accepted"] += 1
+        return 200, None
+
+    def _on_update_done(self, update) -> None:
+        if self._admitted > 0:
+            self._admitted -= 1
+            self._slots.release()
+
+    async def _pump(self) -> None:
+        while True:
+            update = await self.queue.get()
+            await self._slots.acquire()
+            self._admitted += 1
+            await self.application.update_queue.put(update)
+
+    def start(self, listen: str, port: int) -> None:
+        routes = [
+            (rf"/{self.url_path}/?", _UpdateHandler, {"ingress": self}),
+            (r"/healthz", _HealthHandler, {"ingress": self}),
+            (r"/readyz", _ReadyHandler, {"ingress": self}),
+            (r"/queue", _QueueHandler, {"ingress": self}),
+            (r"/metrics", _MetricsHandler, {"ingress": self}),
+        ]
+        self._server = HTTPServer(tornado.web.Application(routes))
+        self._server.listen(port, address=listen)
+        self._pump_task = asyncio.get_running_loop().create_task(self._pump(), name="ingress_pump")
+        logger.info("Ingress webhook in ascolto su %s:%s (coda %s)", listen, port, self.queue.maxsize)
+
+    async def stop(self) -> None:
+        if self._server is not None:
+            self._server.stop()
+            await self._server.close_all_connections()
+        if self._pump_task is not None:
+            self._pump_task.cancel()
+            await asyncio.gather(self._pump_task, return_exceptions=True)
+        if not self.queue.empty():
+            logger.warning("Ingress fermato con %s update ancora in coda", self.queue.qsize())
+
+
+class _IngressHandler(tornado.web.RequestHandler):
+    def initialize(self, ingress: WebhookIngress) -> None:
+        self.ingress = ingress
+
+    def log_exception(self, typ, value, tb) -> None:
+        logger.error("Errore nell'ingress webhook", exc_info=(typ, value, tb))
+
+    def _json(self, status: int, payload: dict) -> None:
+        self.set_status(status)
+        self.set_header("Content-Type", "application/json")
+        self.finish(json.dumps(payload))
+
+
+class _UpdateHandler(_IngressHandler):
+    def post(self) -> None:
+        secret = self.ingress.secret_token
+        if secret and self.request.headers.get("X-Telegram-Bot-Api-Secret-Token") != secret:
+            self.set_status(403); self.finish(); return
+        try:
+            data = json.loads(self.request.body)
+        except ValueError:
+            self.ingress.stats["invalid"] += 1
+            self.set_status(400); self.finish(); return
+        status, body = self.ingress.offer(data)
+        if status == 503:
+            self.set_header("Retry-After", str(INGRESS_RETRY_AFTER))
+        if body is not None:
+            self._json(status, body)
+        else:
+            self.set_status(status); self.finish()
+
+
+class _HealthHandler(_IngressHandler):
+    def get(self) -> None:
+        self._json(200, {"status": "ok"})
+
+
+class _ReadyHandler(_IngressHandler):
+    def get(self) -> None:
+        ready = self.ingress.is_ready()
+        self._json(200 if ready else 503, {"ready": ready, **self.ingress.snapshot()})
+
+
+class _QueueHandler(_IngressHandler):
+    def get(self) -> None:
+        self._json(200, self.ingress.snapshot())
+
+
+class _MetricsHandler(_IngressHandler):
+    def get(self) -> None:
+        self.set_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.finish(metrics_module.render())
+
+
+async def run_webhook_ingress(application, *, listen: str, port: int, url_path: str, webhook_url: str,
+                              secret_token: str | None = None, drop_pending_updates: bool = False) -> None:
+    """Ciclo di vita completo: setWebhook, avvio Application e ingress, attesa dello stop."""
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig_name in ("SIGINT", "SIGTERM"):
+        try:
+            import signal
+            loop.add_signal_handler(getattr(signal, sig_name), stop_event.set)
+        except (NotImplementedError, AttributeError, RuntimeError):
+            pass  # Windows: si ferma con KeyboardInterrupt
+    await application.initialize()
+    ingress = WebhookIngress(application, url_path, secret_token=secret_token)
+    try:
+        await application.bot.set_webhook(
+            url=webhook_url,
+            secret_token=secret_token,
+            drop_pending_updates=drop_pending_updates,
+            allowed_updates=Update.ALL_TYPES,
+        )
+        if application.post_init:
+            await application.post_init(application)
+        await application.start()
+        ingress.start(listen, port)
+        await stop_event.wait()
+    finally:
+        await ingress.stop()
+        if application.running:
+            await application.stop()
+        # Fuori da run_polling/run_webhook gli hook post_* vanno invocati a mano
+        if application.post_stop:
+            await application.post_stop(application)
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+"""
+Modulo logging - log strutturato (righe JSON) con scrittura asincrona e rotazione.
+
+`setup_logging()` sostituisce `logging.basicConfig`:
+- il root logger ha un solo QueueHandler: l'event loop mette il record in coda e torna
+  subito; formattazione JSON e scrittura su disco avvengono nel thread del QueueListener;
+- gli eventi ad alta frequenza marcati con ``extra=SAMPLED`` vengono tenuti 1 ogni
+  `LOG_SAMPLE_EVERY` per messaggio (il record tenuto riporta quanti ne sono stati saltati);
+- il file ruota per dimensione (`LOG_MAX_BYTES`) o per tempo (`LOG_ROTATE_WHEN`, es.
+  "midnight") e i file ruotati vengono compressi in gzip.
+I campi passati con ``extra={...}`` finiscono come chiavi del JSON.
+"""
+import atexit, copy, gzip, json, logging, os, queue, shutil, sys
+from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler, TimedRotatingFileHandler
+
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").strip().upper() or "INFO"
+LOG_FILE = os.environ.get("LOG_FILE", "bot.log")
+# json | text (formato del file; la console resta leggibile)
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "json").strip().lower()
+LOG_CONSOLE = os.environ.get("LOG_CONSOLE", "1").strip().lower() in {"1", "true", "yes", "on"}
+LOG_MAX_BYTES = int(os.environ.get("LOG_MAX_BYTES", str(10 * 1024 * 1024)))
+LOG_BACKUPS = int(os.environ.get("LOG_BACKUPS", "5"))
+# Rotazione a tempo (TimedRotatingFileHandler: "midnight", "H", "D"...); vuoto = per dimensione
+LOG_ROTATE_WHEN = os.environ.get("LOG_ROTATE_WHEN", "").strip()
+LOG_COMPRESS = os.environ.get("LOG_COMPRESS", "1").strip().lower() in {"1", "true", "yes", "on"}
+LOG_SAMPLE_EVERY = max(1, int(os.environ.get("LOG_SAMPLE_EVERY", "10")))
+LOG_QUEUE_SIZE = int(os.environ.get("LOG_QUEUE_SIZE", "10000"))
+# Librerie molto verbose a INFO (httpx logga ogni chiamata alla Bot API)
+NOISY_LOGGERS = ("httpx", "httpcore", "apscheduler.executors.default", "apscheduler.scheduler")
+
+# Da passare come ``extra`` agli eventi ad alta frequenza
+SAMPLED = {"sampled": True}
+
+_RESERVED = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "sampled", "sampled_out"}
+_listener: QueueListener | None = None
+
+
+class JsonFormatter(logging.Formatter):
+    """Una riga JSON per record: ts, livello, logger, messaggio, extra ed eccezione."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RESERVED and not key.startswith("_"):
+                entry[key] = value
+        if getattr(record, "sampled_out", 0):
+            entry["sampled_out"] = record.sampled_out
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        if record.stack_info:
+            entry["stack"] = record.stack_info
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """Tiene 1 record ogni ``every`` tra quelli marcati ``sampled``, per template di messaggio."""
+
+    def __init__(self, every: int = LOG_SAMPLE_EVERY):
+        super().__init__()
+        self.every = every
+        self._seen: dict[tuple, int] = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if self.every <= 1 or not getattr(record, "sampled", False) or record.levelno >= logging.WARNING:
+            return True
+        key = (record.name, record.msg)
+        if len(self._seen) > 4096:
+            # Messaggi non parametrizzati (f-string): evita che il dizionario cresca senza limiti
+            self._seen.clear()
+        seen = self._seen.get(key, 0)
+        self._seen[key] = seen + 1
+        if seen % self.every:
+            return False
+        record.sampled_out = self.every - 1 if seen else 0
+        return True
+
+
+class _DeferredQueueHandler(QueueHandler):
+    """QueueHandler che nel thread chiamante risolve solo il messaggio (``%`` sugli args).
+
+    Lo stdlib formatta l'intero record prima di accodarlo; qui JSON e traceback vengono
+    prodotti dal listener, fuori dall'event loop.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            # Meglio perdere una riga di log che bloccare l'event loop
+            pass
+
+
+def _gzip_namer(name: str) -> str:
+    return name + ".gz"
+
+
+def _gzip_rotator(source: str, dest: str) -> None:
+    with open(source, "rb") as src, gzip.open(dest, "wb") as dst:
+        shutil.copyfileobj(src, dst)
+    os.remove(source)
+
+
+def _file_handler(path: str) -> logging.Handler:
+    if LOG_ROTATE_WHEN:
+        handler = TimedRotatingFileHandler(path, when=LOG_ROTATE_WHEN, backupCount=LOG_BACKUPS, encoding="utf-8", delay=True)
+    else:
+        handler = RotatingFileHandler(path, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUPS, encoding="utf-8", delay=True)
+    if LOG_COMPRESS:
+        handler.namer = _gzip_namer
+        handler.rotator = _gzip_rotator
+    return handler
+
+
+def setup_logging(level: str = LOG_LEVEL, path: str | None = LOG_FILE) -> None:
+    """Configura il root logger: QueueHandler + listener su file (JSON) e console (testo)."""
+    global _listener
+    if _listener is not None:
+        return
+    handlers: list[logging.Handler] = []
+    if path:
+        file_handler = _file_handler(path)
+        file_handler.setFormatter(JsonFormatter() if LOG_FORMAT == "json"
+                                  else logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s"))
+        handlers.append(file_handler)
+    if LOG_CONSOLE:
+        console = logging.StreamHandler(sys.stderr)
+        console.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+        handlers.append(console)
+    log_queue: queue.Queue = queue.Queue(LOG_QUEUE_SIZE)
+    queue_handler = _DeferredQueueHandler(log_queue)
+    queue_handler.addFilter(SamplingFilter())
+    root = logging.getLogger()
+    for old in list(root.handlers):
+        root.removeHandler(old)
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+    for name in NOISY_LOGGERS:
+        logging.getLogger(name).setLevel(max(logging.WARNING, root.level))
+    _listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_logging)
+
+
+def stop_logging() -> None:
+    """Svuota la coda e chiude i file (registrato con atexit)."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+        _listener = None
@@ -0,0 +1,365 @@
+# -*- coding: utf-8 -*-
+"""
+Modulo metrics - contatori e istogrammi in formato testo Prometheus.
+
+Solo libreria standard e nessuna dipendenza da Telegram: il core lo usa per misurare
+le query SQL (connessione strumentata restituita da `db_conn`), il runtime per update,
+chiamate Bot API e ritardo dei job. Le metriche si leggono su `/metrics`:
+- dall'ingress webhook (stessa porta del webhook), oppure
+- dal server locale avviato con `METRICS_PORT` (default su 127.0.0.1).
+Il comando admin `/metrics` ne mostra un riepilogo.
+"""
+import bisect, logging, os, re, sqlite3, threading, time
+from functools import lru_cache
+
+from slowquery_module import SLOW_QUERIES
+
+logger = logging.getLogger(__name__)
+
+
+def _env_flag(name: str, default: bool) -> bool:
+    raw = os.environ.get(name)
+    if raw is None:
+        return default
+    return raw.strip().lower() in {"1", "true", "yes", "on"}
+
+
+METRICS_ENABLED = _env_flag("METRICS_ENABLED", True)
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "0") or 0)
+METRICS_LISTEN = os.environ.get("METRICS_LISTEN", "127.0.0.1")
+
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+LAG_BUCKETS = (0.1, 0.5, 1.0, 5.0, 15.0, 30.0, 60.0, 300.0, 900.0, 3600.0)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _label_str(names: tuple, values: tuple, extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels: tuple = ()):
+        self.name, self.help, self.labels = name, help, tuple(labels)
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, *labels, amount: float = 1.0) -> None:
+        self._values[labels] = self._values.get(labels, 0.0) + amount
+
+    def value(self, *labels) -> float:
+        return self._values.get(labels, 0.0)
+
+    def items(self) -> list[tuple[tuple, float]]:
+        return list(self._values.items())
+
+    def render(self) -> list[str]:
+        return [f"{self.name}{_label_str(self.labels, k)} {v:g}" for k, v in self.items()]
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name, self.help, self.labels = name, help, tuple(labels)
+        self.buckets = tuple(sorted(buckets))
+        # labels -> [conteggi per bucket (non cumulativi, +Inf in coda), somma, conteggio]
+        self._series: dict[tuple, list] = {}
+
+    def observe(self, value: float, *labels) -> None:
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    def time(self, *labels):
+        return _Timer(self, labels)
+
+    def items(self) -> list[tuple[tuple, list]]:
+        return list(self._series.items())
+
+    def quantile(self, q: float, *labels) -> float:
+        """Stima del quantile dai bucket (limite superiore del bucket che lo contiene)."""
+        series = self._series.get(labels)
+        if not series or not series[2]:
+            return 0.0
+        target = q * series[2]
+        seen = 0
+        for bound, count in zip(self.buckets + (float("inf"),), series[0]):
+            seen += count
+            if seen >= target:
+                return bound if bound != float("inf") else self.buckets[-1]
+        return self.buckets[-1]
+
+    def render(self) -> list[str]:
+        lines = []
+        for labels, (counts, total, count) in self.items():
+            cumulative = 0
+            for bound, c in zip(self.buckets, counts):
+                cumulative += c
+                le = 'le="%g"' % bound
+                lines.append(f"{self.name}_bucket{_label_str(self.labels, labels, le)} {cumulative}")
+            le = 'le="+Inf"'
+            lines.append(f"{self.name}_bucket{_label_str(self.labels, labels, le)} {count}")
+            lines.append(f"{self.name}_sum{_label_str(self.labels, labels)} {total:.6f}")
+            lines.append(f"{self.name}_count{_label_str(self.labels, labels)} {count}")
+        return lines
+
+
+class Gauge:
+    """Valore letto al momento dell'esportazione da una funzione ``() -> {labels: valore}``."""
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str, labels: tuple = (), collect=None):
+        self.name, self.help, self.labels = name, help, tuple(labels)
+        self.collect = collect
+
+    def render(self) -> list[str]:
+        if self.collect is None:
+            return []
+        try:
+            values = self.collect()
+        except Exception:
+            logger.exception("Gauge %s non disponibile", self.name)
+            return []
+        return [f"{self.name}{_label_str(self.labels, k)} {v:g}" for k, v in values.items()]
+
+
+class _Timer:
+    def __init__(self, histogram: Histogram, labels: tuple):
+        self.histogram, self.labels = histogram, labels
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.t0, *self.labels)
+        return False
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: dict[str, object] = {}
+
+    def register(self, metric):
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str, labels: tuple = ()) -> Counter:
+        return self.register(Counter(name, help, labels))
+
+    def histogram(self, name: str, help: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def gauge(self, name: str, help: str, labels: tuple = (), collect=None) -> Gauge:
+        return self.register(Gauge(name, help, labels, collect))
+
+    def get(self, name: str):
+        return self._metrics.get(name)
+
+    def render(self) -> str:
+        lines = []
+        for metric in list(self._metrics.values()):
+            body = metric.render()
+            if not body:
+                continue
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(body)
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+UPDATE_LATENCY = REGISTRY.histogram("bot_update_duration_seconds", "Durata dell'elaborazione di un update", ("kind",))
+UPDATE_WAIT = REGISTRY.histogram("bot_update_wait_seconds", "Attesa di un update prima dell'esecuzione (turno della chat e slot liberi)", ("kind",))
+CALLBACK_LATENCY = REGISTRY.histogram("bot_callback_duration_seconds", "Durata degli handler dei callback per rotta", ("router", "route"))
+CALLBACK_ERRORS = REGISTRY.counter("bot_callback_errors_total", "Eccezioni negli handler dei callback per rotta", ("router", "route"))
+CALLBACK_DUPLICATES = REGISTRY.counter("bot_callback_duplicates_total", "Tocchi ripetuti sullo stesso bottone assorbiti senza rieseguire l'handler", ("router", "route"))
+CALLBACK_INVALID = REGISTRY.counter("bot_callback_invalid_total", "Callback con payload non valido per rotta", ("router", "route"))
+DB_QUERY_LATENCY = REGISTRY.histogram("bot_db_query_duration_seconds", "Durata delle query SQLite per tipo di statement e tabella", ("statement",))
+DB_QUERY_ERRORS = REGISTRY.counter("bot_db_query_errors_total", "Query SQLite fallite per tipo di statement e tabella", ("statement",))
+API_LATENCY = REGISTRY.histogram("bot_api_request_duration_seconds", "Durata delle chiamate alla Bot API per metodo", ("method",))
+API_ERRORS = REGISTRY.counter("bot_api_errors_total", "Chiamate alla Bot API fallite per metodo", ("method",))
+JOB_LAG = REGISTRY.histogram("bot_job_lag_seconds", "Ritardo di avvio dei job della JobQueue rispetto all'orario previsto", ("job",), LAG_BUCKETS)
+REMINDER_LAG = REGISTRY.histogram("bot_reminder_lag_seconds", "Ritardo di invio dei promemoria rispetto all'orario previsto", ("source",), LAG_BUCKETS)
+CACHE_REQUESTS = REGISTRY.counter("bot_cache_requests_total", "Accessi alle cache interne per esito (hit/miss)", ("cache", "result"))
+NAVIGATION_COALESCED = REGISTRY.counter("bot_navigation_coalesced_total", "Tocchi di navigazione del calendario superati da uno più recente", ("stage",))
+CALENDAR_PREFETCH = REGISTRY.counter("bot_calendar_prefetch_total", "Calendari precalcolati in background per esito", ("result",))
+BOOKING_STATEMENTS = REGISTRY.histogram("bot_booking_statements", "Statement SQLite eseguiti (trigger compresi) per salvare una prenotazione", ("path",),
+                                        (2, 4, 6, 8, 10, 15, 20, 30, 50))
+REPORT_DURATION = REGISTRY.histogram("bot_report_build_seconds", "Durata della generazione dei report programmati (query e testo)", ("kind",))
+REPORT_SENT = REGISTRY.counter("bot_report_messages_total", "Messaggi dei report programmati per esito dell'invio", ("result",))
+EDITS_SKIPPED = REGISTRY.counter("bot_edits_skipped_total", "Modifiche di messaggi evitate perché il contenuto non cambiava", ("reason",))
+
+
+def cache_hit(cache: str) -> None:
+    CACHE_REQUESTS.inc(cache, "hit")
+
+
+def cache_miss(cache: str) -> None:
+    CACHE_REQUESTS.inc(cache, "miss")
+
+
+# --- SQL ---
+
+_SQL_TABLE_RE = {
+    "select": re.compile(r"\bFROM\s+([\w\"]+)", re.I),
+    "delete": re.compile(r"\bFROM\s+([\w\"]+)", re.I),
+    "insert": re.compile(r"\bINTO\s+([\w\"]+)", re.I),
+    "replace": re.compile(r"\bINTO\s+([\w\"]+)", re.I),
+    "update": re.compile(r"^\s*UPDATE\s+(?:OR\s+\w+\s+)?([\w\"]+)", re.I),
+}
+
+
+@lru_cache(maxsize=1024)
+def statement_label(sql: str) -> str:
+    """Etichetta a bassa cardinalità per una query: "select bookings", "pragma", ..."""
+    head = sql.lstrip().split(None, 1)
+    if not head:
+        return "empty"
+    verb = head[0].lower()
+    pattern = _SQL_TABLE_RE.get(verb)
+    if pattern is not None:
+        m = pattern.search(sql)
+        if m:
+            return f"{verb} {m.group(1).strip(chr(34)).lower()}"
+    return verb
+
+
+class InstrumentedCursor(sqlite3.Cursor):
+    def _observe(self, sql, parameters, elapsed: float, batch: int | None = None) -> None:
+        if METRICS_ENABLED:
+            DB_QUERY_LATENCY.observe(elapsed, statement_label(sql))
+        if SLOW_QUERIES is not None and elapsed >= SLOW_QUERIES.threshold_s:
+            SLOW_QUERIES.record(self.connection, sql, parameters, elapsed, batch)
+
+    def execute(self, sql, parameters=()):
+        t0 = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        except Exception:
+            DB_QUERY_ERRORS.inc(statement_label(sql))
+            raise
+        finally:
+            self._observe(sql, parameters, time.perf_counter() - t0)
+
+    def executemany(self, sql, seq_of_parameters):
+        # La forma dei parametri viene presa dalla prima riga del lotto
+        seq_of_parameters = list(seq_of_parameters)
+        t0 = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        except Exception:
+            DB_QUERY_ERRORS.inc(statement_label(sql))
+            raise
+        finally:
+            first = seq_of_parameters[0] if seq_of_parameters else ()
+            self._observe(sql, first, time.perf_counter() - t0, batch=len(seq_of_parameters))
+
+
+class InstrumentedConnection(sqlite3.Connection):
+    """Connessione SQLite che misura ogni execute/executemany (anche via cursor()) e
+    segnala le query lente a slowquery_module."""
+
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+def connection_factory():
+    """Classe di connessione da passare a ``sqlite3.connect(factory=...)``."""
+    return InstrumentedConnection if METRICS_ENABLED or SLOW_QUERIES is not None else sqlite3.Connection
+
+
+# --- esportazione ---
+
+def render() -> str:
+    return REGISTRY.render()
+
+
+def start_metrics_server(port: int = METRICS_PORT, listen: str = METRICS_LISTEN):
+    """Avvia `/metrics` su un thread daemon (nessun effetto se port=0)."""
+    if not port:
+        return None
+    # Import locale: il core importa questo modulo e deve restare leggero
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def log_message(self, fmt, *args):
+            pass
+
+        def do_GET(self):
+            if self.path.split("?", 1)[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = ThreadingHTTPServer((listen, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    logger.info("Metriche Prometheus su http://%s:%s/metrics", listen, port)
+    return server
+
+
+def _top(histogram: Histogram, n: int) -> list[tuple[tuple, list]]:
+    return sorted(histogram.items(), key=lambda item: item[1][1], reverse=True)[:n]
+
+
+def summary_text(top: int = 5) -> str:
+    """Riepilogo leggibile per il comando admin /metrics."""
+    out = []
+
+    def section(title: str, histogram: Histogram, fmt_labels, errors: Counter | None = None):
+        rows = _top(histogram, top)
+        if not rows:
+            return
+        out.append(title)
+        for labels, (_, total, count) in rows:
+            line = (f"• {fmt_labels(labels)}: {count}× media {total / count * 1000:.0f} ms, "
+                    f"p95 ≤{histogram.quantile(0.95, *labels) * 1000:.0f} ms")
+            if errors is not None and errors.value(*labels):
+                line += f", {errors.value(*labels):g} errori"
+            out.append(line)
+
+    section("Update:", UPDATE_LATENCY, lambda l: l[0])
+    section("Callback (tempo totale):", CALLBACK_LATENCY, lambda l: f"{l[0]}/{l[1]}", CALLBACK_ERRORS)
+    section("Query SQL (tempo totale):", DB_QUERY_LATENCY, lambda l: l[0], DB_QUERY_ERRORS)
+    section("Bot API:", API_LATENCY, lambda l: l[0], API_ERRORS)
+    section("Report programmati (generazione):", REPORT_DURATION, lambda l: l[0])
+    lag_rows = _top(JOB_LAG, top) + [((f"reminder:{l[0]}",), s) for l, s in _top(REMINDER_LAG, top)]
+    if lag_rows:
+        out.append("Ritardo job:")
+        for labels, (_, total, count) in lag_rows:
+            out.append(f"• {labels[0]}: {count}× media {total / count:.1f}s")
+    if BOOKING_STATEMENTS.items():
+        out.append("Statement SQL per prenotazione:")
+        for (path,), (_, total, count) in sorted(BOOKING_STATEMENTS.items()):
+            out.append(f"• {path}: {count}× media {total / count:.1f}")
+    caches: dict[str, dict[str, float]] = {}
+    for (cache, result), value in CACHE_REQUESTS.items():
+        caches.setdefault(cache, {})[result] = value
+    if caches:
+        out.append("Cache:")
+        for cache, v in sorted(caches.items()):
+            total = v.get("hit", 0) + v.get("miss", 0)
+            out.append(f"• {cache}: {v.get('hit', 0) / total * 100 if total else 0:.0f}% hit su {total:g}")
+    return "\n".join(out) if out else "Nessuna metrica raccolta."
@@ -0,0 +1,311 @@
+# -*- coding: utf-8 -*-
+"""
+Modulo persistence - stato delle conversazioni, user_data e bot_data su SQLite.
+
+Un riavvio del bot non deve far ricominciare da capo chi è a metà prenotazione
+("Sessione scaduta"). La persistenza:
+- scrive in modalità write-behind: PTB consegna le modifiche ogni
+  `PERSISTENCE_FLUSH_INTERVAL` secondi, qui vengono accumulate e scritte in un'unica
+  transazione (in un thread, senza bloccare il loop);
+- carica lo user_data in modo lazy, al primo update dell'utente dopo l'avvio;
+- rimuove dalla memoria le sessioni inattive da `PERSISTENCE_IDLE_SECONDS`
+  (restano su DB e vengono ricaricate al ritorno dell'utente).
+"""
+import asyncio, json, logging, os, time
+from collections import Counter
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+from core_module import db_conn, env_flag
+from metrics_module import cache_hit, cache_miss
+
+logger = logging.getLogger(__name__)
+
+PERSISTENCE_ENABLED = env_flag("BOT_PERSISTENCE", default=True)
+PERSISTENCE_FLUSH_INTERVAL = max(1.0, float(os.environ.get("PERSISTENCE_FLUSH_INTERVAL", "10")))
+# Una sessione inattiva viene tolta dalla memoria solo dopo essere stata scritta su DB
+PERSISTENCE_IDLE_SECONDS = max(PERSISTENCE_FLUSH_INTERVAL * 3, float(os.environ.get("PERSISTENCE_IDLE_SECONDS", "1800")))
+# Conversazioni più vecchie di così non vengono ricaricate all'avvio
+PERSISTENCE_SESSION_TTL_DAYS = float(os.environ.get("PERSISTENCE_SESSION_TTL_DAYS", "7"))
+
+
+def ensure_persistence_tables():
+    con = db_conn(); cur = con.cursor()
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS persistence_user_data (
+            user_id INTEGER PRIMARY KEY,
+            data TEXT NOT NULL,
+            updated_at REAL
+        )
+    """)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS persistence_conversations (
+            name TEXT NOT NULL,
+            key TEXT NOT NULL,
+            state TEXT NOT NULL,
+            updated_at REAL,
+            PRIMARY KEY (name, key)
+        )
+    """)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS persistence_bot_data (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            data TEXT NOT NULL,
+            updated_at REAL
+        )
+    """)
+    con.commit(); con.close()
+
+
+def _dumps(value) -> str:
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":"), default=str)
+
+
+class SQLitePersistence(BasePersistence):
+    """BasePersistence su SQLite con scrittura a lotti e caricamento lazy dello user_data.
+
+    Le chiamate `update_*` di PTB non toccano il DB: registrano la modifica nei buffer
+    `_pending_*` e programmano un flush, che scrive tutto il lotto in una transazione.
+    Il chat_data e il callback_data non sono usati dal bot e non vengono salvati.
+    """
+
+    def __init__(self, update_interval: float = PERSISTENCE_FLUSH_INTERVAL, idle_seconds: float = PERSISTENCE_IDLE_SECONDS):
+        super().__init__(store_data=PersistenceInput(chat_data=False, callback_data=False), update_interval=update_interval)
+        self.idle_seconds = idle_seconds
+        # user_id -> JSON (None = cancella)
+        self._pending_users: dict[int, str | None] = {}
+        # (nome, chiave JSON) -> stato JSON (None = conversazione terminata)
+        self._pending_convs: dict[tuple[str, str], str | None] = {}
+        self._pending_bot: str | None = None
+        self._bot_written: str | None = None
+        # Sessioni in memoria: ultimo accesso e dict vivo dell'Application
+        self._last_seen: dict[int, float] = {}
+        self._live: dict[int, dict] = {}
+        self._evicting: set[int] = set()
+        self._flush_task: asyncio.Task | None = None
+        self._flush_lock = asyncio.Lock()
+        self._tables_ready = False
+        self.stats: Counter[str] = Counter()
+
+    def _ensure_tables(self) -> None:
+        if self._tables_ready:
+            return
+        ensure_persistence_tables()
+        if PERSISTENCE_SESSION_TTL_DAYS > 0:
+            cutoff = time.time() - PERSISTENCE_SESSION_TTL_DAYS * 86400
+            con = db_conn()
+            con.execute("DELETE FROM persistence_conversations WHERE updated_at < ?", (cutoff,))
+            con.execute("DELETE FROM persistence_user_data WHERE updated_at < ?", (cutoff,))
+            con.commit(); con.close()
+        self._tables_ready = True
+
+    # --- caricamento ---
+
+    async def get_user_data(self) -> dict:
+        # Lazy: nulla all'avvio, ogni utente viene caricato in refresh_user_data
+        self._ensure_tables()
+        return {}
+
+    async def get_chat_data(self) -> dict:
+        return {}
+
+    async def get_bot_data(self) -> dict:
+        self._ensure_tables()
+        con = db_conn()
+        row = con.execute("SELECT data FROM persistence_bot_data WHERE id=1").fetchone()
+        con.close()
+        self._bot_written = row[0] if row else _dumps({})
+        return json.loads(row[0]) if row else {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name: str) -> dict:
+        self._ensure_tables()
+        con = db_conn()
+        rows = con.execute("SELECT key, state FROM persistence_conversations WHERE name=?", (name,)).fetchall()
+        con.close()
+        conversations = {tuple(json.loads(key)): json.loads(state) for key, state in rows}
+        if conversations:
+            logger.info("Ripristinate %s conversazioni '%s' dal DB", len(conversations), name)
+        return conversations
+
+    def _load_user(self, user_id: int) -> dict:
+        if user_id in self._pending_users:
+            raw = self._pending_users[user_id]
+        else:
+            con = db_conn()
+            row = con.execute("SELECT data FROM persistence_user_data WHERE user_id=?", (user_id,)).fetchone()
+            con.close()
+            raw = row[0] if row else None
+        self.stats["loads"] += 1
+        return json.loads(raw) if raw else {}
+
+    async def refresh_user_data(self, user_id: int, user_data: dict) -> None:
+        self._last_seen[user_id] = time.time()
+        if user_id in self._live:
+            cache_hit("user_data")
+            return
+        cache_miss("user_data")
+        for key, value in self._load_user(user_id).items():
+            # I valori già in memoria (impostati prima del caricamento) hanno la precedenza
+            user_data.setdefault(key, value)
+        self._live[user_id] = user_data
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data: dict) -> None:
+        pass
+
+    # --- scrittura (write-behind) ---
+
+    async def update_user_data(self, user_id: int, data: dict) -> None:
+        self._pending_users[user_id] = _dumps(data) if data else None
+        self._schedule_flush()
+
+    async def drop_user_data(self, user_id: int) -> None:
+        if user_id in self._evicting:
+            # Sessione solo tolta dalla memoria da evict_idle: il DB resta com'è, a meno che
+            # l'utente non sia tornato nel frattempo (PTB scarta l'aggiornamento in quel caso)
+            self._evicting.discard(user_id)
+            if user_id in self._live:
+                self._pending_users[user_id] = _dumps(self._live[user_id]) if self._live[user_id] else None
+                self._schedule_flush()
+            return
+        self._live.pop(user_id, None)
+        self._last_seen.pop(user_id, None)
+        self._pending_users[user_id] = None
+        self._schedule_flush()
+
+    async def update_chat_data(self, chat_id: int, data: dict) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
+
+    async def update_bot_data(self, data: dict) -> None:
+        raw = _dumps(data)
+        # PTB consegna il bot_data a ogni giro: si scrive solo se è cambiato
+        if raw != self._bot_written:
+            self._pending_bot = raw
+            self._schedule_flush()
+
+    async def update_callback_data(self, data) -> None:
+        pass
+
+    async def update_conversation(self, name: str, key: tuple, new_state: object | None) -> None:
+        self._pending_convs[(name, _dumps(list(key)))] = None if new_state is None else _dumps(new_state)
+        self._schedule_flush()
+
+    def _schedule_flush(self) -> None:
+        # Un solo flush per giro di update_persistence: le update_* dello stesso giro
+        # vengono eseguite insieme (asyncio.gather) prima che il task parta
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.get_running_loop().create_task(self._flush_soon(), name="persistence_flush")
+
+    async def _flush_soon(self) -> None:
+        await asyncio.sleep(0)
+        try:
+            await self._flush_pending()
+        except Exception:
+            logger.exception("Flush della persistenza fallito: riprovo al prossimo giro")
+
+    async def _flush_pending(self) -> None:
+        async with self._flush_lock:
+            users, self._pending_users = self._pending_users, {}
+            convs, self._pending_convs = self._pending_convs, {}
+            bot, self._pending_bot = self._pending_bot, None
+            if not (users or convs or bot is not None):
+                return
+            try:
+                await asyncio.to_thread(self._write_batch, users, convs, bot)
+            except Exception:
+                # Rimette in coda il lotto senza sovrascrivere modifiche più recenti
+                self._pending_users = {**users, **self._pending_users}
+                self._pending_convs = {**convs, **self._pending_convs}
+                if self._pending_bot is None:
+                    self._pending_bot = bot
+                self.stats["flush_errors"] += 1
+                raise
+            if bot is not None:
+                self._bot_written = bot
+
+    def _write_batch(self, users: dict, convs: dict, bot: str | None) -> None:
+        now = time.time()
+        con = db_conn()
+        try:
+            with con:
+                con.executemany(
+                    "INSERT INTO persistence_user_data (user_id, data, updated_at) VALUES (?,?,?) "
+                    "ON CONFLICT(user_id) DO UPDATE SET data=excluded.data, updated_at=excluded.updated_at",
+                    [(uid, raw, now) for uid, raw in users.items() if raw is not None],
+                )
+                con.executemany(
+                    "DELETE FROM persistence_user_data WHERE user_id=?",
+                    [(uid,) for uid, raw in users.items() if raw is None],
+                )
+                con.executemany(
+                    "INSERT INTO persistence_conversations (name, key, state, updated_at) VALUES (?,?,?,?) "
+                    "ON CONFLICT(name, key) DO UPDATE SET state=excluded.state, updated_at=excluded.updated_at",
+                    [(name, key, state, now) for (name, key), state in convs.items() if state is not None],
+                )
+                con.executemany(
+                    "DELETE FROM persistence_conversations WHERE name=? AND key=?",
+                    [(name, key) for (name, key), state in convs.items() if state is None],
+                )
+                if bot is not None:
+                    con.execute(
+                        "INSERT INTO persistence_bot_data (id, data, updated_at) VALUES (1,?,?) "
+                        "ON CONFLICT(id) DO UPDATE SET data=excluded.data, updated_at=excluded.updated_at",
+                        (bot, now),
+                    )
+        finally:
+            con.close()
+        self.stats["flushes"] += 1
+        self.stats["rows"] += len(users) + len(convs) + (bot is not None)
+
+    async def flush(self) -> None:
+        """Chiamato da PTB allo shutdown, dopo l'ultimo update_persistence."""
+        if self._flush_task is not None and not self._flush_task.done():
+            await asyncio.gather(self._flush_task, return_exceptions=True)
+        await self._flush_pending()
+
+    # --- memoria ---
+
+    def evict_idle(self, application, now: float | None = None) -> int:
+        """Toglie dalla memoria le sessioni inattive. Restituisce quante ne ha rimosse."""
+        now = time.time() if now is None else now
+        evicted = 0
+        for user_id, seen in list(self._last_seen.items()):
+            if now - seen < self.idle_seconds or user_id in self._pending_users:
+                continue
+            self._last_seen.pop(user_id, None)
+            self._live.pop(user_id, None)
+            self._evicting.add(user_id)
+            application.drop_user_data(user_id)
+            evicted += 1
+        self.stats["evicted"] += evicted
+        return evicted
+
+    def summary(self) -> str:
+        pending = len(self._pending_users) + len(self._pending_convs) + (self._pending_bot is not None)
+        return (
+            f"{len(self._live)} sessioni in memoria, {pending} modifiche in attesa, "
+            f"{self.stats['flushes']} flush ({self.stats['rows']} righe), "
+            f"{self.stats['loads']} caricamenti, {self.stats['evicted']} rimosse per inattività"
+        )
+
+
+async def evict_idle_sessions_job(context) -> None:
+    """Job periodico: libera la memoria delle sessioni inattive."""
+    persistence = context.application.persistence
+    if isinstance(persistence, SQLitePersistence):
+        evicted = persistence.evict_idle(context.application)
+        if evicted:
+            logger.info("Rimosse dalla memoria %s sessioni inattive", evicted)
+
+
+def build_persistence() -> SQLitePersistence | None:
+    """Persistenza da collegare all'ApplicationBuilder (None se BOT_PERSISTENCE=0)."""
+    return SQLitePersistence() if PERSISTENCE_ENABLED else None
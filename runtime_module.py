@@ -0,0 +1,326 @@
+# -*- coding: utf-8 -*-
+"""
+Modulo runtime - infrastruttura asincrona condivisa dalle varianti Minimal e Full.
+
+Contiene:
+- l'update processor concorrente: update di utenti/chat diversi vengono elaborati in
+  parallelo, quelli della stessa chat restano in ordine stretto (gli stati ASK_* della
+  ConversationHandler dipendono da questo);
+- il supervisore dei task in background: ogni task ha un nome e un tipo, i tipi hanno
+  un limite di concorrenza, gli errori arrivano all'error handler e allo shutdown i
+  task vengono attesi (o cancellati dopo un timeout);
+- la strumentazione per metrics_module: durata degli update, chiamate Bot API e
+  ritardo dei job della JobQueue.
+"""
+import asyncio, logging, os, time
+from collections import Counter
+from datetime import datetime, timezone
+
+from telegram.ext import BaseUpdateProcessor
+from telegram.request import HTTPXRequest
+
+from metrics_module import REGISTRY, UPDATE_LATENCY, UPDATE_WAIT, API_LATENCY, API_ERRORS, JOB_LAG
+
+logger = logging.getLogger(__name__)
+
+# Numero massimo di handler in esecuzione contemporaneamente
+UPDATE_CONCURRENCY = max(1, int(os.environ.get("UPDATE_CONCURRENCY", "16")))
+# Update accettati dal processor (in esecuzione + in attesa del proprio turno di chat)
+UPDATE_QUEUE_LIMIT = max(UPDATE_CONCURRENCY, int(os.environ.get("UPDATE_QUEUE_LIMIT", str(UPDATE_CONCURRENCY * 8))))
+
+
+def update_ordering_key(update: object):
+    """Chiave di serializzazione: chat se presente, altrimenti utente, altrimenti None."""
+    chat = getattr(update, "effective_chat", None)
+    if chat is not None:
+        return ("chat", chat.id)
+    user = getattr(update, "effective_user", None)
+    if user is not None:
+        return ("user", user.id)
+    return None
+
+
+# Comandi registrati nell'Application: gli altri finiscono sotto un'unica etichetta
+# per non far crescere senza limiti le serie delle metriche
+KNOWN_COMMANDS: set[str] = set()
+
+
+def register_command_names(application) -> None:
+    """Raccoglie i comandi dei CommandHandler (anche dentro le ConversationHandler)."""
+    def walk(handlers):
+        for handler in handlers:
+            KNOWN_COMMANDS.update(getattr(handler, "commands", ()) or ())
+            for attr in ("entry_points", "fallbacks"):
+                walk(getattr(handler, attr, ()) or ())
+            for state_handlers in (getattr(handler, "states", None) or {}).values():
+                walk(state_handlers)
+    for group in application.handlers.values():
+        walk(group)
+
+
+def update_kind(update: object) -> str:
+    """Etichetta a bassa cardinalità dell'update: comando, callback, messaggio, altro."""
+    if getattr(update, "callback_query", None) is not None:
+        return "callback"
+    message = getattr(update, "message", None)
+    if message is not None:
+        text = message.text or ""
+        if text.startswith("/"):
+            command = text[1:].split(None, 1)[0].split("@", 1)[0].lower() if len(text) > 1 else ""
+            return f"/{command}" if command in KNOWN_COMMANDS else "command"
+        return "message"
+    return "other"
+
+
+class PerChatUpdateProcessor(BaseUpdateProcessor):
+    """Update processor con parallelismo tra chat e ordine FIFO all'interno della stessa chat.
+
+    Il semaforo di PTB (``max_concurrent_updates``) limita gli update accettati, inclusi
+    quelli in coda dietro ad altri della stessa chat; un secondo semaforo limita gli handler
+    effettivamente in esecuzione, così una chat che invia raffiche di update non blocca
+    gli slot degli altri utenti.
+    """
+
+    __slots__ = ("_concurrency", "_running", "_chat_locks", "_chat_waiters", "_arrival_callbacks", "_done_callbacks")
+
+    def __init__(self, concurrency: int = UPDATE_CONCURRENCY, queue_limit: int = UPDATE_QUEUE_LIMIT):
+        super().__init__(max(concurrency, queue_limit))
+        self._concurrency = concurrency
+        self._running = asyncio.Semaphore(concurrency)
+        self._chat_locks: dict[tuple, asyncio.Lock] = {}
+        self._chat_waiters: dict[tuple, int] = {}
+        self._arrival_callbacks: list = []
+        self._done_callbacks: list = []
+
+    def add_arrival_callback(self, callback) -> None:
+        """Registra ``callback(update)``, invocata appena l'update arriva, prima di attendere il turno della chat."""
+        self._arrival_callbacks.append(callback)
+
+    def add_done_callback(self, callback) -> None:
+        """Registra ``callback(update)``, invocata al termine di ogni update (es. per il backpressure dell'ingress)."""
+        self._done_callbacks.append(callback)
+
+    def _notify_arrival(self, update) -> None:
+        for callback in self._arrival_callbacks:
+            try:
+                callback(update)
+            except Exception:
+                logger.exception("Callback di arrivo update fallita")
+
+    def _notify_done(self, update) -> None:
+        for callback in self._done_callbacks:
+            try:
+                callback(update)
+            except Exception:
+                logger.exception("Callback di fine update fallita")
+
+    @property
+    def concurrency(self) -> int:
+        return self._concurrency
+
+    @property
+    def active_chats(self) -> int:
+        return len(self._chat_locks)
+
+    async def do_process_update(self, update, coroutine) -> None:
+        self._notify_arrival(update)
+        try:
+            await self._process_in_order(update, coroutine)
+        finally:
+            self._notify_done(update)
+
+    async def _run_timed(self, update, coroutine, queued_at: float) -> None:
+        kind = update_kind(update)
+        started = time.perf_counter()
+        UPDATE_WAIT.observe(started - queued_at, kind)
+        try:
+            await coroutine
+        finally:
+            UPDATE_LATENCY.observe(time.perf_counter() - started, kind)
+
+    async def _process_in_order(self, update, coroutine) -> None:
+        queued_at = time.perf_counter()
+        key = update_ordering_key(update)
+        if key is None:
+            async with self._running:
+                await self._run_timed(update, coroutine, queued_at)
+            return
+        lock = self._chat_locks.get(key)
+        if lock is None:
+            lock = self._chat_locks[key] = asyncio.Lock()
+        self._chat_waiters[key] = self._chat_waiters.get(key, 0) + 1
+        try:
+            async with lock:
+                async with self._running:
+                    await self._run_timed(update, coroutine, queued_at)
+        finally:
+            remaining = self._chat_waiters[key] - 1
+            if remaining:
+                self._chat_waiters[key] = remaining
+            else:
+                # Nessun altro update in attesa per questa chat: libera il lock
+                self._chat_waiters.pop(key, None)
+                self._chat_locks.pop(key, None)
+
+    async def initialize(self) -> None:
+        logger.info("Update processor concorrente: %s handler paralleli, %s update accettati", self._concurrency, self.max_concurrent_updates)
+
+    async def shutdown(self) -> None:
+        self._chat_locks.clear()
+        self._chat_waiters.clear()
+
+
+class InstrumentedRequest(HTTPXRequest):
+    """HTTPXRequest che misura durata ed errori di ogni chiamata alla Bot API per metodo."""
+
+    async def do_request(self, url: str, method: str, *args, **kwargs) -> tuple[int, bytes]:
+        api_method = url.rsplit("/", 1)[-1] or "unknown"
+        t0 = time.perf_counter()
+        try:
+            status, payload = await super().do_request(url, method, *args, **kwargs)
+        except Exception:
+            API_ERRORS.inc(api_method)
+            raise
+        finally:
+            API_LATENCY.observe(time.perf_counter() - t0, api_method)
+        if status >= 400:
+            API_ERRORS.inc(api_method)
+        return status, payload
+
+
+def install_job_lag_metrics(job_queue) -> None:
+    """Misura il ritardo tra l'orario previsto di ogni job e il suo avvio effettivo."""
+    from apscheduler.events import EVENT_JOB_SUBMITTED
+
+    scheduler = job_queue.scheduler
+
+    def on_submitted(event) -> None:
+        job = scheduler.get_job(event.job_id)
+        name = getattr(job, "name", None) or "unknown"
+        now = datetime.now(timezone.utc)
+        for scheduled in event.scheduled_run_times:
+            JOB_LAG.observe(max(0.0, (now - scheduled).total_seconds()), name)
+
+    scheduler.add_listener(on_submitted, EVENT_JOB_SUBMITTED)
+
+
+# Limiti di concorrenza per tipo di task in background
+TASK_LIMITS = {
+    "reminder": int(os.environ.get("TASK_LIMIT_REMINDER", "64")),
+    "waitlist": int(os.environ.get("TASK_LIMIT_WAITLIST", "16")),
+    "admin": int(os.environ.get("TASK_LIMIT_ADMIN", "4")),
+    "prefetch": int(os.environ.get("TASK_LIMIT_PREFETCH", "2")),
+}
+TASK_DEFAULT_LIMIT = int(os.environ.get("TASK_LIMIT_DEFAULT", "32"))
+TASK_DRAIN_TIMEOUT = float(os.environ.get("TASK_DRAIN_TIMEOUT", "10"))
+
+
+class TaskSupervisor:
+    """Registro dei task in background con limiti per tipo e drenaggio allo shutdown.
+
+    I task vengono tenuti in un dizionario (riferimento forte: asyncio non li raccoglie a metà
+    esecuzione). Un task oltre il limite del suo tipo resta "in attesa" finché non si
+    libera uno slot. Le eccezioni vengono loggate e inoltrate all'error handler
+    dell'Application collegata con :meth:`bind`.
+    """
+
+    def __init__(self, limits: dict[str, int] | None = None, default_limit: int = TASK_DEFAULT_LIMIT):
+        self._limits = dict(TASK_LIMITS if limits is None else limits)
+        self._default_limit = max(1, default_limit)
+        self._semaphores: dict[str, asyncio.Semaphore] = {}
+        self._tasks: dict[asyncio.Task, str] = {}
+        self._running: Counter[str] = Counter()
+        self._failures: Counter[str] = Counter()
+        self._application = None
+        self._closing = False
+
+    def bind(self, application) -> None:
+        """Collega l'Application a cui inoltrare gli errori dei task."""
+        self._application = application
+
+    def _semaphore(self, kind: str) -> asyncio.Semaphore:
+        sem = self._semaphores.get(kind)
+        if sem is None:
+            sem = self._semaphores[kind] = asyncio.Semaphore(max(1, self._limits.get(kind, self._default_limit)))
+        return sem
+
+    def spawn(self, coro, *, kind: str = "default", name: str | None = None) -> asyncio.Task | None:
+        """Avvia ``coro`` come task supervisionato e lo restituisce (None se in chiusura)."""
+        if self._closing:
+            logger.warning("Task %s rifiutato: supervisore in chiusura", name or kind)
+            coro.close()
+            return None
+        task_name = name or kind
+        task = asyncio.get_running_loop().create_task(self._run(coro, kind, task_name), name=task_name)
+        self._tasks[task] = kind
+        task.add_done_callback(self._tasks.pop)
+        return task
+
+    async def _run(self, coro, kind: str, name: str) -> None:
+        async with self._semaphore(kind):
+            self._running[kind] += 1
+            try:
+                await coro
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc:
+                self._failures[kind] += 1
+                logger.exception("Task in background fallito: %s", name)
+                await self._report(exc)
+            finally:
+                self._running[kind] -= 1
+
+    async def _report(self, exc: Exception) -> None:
+        if self._application is None:
+            return
+        try:
+            await self._application.process_error(update=None, error=exc)
+        except Exception:
+            logger.exception("Inoltro dell'errore all'error handler fallito")
+
+    def in_flight(self) -> dict[str, dict[str, int]]:
+        """Conteggi per tipo: task in esecuzione, in attesa di slot e falliti finora."""
+        totals = Counter(self._tasks.values())
+        kinds = set(totals) | set(self._failures)
+        return {
+            kind: {
+                "running": self._running[kind],
+                "waiting": totals[kind] - self._running[kind],
+                "failed": self._failures[kind],
+            }
+            for kind in sorted(kinds)
+        }
+
+    def summary(self) -> str:
+        stats = self.in_flight()
+        if not stats:
+            return "nessuno"
+        return ", ".join(f"{kind}: {v['running']} attivi/{v['waiting']} in attesa/{v['failed']} falliti" for kind, v in stats.items())
+
+    async def drain(self, timeout: float = TASK_DRAIN_TIMEOUT) -> None:
+        """Non accetta nuovi task, attende quelli presenti e cancella chi supera il timeout."""
+        self._closing = True
+        pending = list(self._tasks)
+        if not pending:
+            return
+        logger.info("Attendo %s task in background prima dello shutdown...", len(pending))
+        done, still_running = await asyncio.wait(pending, timeout=timeout)
+        for task in still_running:
+            task.cancel()
+        if still_running:
+            await asyncio.gather(*still_running, return_exceptions=True)
+            logger.warning("Cancellati %s task in background dopo %ss", len(still_running), timeout)
+
+
+# Supervisore condiviso dal processo
+TASKS = TaskSupervisor()
+
+REGISTRY.gauge(
+    "bot_background_tasks", "Task in background per tipo e stato", ("kind", "state"),
+    collect=lambda: {(kind, state): n for kind, v in TASKS.in_flight().items() for state, n in v.items() if state != "failed"},
+)
+
+
+async def drain_background_tasks(application) -> None:
+    """Hook ``post_stop`` dell'Application: drena i task supervisionati."""
+    await TASKS.drain()
@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+"""
+Modulo schedule - orari settimanali per operatore compilati in intervalli di minuti.
+
+Un template settimanale è una tupla di 7 tuple (lunedì..domenica) di intervalli
+``(inizio, fine)`` in minuti dalla mezzanotte, già ordinati e senza sovrapposizioni.
+Si ottiene intersecando gli orari del centro (`ORARI_SETTIMANA`) con l'orario
+dell'operatore (`work_start`/`work_end`) e togliendo le pause (`breaks_json`).
+I template sono valori immutabili e hashable: la lista degli slot per
+(template, giorno, durata) viene calcolata una volta e poi letta dalla cache.
+
+Le eccezioni (chiusure, ferie, orari speciali) vivono in un `ExceptionIndex`: per
+ciascun ambito (centro o operatore) le date sono ridotte a segmenti disgiunti di
+giorni ordinati, e la ricerca di una data è una bisezione.
+
+Formati accettati per `breaks_json` (lista JSON):
+    [["13:00", "14:00"]]                                  pausa tutti i giorni
+    ["13:00-14:00"]                                       idem
+    [{"start": "16:00", "end": "16:30", "days": [0, 2]}]  solo lunedì e mercoledì
+"""
+import bisect, heapq, json, logging
+from datetime import date
+from functools import lru_cache
+
+logger = logging.getLogger(__name__)
+
+DAY_MINUTES = 24 * 60
+# Granularità della bitmask di disponibilità (minuti per bit)
+MASK_UNIT = 5
+
+EMPTY_WEEK = ((),) * 7
+
+
+def hhmm_to_min(value: str) -> int:
+    h, m = value.strip().split(":")
+    return int(h) * 60 + int(m)
+
+
+# Etichette "HH:MM" precalcolate per ogni minuto della giornata
+_LABELS = tuple(f"{m // 60:02d}:{m % 60:02d}" for m in range(DAY_MINUTES + 1))
+
+
+def min_to_hhmm(minutes: int) -> str:
+    return _LABELS[minutes]
+
+
+def _normalize(ranges) -> tuple:
+    """Ordina e fonde intervalli sovrapposti o adiacenti, scartando quelli vuoti."""
+    merged: list[list[int]] = []
+    for start, end in sorted(r for r in ranges if r[1] > r[0]):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return tuple((s, e) for s, e in merged)
+
+
+def _intersect(ranges: tuple, lo: int, hi: int) -> tuple:
+    return _normalize((max(s, lo), min(e, hi)) for s, e in ranges)
+
+
+def _subtract(ranges: tuple, cut_start: int, cut_end: int) -> tuple:
+    out = []
+    for s, e in ranges:
+        if cut_end <= s or cut_start >= e:
+            out.append((s, e))
+            continue
+        if s < cut_start:
+            out.append((s, cut_start))
+        if cut_end < e:
+            out.append((cut_end, e))
+    return tuple(out)
+
+
+def parse_breaks(raw) -> list[tuple[int, int, frozenset | None]]:
+    """Pause da `breaks_json`: lista di (inizio, fine, giorni o None = tutti)."""
+    if not raw:
+        return []
+    try:
+        items = json.loads(raw) if isinstance(raw, str) else raw
+    except ValueError:
+        logger.warning("breaks_json non valido ignorato: %r", raw)
+        return []
+    breaks = []
+    for item in items or ():
+        try:
+            days = None
+            if isinstance(item, dict):
+                start, end = item["start"], item["end"]
+                if item.get("days") is not None:
+                    days = frozenset(int(d) for d in item["days"])
+            elif isinstance(item, str):
+                start, end = item.split("-", 1)
+            else:
+                start, end = item
+            breaks.append((hhmm_to_min(start), hhmm_to_min(end), days))
+        except (KeyError, TypeError, ValueError):
+            logger.warning("Pausa non valida ignorata: %r", item)
+    return breaks
+
+
+def compile_week(base: dict, work_start: str | None = None, work_end: str | None = None, breaks_json=None) -> tuple:
+    """Template settimanale: orari ``base`` ∩ [work_start, work_end) meno le pause."""
+    lo = hhmm_to_min(work_start) if work_start else 0
+    hi = hhmm_to_min(work_end) if work_end else DAY_MINUTES
+    breaks = parse_breaks(breaks_json)
+    week = []
+    for wd in range(7):
+        ranges = _normalize((hhmm_to_min(s), hhmm_to_min(e)) for s, e in base.get(wd, ()))
+        ranges = _intersect(ranges, lo, hi)
+        for b_start, b_end, days in breaks:
+            if days is None or wd in days:
+                ranges = _subtract(ranges, b_start, b_end)
+        week.append(ranges)
+    return tuple(week)
+
+
+@lru_cache(maxsize=4096)
+def slot_starts(day_ranges: tuple, durata: int, step: int) -> tuple[str, ...]:
+    """Orari di inizio ("HH:MM") ogni ``step`` minuti in cui ``durata`` sta in un intervallo."""
+    out = []
+    for start, end in day_ranges:
+        last = end - durata
+        out.extend(_LABELS[m] for m in range(start, last + 1, step))
+    return tuple(out)
+
+
+@lru_cache(maxsize=256)
+def availability_mask(day_ranges: tuple, unit: int = MASK_UNIT) -> int:
+    """Bitmask della giornata: il bit i è acceso se il minuto [i*unit, (i+1)*unit) è lavorativo."""
+    mask = 0
+    for start, end in day_ranges:
+        # Solo unità interamente lavorative: arrotonda l'inizio per eccesso e la fine per difetto
+        first, last = -(-start // unit), end // unit
+        if last > first:
+            mask |= ((1 << (last - first)) - 1) << first
+    return mask
+
+
+@lru_cache(maxsize=1024)
+def start_mask(day_ranges: tuple, durata: int, step: int, unit: int = MASK_UNIT) -> int | None:
+    """Bitmask degli inizi di :func:`slot_starts` (passo ``step`` da ogni intervallo).
+
+    None se un inizio o ``durata`` non cadono sulla griglia di ``unit`` minuti: la
+    bitmask non li rappresenta esattamente e serve il controllo slot per slot.
+    """
+    if durata % unit:
+        return None
+    mask = 0
+    for label in slot_starts(day_ranges, durata, step):
+        minutes = hhmm_to_min(label)
+        if minutes % unit:
+            return None
+        mask |= 1 << (minutes // unit)
+    return mask
+
+
+def fits(day_ranges: tuple, start: int, durata: int) -> bool:
+    """True se [start, start+durata) è interamente dentro un intervallo lavorativo."""
+    end = start + durata
+    return any(s <= start and end <= e for s, e in day_ranges)
+
+
+@lru_cache(maxsize=1024)
+def compile_day(hours: tuple, weekday: int, work_start: str | None = None, work_end: str | None = None, breaks_json=None) -> tuple:
+    """Come :func:`compile_week` per un solo giorno con orari ``hours`` (es. orario speciale)."""
+    return compile_week({weekday: hours}, work_start, work_end, breaks_json)[weekday]
+
+
+def parse_hours(raw) -> tuple:
+    """Orari da testo o JSON: "10:00-13:00,14:00-20:00" o [["10:00","20:00"]] -> (("10:00","13:00"), ...)."""
+    if isinstance(raw, str):
+        raw = raw.strip()
+        items = json.loads(raw) if raw.startswith("[") else [p for p in raw.split(",") if p.strip()]
+    else:
+        items = raw or ()
+    hours = []
+    for item in items:
+        start, end = item.split("-", 1) if isinstance(item, str) else item
+        start, end = start.strip(), end.strip()
+        if hhmm_to_min(end) <= hhmm_to_min(start):
+            raise ValueError(f"intervallo non valido: {start}-{end}")
+        hours.append((start, end))
+    return tuple(hours)
+
+
+class ScheduleException:
+    """Eccezione su un intervallo di date (estremi inclusi): ``hours`` vuoto = chiuso."""
+    __slots__ = ("id", "operator_id", "first", "last", "hours", "note")
+
+    def __init__(self, id: int, operator_id: str | None, first: date, last: date, hours: tuple = (), note: str | None = None):
+        self.id, self.operator_id, self.first, self.last = id, operator_id, first, last
+        self.hours, self.note = hours, note
+
+    @property
+    def closed(self) -> bool:
+        return not self.hours
+
+
+class ExceptionIndex:
+    """Indice per ambito (None = centro, altrimenti id operatore) con ricerca O(log n).
+
+    Le eccezioni dello stesso ambito possono sovrapporsi: vince la più recente (id
+    maggiore). In costruzione le date vengono ridotte a segmenti disgiunti
+    ``[inizio, fine]`` (ordinali) ciascuno con la sua eccezione vincente.
+    """
+
+    def __init__(self, exceptions=()):
+        by_scope: dict = {}
+        for exc in exceptions:
+            by_scope.setdefault(exc.operator_id, []).append(exc)
+        self._starts: dict = {}
+        self._segments: dict = {}
+        for scope, items in by_scope.items():
+            starts, segments = self._build(items)
+            self._starts[scope], self._segments[scope] = starts, segments
+        self.size = sum(len(v) for v in by_scope.values())
+
+    @staticmethod
+    def _build(items: list) -> tuple[list, list]:
+        bounds = sorted({e.first.toordinal() for e in items} | {e.last.toordinal() + 1 for e in items})
+        pending = sorted(items, key=lambda e: e.first, reverse=True)
+        active: list = []  # heap di (-id, ultimo giorno, eccezione): in cima la più recente
+        starts, segments = [], []
+        for lo, hi in zip(bounds, bounds[1:]):
+            while pending and pending[-1].first.toordinal() <= lo:
+                exc = pending.pop()
+                heapq.heappush(active, (-exc.id, exc.last.toordinal(), exc))
+            while active and active[0][1] < lo:
+                heapq.heappop(active)
+            if not active:
+                continue
+            winner = active[0][2]
+            if segments and segments[-1][2] is winner and segments[-1][1] == lo - 1:
+                segments[-1] = (segments[-1][0], hi - 1, winner)
+            else:
+                starts.append(lo)
+                segments.append((lo, hi - 1, winner))
+        return starts, segments
+
+    def lookup(self, scope, d: date) -> ScheduleException | None:
+        starts = self._starts.get(scope)
+        if not starts:
+            return None
+        day = d.toordinal()
+        i = bisect.bisect_right(starts, day) - 1
+        if i >= 0:
+            first, last, exc = self._segments[scope][i]
+            if first <= day <= last:
+                return exc
+        return None
+
+    def __len__(self) -> int:
+        return self.size
+
+
+EMPTY_INDEX = ExceptionIndex()
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark del core di PrenotaFacile.
+
+Uso (dalla root del progetto):
+    python scripts/bench_core.py
+
+Ogni benchmark stampa una riga "nome: valore (budget)" e lo script termina con
+codice 1 se almeno un budget viene superato. I budget si possono sovrascrivere
+con variabili d'ambiente (es. CORE_IMPORT_BUDGET_MS=150).
+"""
+import os, sys, subprocess, statistics
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+if ROOT_DIR not in sys.path:
+    sys.path.insert(0, ROOT_DIR)
+
+# Moduli pesanti che il core non deve caricare all'import
+HEAVY_MODULES = ("telegram", "pyngrok", "stats_module")
+
+BENCHMARKS = []
+
+
+def benchmark(fn):
+    BENCHMARKS.append(fn)
+    return fn
+
+
+def _budget(name: str, default: float) -> float:
+    try:
+        return float(os.environ.get(name, default))
+    except ValueError:
+        return default
+
+
+@benchmark
+def core_import_time():
+    """Tempo di import di core_module in un interprete pulito (mediana su 5 run)."""
+    budget_ms = _budget("CORE_IMPORT_BUDGET_MS", 100)
+    probe = (
+        "import sys, time; t0 = time.perf_counter(); import core_module; "
+        "dt = (time.perf_counter() - t0) * 1000; "
+        f"heavy = [m for m in {HEAVY_MODULES!r} if m in sys.modules]; "
+        "print(dt); print(','.join(heavy))"
+    )
+    env = dict(os.environ)
+    env.pop("BOT_TOKEN", None)  # l'import deve funzionare anche senza token
+    samples = []
+    heavy: list[str] = []
+    for _ in range(5):
+        out = subprocess.run([sys.executable, "-c", probe], cwd=ROOT_DIR, env=env, capture_output=True, text=True, check=True)
+        lines = out.stdout.strip().split("\n")
+        samples.append(float(lines[0]))
+        if len(lines) > 1 and lines[1]:
+            heavy = lines[1].split(",")
+    value = statistics.median(samples)
+    ok = value <= budget_ms and not heavy
+    detail = f"{value:.1f} ms (budget {budget_ms:.0f} ms)"
+    if heavy:
+        detail += f" - moduli pesanti caricati: {', '.join(heavy)}"
+    return ok, detail
+
+
+def main() -> int:
+    failed = 0
+    for fn in BENCHMARKS:
+        ok, detail = fn()
+        print(f"{'OK  ' if ok else 'FAIL'} {fn.__name__}: {detail}")
+        if not ok:
+            failed += 1
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+"""
+Bot API finta per test locali (multi-worker, cluster, carico).
+
+Uso:
+    python scripts/fake_bot_api.py --port 8089
+    # nei worker:  BOT_API_BASE_URL=http://127.0.0.1:8089  BOT_TOKEN=123:fake
+
+Risponde ai metodi usati dal bot (getMe, setWebhook, sendMessage, ...) senza
+contattare Telegram e registra ogni chiamata. Endpoint di servizio:
+    GET  /_calls            -> elenco JSON delle chiamate ricevute
+    DELETE /_calls          -> azzera l'elenco
+    POST /_push?url=<url>   -> inoltra il body (un Update JSON) all'URL indicato,
+                               o all'ultimo URL registrato con setWebhook
+"""
+import argparse, itertools, json, threading, time
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+BOT_USER = {
+    "id": 1, "is_bot": True, "first_name": "FakeBot", "username": "fake_bot",
+    "can_join_groups": True, "can_read_all_group_messages": False, "supports_inline_queries": False,
+}
+
+_lock = threading.Lock()
+_calls: list[dict] = []
+_message_ids = itertools.count(1)
+_webhook = {"url": ""}
+
+
+def _decode_params(handler) -> dict:
+    length = int(handler.headers.get("Content-Length") or 0)
+    raw = handler.rfile.read(length) if length else b""
+    ctype = handler.headers.get("Content-Type", "")
+    if "json" in ctype:
+        return json.loads(raw or b"{}")
+    params = {}
+    for key, values in parse_qs(raw.decode("utf-8")).items():
+        value = values[-1]
+        try:
+            params[key] = json.loads(value)
+        except ValueError:
+            params[key] = value
+    return params
+
+
+def _message(params: dict) -> dict:
+    return {
+        "message_id": next(_message_ids),
+        "date": int(time.time()),
+        "chat": {"id": params.get("chat_id", 0), "type": "private"},
+        "text": params.get("text", ""),
+    }
+
+
+def api_result(method: str, params: dict):
+    if method == "getMe":
+        return BOT_USER
+    if method == "setWebhook":
+        _webhook["url"] = params.get("url", "")
+        return True
+    if method == "deleteWebhook":
+        _webhook["url"] = ""
+        return True
+    if method == "getWebhookInfo":
+        return {"url": _webhook["url"], "has_custom_certificate": False, "pending_update_count": 0}
+    if method == "getUpdates":
+        time.sleep(min(float(params.get("timeout", 0) or 0), 1.0))
+        return []
+    if method == "getChat":
+        return {"id": params.get("chat_id", 0), "type": "private"}
+    if method in {"sendMessage", "editMessageText", "sendDocument"}:
+        return _message(params)
+    return True
+
+
+class Handler(BaseHTTPRequestHandler):
+    def log_message(self, fmt, *args):
+        pass
+
+    def _reply(self, payload, status=200):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if urlparse(self.path).path == "/_calls":
+            with _lock:
+                self._reply(list(_calls))
+            return
+        self._reply({"ok": False, "description": "Not Found"}, 404)
+
+    def do_DELETE(self):
+        with _lock:
+            _calls.clear()
+        self._reply({"ok": True})
+
+    def do_POST(self):
+        parsed = urlparse(self.path)
+        if parsed.path == "/_push":
+            length = int(self.headers.get("Content-Length") or 0)
+            body = self.rfile.read(length)
+            target = parse_qs(parsed.query).get("url", [_webhook["url"]])[0]
+            req = urllib.request.Request(target, data=body, headers={"Content-Type": "application/json"})
+            with urllib.request.urlopen(req, timeout=10) as resp:
+                self._reply({"ok": True, "status": resp.status, "url": target})
+            return
+        # /bot<token>/<method>
+        parts = parsed.path.strip("/").split("/")
+        if len(parts) != 2 or not parts[0].startswith("bot"):
+            self._reply({"ok": False, "description": "Not Found"}, 404)
+            return
+        method = parts[1]
+        params = _decode_params(self)
+        with _lock:
+            _calls.append({"method": method, "params": params, "ts": time.time()})
+        self._reply({"ok": True, "result": api_result(method, params)})
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8089)
+    args = parser.parse_args()
+    server = ThreadingHTTPServer((args.host, args.port), Handler)
+    print(f"Fake Bot API in ascolto su http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
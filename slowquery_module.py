@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+"""
+Modulo slowquery - log delle query SQLite lente con piano di esecuzione.
+
+Attivo solo con `SLOW_QUERY_MS` > 0. Le connessioni strumentate di metrics_module
+segnalano qui ogni statement oltre la soglia; per ciascuno vengono scritti su un file
+a rotazione (una riga JSON per query):
+- SQL normalizzato, forma dei parametri (tipi, mai i valori), durata, funzione chiamante;
+- l'output di `EXPLAIN QUERY PLAN`, calcolato una sola volta per testo SQL.
+In memoria resta un aggregato per query (conteggio, tempo totale e massimo) letto dal
+comando admin `/slow_queries`. Solo libreria standard, nessuna dipendenza da Telegram.
+"""
+import json, logging, os, re, sqlite3, sys, threading, time
+
+logger = logging.getLogger(__name__)
+
+# Soglia in millisecondi; 0 = log disattivato
+SLOW_QUERY_MS = float(os.environ.get("SLOW_QUERY_MS", "0") or 0)
+SLOW_QUERY_ENABLED = SLOW_QUERY_MS > 0
+SLOW_QUERY_FILE = os.environ.get("SLOW_QUERY_FILE", "slow_queries.log")
+SLOW_QUERY_MAX_BYTES = int(os.environ.get("SLOW_QUERY_MAX_BYTES", str(5 * 1024 * 1024)))
+SLOW_QUERY_BACKUPS = int(os.environ.get("SLOW_QUERY_BACKUPS", "3"))
+# Query distinte tenute nell'aggregato (le meno costose vengono scartate oltre il limite)
+SLOW_QUERY_MAX_TRACKED = int(os.environ.get("SLOW_QUERY_MAX_TRACKED", "200"))
+
+# Statement per cui EXPLAIN QUERY PLAN ha senso
+_EXPLAINABLE = ("select", "insert", "update", "delete", "replace", "with")
+# Frame da saltare per trovare il chiamante reale
+_SKIP_MODULES = {"metrics_module", "slowquery_module", "sqlite3", "sqlite3.dbapi2"}
+_WS_RE = re.compile(r"\s+")
+
+
+def normalize_sql(sql: str) -> str:
+    """Spazi compressi su una riga: chiave di aggregazione della query."""
+    return _WS_RE.sub(" ", sql).strip()
+
+
+def params_shape(parameters) -> str:
+    """Forma dei parametri senza i valori: "(int, str, NoneType)" o "{date: str}"."""
+    if isinstance(parameters, dict):
+        return "{" + ", ".join(f"{k}: {type(v).__name__}" for k, v in parameters.items()) + "}"
+    try:
+        return "(" + ", ".join(type(v).__name__ for v in parameters) + ")"
+    except TypeError:
+        return type(parameters).__name__
+
+
+def _caller() -> str:
+    frame = sys._getframe(2)
+    while frame is not None:
+        module = frame.f_globals.get("__name__", "")
+        if module not in _SKIP_MODULES:
+            code = frame.f_code
+            return f"{module}.{code.co_name}:{frame.f_lineno}"
+        frame = frame.f_back
+    return "?"
+
+
+class SlowQueryStats:
+    # Classe semplice (niente dataclasses): il modulo è importato dal core
+    __slots__ = ("sql", "count", "total_ms", "max_ms", "callers", "plan")
+
+    def __init__(self, sql: str):
+        self.sql = sql
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.callers: set[str] = set()
+        self.plan: list[str] = []
+
+    @property
+    def avg_ms(self) -> float:
+        return self.total_ms / self.count if self.count else 0.0
+
+
+class SlowQueryLog:
+    """Aggregato delle query lente e scrittura sul file a rotazione (thread-safe)."""
+
+    def __init__(self, threshold_ms: float = SLOW_QUERY_MS, path: str = SLOW_QUERY_FILE,
+                 max_tracked: int = SLOW_QUERY_MAX_TRACKED):
+        self.threshold_s = threshold_ms / 1000
+        self.path = path
+        self.max_tracked = max(1, max_tracked)
+        self._stats: dict[str, SlowQueryStats] = {}
+        self._lock = threading.Lock()
+        self._file_logger: logging.Logger | None = None
+
+    def _writer(self) -> logging.Logger:
+        if self._file_logger is None:
+            # Import locale: il core passa da qui e deve restare leggero
+            from logging.handlers import RotatingFileHandler
+            handler = RotatingFileHandler(self.path, maxBytes=SLOW_QUERY_MAX_BYTES,
+                                          backupCount=SLOW_QUERY_BACKUPS, encoding="utf-8", delay=True)
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            file_logger = logging.getLogger("slowquery.file")
+            file_logger.propagate = False
+            file_logger.setLevel(logging.INFO)
+            file_logger.addHandler(handler)
+            self._file_logger = file_logger
+        return self._file_logger
+
+    def _explain(self, connection, sql: str, parameters) -> list[str]:
+        if not sql.lstrip()[:7].lower().startswith(_EXPLAINABLE):
+            return []
+        try:
+            # Cursore non strumentato: l'EXPLAIN non deve finire nelle metriche né qui
+            rows = sqlite3.Cursor(connection).execute("EXPLAIN QUERY PLAN " + sql, parameters).fetchall()
+        except sqlite3.Error as e:
+            return [f"EXPLAIN non disponibile: {e}"]
+        return [str(row[-1]) for row in rows]
+
+    def record(self, connection, sql: str, parameters, elapsed: float, batch: int | None = None) -> None:
+        """Registra una query durata ``elapsed`` secondi (chiamata solo oltre la soglia)."""
+        key = normalize_sql(sql)
+        caller = _caller()
+        with self._lock:
+            stats = self._stats.get(key)
+            new = stats is None
+            if new:
+                if len(self._stats) >= self.max_tracked:
+                    cheapest = min(self._stats.values(), key=lambda s: s.total_ms)
+                    del self._stats[cheapest.sql]
+                stats = self._stats[key] = SlowQueryStats(key)
+            elapsed_ms = elapsed * 1000
+            stats.count += 1
+            stats.total_ms += elapsed_ms
+            stats.max_ms = max(stats.max_ms, elapsed_ms)
+            if len(stats.callers) < 5:
+                stats.callers.add(caller)
+        if new:
+            # Il piano dipende dal testo SQL e dagli indici, non dai valori: una volta basta
+            stats.plan = self._explain(connection, sql, parameters)
+        entry = {
+            "ts": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "ms": round(elapsed_ms, 2),
+            "sql": key,
+            "params": params_shape(parameters),
+            "caller": caller,
+            "plan": stats.plan,
+        }
+        if batch is not None:
+            entry["batch"] = batch
+        try:
+            self._writer().info(json.dumps(entry, ensure_ascii=False))
+        except Exception:
+            logger.exception("Scrittura del log delle query lente fallita")
+
+    def top(self, n: int = 5) -> list[SlowQueryStats]:
+        with self._lock:
+            return sorted(self._stats.values(), key=lambda s: s.total_ms, reverse=True)[:n]
+
+    def reset(self) -> None:
+        with self._lock:
+            self._stats.clear()
+
+    def summary(self, top: int = 5) -> str:
+        """Le query lente più costose (tempo totale) per il comando admin."""
+        rows = self.top(top)
+        if not rows:
+            return f"Nessuna query oltre {self.threshold_s * 1000:g} ms."
+        out = []
+        for i, s in enumerate(rows, 1):
+            sql = s.sql if len(s.sql) <= 160 else s.sql[:157] + "..."
+            out.append(f"{i}. {s.count}× media {s.avg_ms:.1f} ms, max {s.max_ms:.1f} ms\n{sql}")
+            if s.callers:
+                out.append("   da: " + ", ".join(sorted(s.callers)))
+            for step in s.plan[:4]:
+                out.append(f"   ↳ {step}")
+        return "\n".join(out)
+
+
+# Log condiviso dal processo (None se SLOW_QUERY_MS=0)
+SLOW_QUERIES = SlowQueryLog() if SLOW_QUERY_ENABLED else None
@@ -1,16 +1,20 @@
 # stats_module.py
+from __future__ import annotations
+
 import datetime
 import os
 import sqlite3
 from collections import Counter, defaultdict
-from typing import Iterable, Sequence
+from typing import TYPE_CHECKING, Iterable, Sequence
 
-from telegram import Update
-from telegram.ext import ContextTypes
+if TYPE_CHECKING:  # telegram serve solo per le annotazioni degli handler
+    from telegram import Update
+    from telegram.ext import ContextTypes
 
 
 def _resolve_db_path() -> str:
-    explicit = os.environ.get("STATS_DB_PATH")
+    # Stesso DB del bot (BOT_DB_PATH, come core_module) salvo STATS_DB_PATH esplicito
+    explicit = os.environ.get("STATS_DB_PATH") or os.environ.get("BOT_DB_PATH", "").strip()
     if explicit:
         return explicit
     base_dir = os.path.dirname(os.path.abspath(__file__))
@@ -33,6 +37,15 @@ GENDER_ORDER = ["Donna", "Uomo"]
 GENDER_ICONS = {"Donna": "👩", "Uomo": "👨"}
 
 
+def _bookings_table(con: sqlite3.Connection, start_iso: str) -> str:
+    """"bookings" o, se il periodo arriva nell'archivio, la vista "bookings_all"."""
+    try:
+        row = con.execute("SELECT MAX(date) FROM bookings_archive").fetchone()
+    except sqlite3.OperationalError:
+        return "bookings"
+    return "bookings_all" if row[0] is not None and start_iso <= row[0] else "bookings"
+
+
 def _make_bar(value: int, max_value: int) -> str:
     if max_value <= 0:
         return "▫" * BAR_WIDTH
@@ -121,26 +134,48 @@ def _format_waitlist_section(entries: Sequence[tuple[str, str]], heading: str) -
     lines.append("")
     return lines
 
-def get_daily_stats_text(target_date: datetime.date | None = None) -> str | None:
-    """Restituisce il report testuale delle prenotazioni odierne (o data indicata)."""
-    if target_date is None:
-        target_date = datetime.date.today()
-    date_str = target_date.strftime("%Y-%m-%d")
+def _aggregate_bookings(
+    bucket_sql: str, start_iso: str, end_iso: str
+) -> list[tuple[str, str | None, str, int]]:
+    """Prenotazioni confermate del periodo già contate da SQLite: (bucket, genere, servizio, n).
+
+    Il GROUP BY restituisce al più bucket × servizi righe, qualunque sia il numero di
+    prenotazioni: il report resta veloce al crescere dei dati.
+    """
     con = _connect()
     cur = con.cursor()
     cur.execute(
-        """
-        SELECT SUBSTR(b.time, 1, 2) AS hour_bucket,
+        f"""
+        SELECT {bucket_sql} AS bucket,
                COALESCE(s.gender, '') AS gender,
-               COALESCE(s.title, b.service_name, b.service_code) AS service_title
-        FROM bookings b
+               COALESCE(s.title, b.service_name, b.service_code) AS service_title,
+               COUNT(*) AS n
+        FROM {_bookings_table(con, start_iso)} b
         LEFT JOIN services s ON s.code = b.service_code
-        WHERE b.date = ? AND b.status = 'CONFIRMED'
+        WHERE b.date BETWEEN ? AND ? AND b.status = 'CONFIRMED'
+        GROUP BY bucket, gender, service_title
         """,
-        (date_str,),
+        (start_iso, end_iso),
     )
     rows = cur.fetchall()
     con.close()
+    return [
+        (
+            row["bucket"],
+            _normalize_gender(row["gender"]),
+            (row["service_title"] or "Servizio").strip() or "Servizio",
+            row["n"],
+        )
+        for row in rows
+    ]
+
+
+def get_daily_stats_text(target_date: datetime.date | None = None) -> str | None:
+    """Restituisce il report testuale delle prenotazioni odierne (o data indicata)."""
+    if target_date is None:
+        target_date = datetime.date.today()
+    date_str = target_date.strftime("%Y-%m-%d")
+    rows = _aggregate_bookings("SUBSTR(b.time, 1, 2)", date_str, date_str)
     if not rows:
         return None
 
@@ -148,16 +183,12 @@ def get_daily_stats_text(target_date: datetime.date | None = None) -> str | None
     gender_hour_counts: dict[str, Counter[str]] = defaultdict(Counter)
     gender_service_counts: dict[str, Counter[str]] = defaultdict(Counter)
 
-    for row in rows:
-        raw_hour = (row["hour_bucket"] or "00").strip()
-        hour_label = f"{raw_hour.zfill(2)}:00"
-        gender = _normalize_gender(row["gender"])
-        service_title = (row["service_title"] or "Servizio").strip() or "Servizio"
-
-        hour_counts[hour_label] += 1
+    for raw_hour, gender, service_title, n in rows:
+        hour_label = f"{(raw_hour or '00').strip().zfill(2)}:00"
+        hour_counts[hour_label] += n
         if gender:
-            gender_hour_counts[gender][hour_label] += 1
-            gender_service_counts[gender][service_title] += 1
+            gender_hour_counts[gender][hour_label] += n
+            gender_service_counts[gender][service_title] += n
 
     ordered_hours = sorted(hour_counts.keys())
     global_max_hour = max(hour_counts.values()) if hour_counts else 0
@@ -198,21 +229,7 @@ def get_weekly_stats_text(anchor_date: datetime.date | None = None) -> str | Non
         anchor_date = datetime.date.today()
     start = anchor_date - datetime.timedelta(days=anchor_date.weekday())
     end = start + datetime.timedelta(days=6)
-    con = _connect()
-    cur = con.cursor()
-    cur.execute(
-        """
-        SELECT b.date AS day,
-               COALESCE(s.gender, '') AS gender,
-               COALESCE(s.title, b.service_name, b.service_code) AS service_title
-        FROM bookings b
-        LEFT JOIN services s ON s.code = b.service_code
-        WHERE b.date BETWEEN ? AND ? AND b.status = 'CONFIRMED'
-        """,
-        (start.strftime("%Y-%m-%d"), end.strftime("%Y-%m-%d")),
-    )
-    rows = cur.fetchall()
-    con.close()
+    rows = _aggregate_bookings("b.date", start.strftime("%Y-%m-%d"), end.strftime("%Y-%m-%d"))
     if not rows:
         return None
 
@@ -220,17 +237,12 @@ def get_weekly_stats_text(anchor_date: datetime.date | None = None) -> str | Non
     gender_day_counts: dict[str, Counter[str]] = defaultdict(Counter)
     gender_service_counts: dict[str, Counter[str]] = defaultdict(Counter)
 
-    for row in rows:
-        date_iso = row["day"]
-        day_obj = datetime.datetime.strptime(date_iso, "%Y-%m-%d").date()
-        day_label = day_obj.strftime("%d/%m")
-        gender = _normalize_gender(row["gender"])
-        service_title = (row["service_title"] or "Servizio").strip() or "Servizio"
-
-        day_counts[day_label] += 1
+    for date_iso, gender, service_title, n in rows:
+        day_label = datetime.datetime.strptime(date_iso, "%Y-%m-%d").strftime("%d/%m")
+        day_counts[day_label] += n
         if gender:
-            gender_day_counts[gender][day_label] += 1
-            gender_service_counts[gender][service_title] += 1
+            gender_day_counts[gender][day_label] += n
+            gender_service_counts[gender][service_title] += n
 
     ordered_days = [
         (start + datetime.timedelta(days=offset)).strftime("%d/%m")
@@ -2,9 +2,14 @@
 Modulo UX - Messaggi di conferma e notifiche per migliorare l'esperienza utente
 """
 
+from __future__ import annotations
+
 from datetime import datetime
-from telegram import Update, InlineKeyboardMarkup
-from telegram.ext import ContextTypes
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:  # telegram serve solo per le annotazioni
+    from telegram import Update, InlineKeyboardMarkup
+    from telegram.ext import ContextTypes
 
 async def send_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE, booking_info, via_callback=False, reply_markup=None, skip_warm_message=False):
     """